@@ -16,9 +16,15 @@
 #define DAC_TEST_DELAY 20
 #define DACMAX 4095
 
+// Serial link to Spotter, has to match the baud rate set in Spotter.
+// The programming port runs reliably up to 115200 baud. The native USB
+// port (SerialUSB) always runs at full USB speed, ignoring the baud rate.
+#define LINK Serial
+#define BAUD_RATE 57600
+
 #ifdef DEBUG
-  #define DEBUGLN(x)  Serial.println(x)
-  #define DEBUG(x)  Serial.print(x)
+  #define DEBUGLN(x)  LINK.println(x)
+  #define DEBUG(x)  LINK.print(x)
 #else
   #define DEBUGLN(x)
   #define DEBUG(x)
@@ -43,6 +49,32 @@ byte DOUT_pins[DOUT_N] = {2, 3, 4, 5};
 #define TYPE_DAC 0x01
 #define TYPE_DIGITAL 0x02
 
+// Protocols, switched by utility request REPORT_PROTOCOL
+#define REPORT_PROTOCOL 0x04
+#define PROTOCOL_LEGACY 1
+#define PROTOCOL_FRAMED 2
+#define PROTOCOL_PACKED 3
+
+// Framed protocol: SYNC, sequence number, instruction count, three bytes
+// per instruction (command, 16 bit data LSB first), CRC8 of everything
+// after SYNC. Every frame is answered by SYNC, sequence number, ACK/NAK.
+// With the packed protocol, frames may also start with SYNC_DAC, followed
+// by sequence number, channel count, values of DAC channels 0..count-1
+// packed as 12 bit each (two values in three bytes, LSB first) and CRC8.
+#define SYNC 0xA5
+#define SYNC_DAC 0xA6
+#define ACK 0x06
+#define NAK 0x15
+#define MAX_INSTRUCTIONS 255
+// ms after which an incomplete frame is dropped
+#define FRAME_TIMEOUT 50
+
+#define WAIT_SYNC 0
+#define WAIT_SEQ 1
+#define WAIT_COUNT 2
+#define WAIT_PAYLOAD 3
+#define WAIT_CRC 4
+
 int inData = 0;
 byte outData = 0;
 byte data = 0x00;
@@ -50,6 +82,16 @@ byte data = 0x00;
 int tmp = 0x00;
 byte inBytes[4];
 
+byte protocol = PROTOCOL_LEGACY;
+byte frameState = WAIT_SYNC;
+byte frameSync = SYNC;
+byte frameSeq = 0;
+byte frameCount = 0;
+byte frameCRC = 0;
+unsigned int framePos = 0;
+unsigned long frameStart = 0;
+byte framePayload[3*MAX_INSTRUCTIONS];
+
 /* 
  Analog write on Arduino Due's DAC0 and DAC1
  */
@@ -99,21 +141,44 @@ Report arduino capabilities to Spotter. I.e. give number
 void report(byte request, short inputValue) {
   switch (request) {
     case 0x00:
-      Serial.println(inputValue, DEC);
+      LINK.println(inputValue, DEC);
       break;
     case 0x01:
-      Serial.println(DAC_N, DEC);
+      LINK.println(DAC_N, DEC);
       break;
     case 0x02:
-      Serial.println(DOUT_N, DEC);
+      LINK.println(DOUT_N, DEC);
       break;
     case 0x03:
-      Serial.println(DIN_N, DEC);
+      LINK.println(DIN_N, DEC);
+      break;
+    case REPORT_PROTOCOL:
+      if (inputValue >= PROTOCOL_LEGACY && inputValue <= PROTOCOL_PACKED) {
+        LINK.println(inputValue, DEC);
+        protocol = inputValue;
+      }
       break;
   }
 }
 
 
+/*
+CRC-8 with polynomial 0x07, updated byte by byte
+ */
+byte crc8(byte crc, byte value) {
+  crc ^= value;
+  for (byte i = 0; i < 8; i++) {
+    if (crc & 0x80) {
+      crc = (crc << 1) ^ 0x07;
+    } 
+    else {
+      crc <<= 1;
+    }
+  }
+  return crc;
+}
+
+
 /*
 Interpret the received byte array by splitting it into a command, followed
  by payload data used in its execution
@@ -122,12 +187,20 @@ void interpretCommand() {
   if (inBytes[3] != '\n') {
     return;
   }
-  inData = (inBytes[2]<<8) + inBytes[1];
+  executeCommand(inBytes[0], inBytes[1], inBytes[2]);
+}
+
+
+/*
+Execute a single command byte with its two data bytes, LSB first
+ */
+void executeCommand(byte cmd, byte lsb, byte msb) {
+  inData = (msb<<8) + lsb;
   if (inData > DACMAX) {
     inData = DACMAX;
   }
-  byte addr = (CMDADDR & inBytes[0]);
-  byte type = (CMDTYPE & inBytes[0]) >> 3;
+  byte addr = (CMDADDR & cmd);
+  byte type = (CMDTYPE & cmd) >> 3;
   DEBUGLN(type);
   DEBUGLN(addr);
   DEBUGLN(inData);
@@ -162,7 +235,7 @@ void setup(){
   }
 
   // initialize serial connection
-  Serial.begin(57600);
+  LINK.begin(BAUD_RATE);
 
   // ready ditital output pins
   for (byte i = 0; i < DOUT_N; i++) {
@@ -181,15 +254,20 @@ Called when serial data available after each loop()
  Requires use of non-blocking timings for opening outputs,
  otherwise delayed and buffers might fill up
  
- Current protocol is defined as one command byte, followed
- by two data bytes and closed with a newline.
+ Legacy protocol is defined as one command byte, followed
+ by two data bytes and closed with a newline. The framed protocol
+ is handled by frameRcvEvent.
  */
 void serialRcvEvent() {
-  while (Serial.available()) {
+  if (protocol >= PROTOCOL_FRAMED) {
+    frameRcvEvent();
+    return;
+  }
+  while (LINK.available()) {
     byte n = 0;
     while (n < 4) {
       // get the new byte:
-      tmp = Serial.read();
+      tmp = LINK.read();
       if (tmp > -1) {
         inBytes[n] = tmp;
         n++;
@@ -200,8 +278,100 @@ void serialRcvEvent() {
 }
 
 
+/*
+Payload bytes of the current frame
+ */
+unsigned int payloadLength() {
+  if (frameSync == SYNC_DAC) {
+    return (3*(unsigned int)frameCount + 1)/2;
+  }
+  return 3*(unsigned int)frameCount;
+}
+
+
+/*
+Set DAC channels 0..frameCount-1 from 12 bit values packed two in three bytes
+ */
+void setPackedDACs() {
+  for (unsigned int i = 0; i < frameCount; i++) {
+    unsigned int pos = 3*(i/2);
+    int value;
+    if (i % 2 == 0) {
+      value = framePayload[pos] | ((framePayload[pos+1] & 0x0F) << 8);
+    } 
+    else {
+      value = (framePayload[pos+1] >> 4) | (framePayload[pos+2] << 4);
+    }
+    setDAC(i, value);
+  }
+}
+
+
+/*
+Framed protocol receiver. Consumes bytes as they arrive, executes all
+ instructions of a frame once its CRC matched and answers ACK, or NAK
+ if it didn't. Resynchronizes on the next SYNC byte.
+ */
+void frameRcvEvent() {
+  if (frameState != WAIT_SYNC && millis() - frameStart > FRAME_TIMEOUT) {
+    frameState = WAIT_SYNC;
+  }
+  while (LINK.available() && protocol >= PROTOCOL_FRAMED) {
+    byte b = LINK.read();
+    switch (frameState) {
+    case WAIT_SYNC:
+      if (b == SYNC || (b == SYNC_DAC && protocol == PROTOCOL_PACKED)) {
+        frameSync = b;
+        frameState = WAIT_SEQ;
+        frameStart = millis();
+      }
+      break;
+    case WAIT_SEQ:
+      frameSeq = b;
+      frameCRC = crc8(0, b);
+      frameState = WAIT_COUNT;
+      break;
+    case WAIT_COUNT:
+      frameCount = b;
+      frameCRC = crc8(frameCRC, b);
+      framePos = 0;
+      frameState = frameCount ? WAIT_PAYLOAD : WAIT_CRC;
+      break;
+    case WAIT_PAYLOAD:
+      framePayload[framePos++] = b;
+      frameCRC = crc8(frameCRC, b);
+      if (framePos >= payloadLength()) {
+        frameState = WAIT_CRC;
+      }
+      break;
+    case WAIT_CRC:
+      frameState = WAIT_SYNC;
+      if (b == frameCRC) {
+        if (frameSync == SYNC_DAC) {
+          setPackedDACs();
+        } 
+        else {
+          for (unsigned int i = 0; i < frameCount; i++) {
+            executeCommand(framePayload[3*i], framePayload[3*i+1], framePayload[3*i+2]);
+          }
+        }
+        LINK.write(SYNC);
+        LINK.write(frameSeq);
+        LINK.write(ACK);
+      } 
+      else {
+        LINK.write(SYNC);
+        LINK.write(frameSeq);
+        LINK.write(NAK);
+      }
+      break;
+    }
+  }
+}
+
+
 void loop() {
-  if (Serial.available()) {
+  if (LINK.available()) {
     serialRcvEvent();
   }
   //delay(1);
@@ -16,6 +16,10 @@
 #define DAC_TEST_DELAY 20
 #define DACMAX 4095
 
+// has to match the baud rate set in Spotter, 16 MHz boards run reliably up
+// to 115200 baud
+#define BAUD_RATE 57600
+
 #ifdef DEBUG
   #define DEBUGLN(x)  Serial.println(x)
   #define DEBUG(x)  Serial.print(x)
@@ -189,7 +193,7 @@ void interpretCommand() {
 
 void setup(){
   // initialize serial connection
-  Serial.begin(57600);
+  Serial.begin(BAUD_RATE);
 
   // ready SPI to talk to DAC
   for (byte i = 0; i < SPI_N_DEVS; i++) {
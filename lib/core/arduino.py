@@ -6,7 +6,8 @@ Created on Sat Jan  5 16:54:29 2013
 
 A lot of the handling is done the way Firmata handles the boards
 
-TODO: How does the non-blocking pass_time function work exactly?
+Waits for replies block on the port with select where the platform allows,
+and fall back to short sleeps elsewhere.
 """
 import logging
 
@@ -14,9 +15,49 @@ import sys
 import serial
 import time
 import struct
+import select
 
 VERSION = 0.1
 
+# Framed protocol. Frame: SYNC, sequence number, instruction count, three
+# bytes per instruction (type << 3 | address, 16 bit data little endian) and
+# CRC8 of everything after SYNC. The board answers SYNC, sequence number and
+# ACK or NAK for every frame. Replies of report instructions are text lines
+# as before, which can never contain SYNC.
+# The packed protocol adds frames starting with SYNC_DAC, carrying the values
+# of DAC channels 0..count-1 as 12 bit each, two values in three bytes.
+PROTOCOL_LEGACY = 1
+PROTOCOL_FRAMED = 2
+PROTOCOL_PACKED = 3
+REPORT_PROTOCOL = 4
+SYNC = 0xA5
+SYNC_DAC = 0xA6
+ACK = 0x06
+NAK = 0x15
+MAX_INSTRUCTIONS = 255
+# instruction type the firmware doesn't execute
+TYPE_NONE = 7
+
+
+def _crc8_table(poly=0x07):
+    table = []
+    for byte in xrange(256):
+        crc = byte
+        for _ in xrange(8):
+            crc = ((crc << 1) ^ poly) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+        table.append(crc)
+    return table
+
+CRC8_TABLE = _crc8_table()
+
+
+def crc8(data, start=0, end=None):
+    """ CRC-8 (polynomial 0x07) of a bytearray slice. """
+    crc = 0
+    for i in xrange(start, len(data) if end is None else end):
+        crc = CRC8_TABLE[crc ^ data[i]]
+    return crc
+
 
 class Pin(object):
     prefixes = ['CMD', 'DAC', 'DO', 'PWM']
@@ -37,12 +78,25 @@ class Arduino(object):
     connected = False
     name = 'Arduino'
 
+    # seconds to wait for acknowledgement of a frame before sending its
+    # instructions again, and how often
+    ack_timeout = 0.1
+    max_retries = 2
+
+    # seconds a board may take to answer after opening the port resets it
+    boot_timeout = 3.0
+
+    # protocol switch requests per protocol, and seconds to wait for the
+    # board to confirm each
+    negotiate_tries = 2
+    negotiate_timeout = 0.1
+
     def __init__(self, port, baud_rate=57600):
 
         self.log = logging.getLogger(__name__)
 
         self.sp = serial.Serial(port, baud_rate)
-        self.pass_time(3)
+        self.baud_rate = baud_rate
 
         self.bytes_sent = 0
         self.bytes_received = 0
@@ -50,6 +104,31 @@ class Arduino(object):
         self.pins = dict(dac=[], digital=[], pwm=[], adc=[])
 
         self.port_string = port
+
+        # framed protocol state, legacy until negotiated with the board
+        self.framed = False
+        self.packed = False
+        self.seq = 0
+        self.tx_buffer = bytearray(4 + 3*MAX_INSTRUCTIONS)
+        self.rx_buffer = bytearray()
+        self.rx_text = ''
+        # unacknowledged frames by sequence number as [instructions, ack
+        # deadline, tries, size], bytes of those still on the way, and the
+        # last frame carrying each pin
+        self.pending = {}
+        self.bytes_in_flight = 0
+        self.pin_seq = {}
+        # pins whose latest frame was refused or lost and not sent again,
+        # for the sender to take with take_failed_pins
+        self.failed_pins = set()
+        # last value sent to each DAC channel, fills gaps of packed frames
+        self.dac_values = {}
+        self.last_ack = None
+        self.n_frames = 0
+        self.n_nak = 0
+        self.n_timeouts = 0
+        self.n_retries = 0
+        self.n_lost = 0
 #        self.sp.flushInput()
 
     def __str__(self):
@@ -68,8 +147,7 @@ class Arduino(object):
     def get_pins(self):
         self.send_instructions([[0, 1, 0], [0, 2, 0]])
         # give arduino time to respond
-        self.pass_time(0.1)
-        if self.bytes_available():
+        if self.wait_for_lines(2, 0.1):
             responses = map(int, self.read_all_bytes().splitlines())
             dac_pins = [Pin(idx, 1) for idx in xrange(responses[0])]
             dig_pins = [Pin(idx, 2) for idx in xrange(responses[1])]
@@ -83,26 +161,289 @@ class Arduino(object):
             return True
         return False
 
+    @property
+    def instruction_size(self):
+        """ Bytes per instruction on the wire, without frame overhead. """
+        if self.packed:
+            return 1.5
+        return 3 if self.framed else 4
+
+    @property
+    def protocol_name(self):
+        return 'packed' if self.packed else 'framed' if self.framed else 'legacy'
+
+    def negotiate(self, protocols=(PROTOCOL_PACKED, PROTOCOL_FRAMED)):
+        """
+        Ask the board to switch to the first protocol it accepts. Boards
+        with older firmware don't answer and stay with the current one.
+        A switch to a framed protocol only counts once the board acknowledged
+        a frame, as its answer may get lost. Without acknowledgement the
+        board is told to go back to the legacy protocol, whatever it uses.
+        """
+        for protocol in protocols:
+            for attempt in xrange(self.negotiate_tries):
+                self.send_instructions([[0, REPORT_PROTOCOL, protocol]])
+                answer = self.read_all_bytes().strip() if self.wait_for_lines(1, self.negotiate_timeout) else ''
+                accepted = answer.isdigit() and int(answer) == protocol
+                if protocol == PROTOCOL_LEGACY:
+                    if accepted:
+                        self.use_protocol(protocol)
+                        return True
+                    continue
+
+                self.use_protocol(protocol)
+                if self.ping():
+                    self.log.info('Using %s serial protocol', self.protocol_name)
+                    return True
+                if accepted:
+                    self.log.warning('Board accepted %s protocol, but did not acknowledge frames',
+                                     self.protocol_name)
+                self.revert()
+        self.log.info('Board did not accept protocols %s, using %s protocol', protocols,
+                      self.protocol_name)
+        return False
+
+    def use_protocol(self, protocol):
+        self.framed = protocol >= PROTOCOL_FRAMED
+        self.packed = protocol == PROTOCOL_PACKED
+        self.pending.clear()
+        self.failed_pins.clear()
+        self.bytes_in_flight = 0
+        # frame statistics are of the protocol in use, not of negotiating it
+        self.n_frames = self.n_nak = self.n_timeouts = self.n_retries = self.n_lost = 0
+
+    def ping(self):
+        """
+        Send an empty frame, True if acknowledged. Only used before the
+        framed protocol is confirmed: being four bytes long, it keeps a
+        board still reading legacy commands aligned, which drops it as
+        command without newline or executes it as unknown command type.
+        """
+        self.send_frame([])
+        seq = self.seq
+        deadline = time.time() + self.negotiate_timeout + self.bytes_in_flight * 10.0 / self.baud_rate
+        while self.last_ack != seq:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            self.wait_readable(remaining)
+            self.poll()
+        return True
+
+    def revert(self):
+        """
+        Put the board back to the legacy protocol, whichever it is in. The
+        framed request is filled up with instructions of unused type to
+        sixteen bytes, which a board reading legacy commands drops as four
+        commands without newline, or executes as unknown command type. The
+        legacy request has no SYNC byte and is skipped by a board reading
+        frames.
+        """
+        self.use_protocol(PROTOCOL_FRAMED)
+        self.send_frame([[0, REPORT_PROTOCOL, PROTOCOL_LEGACY]] + [[TYPE_NONE, 0, 0]] * 3)
+        self.use_protocol(PROTOCOL_LEGACY)
+        self.send_instructions([[0, REPORT_PROTOCOL, PROTOCOL_LEGACY]])
+        self.wait_for_lines(2, self.negotiate_timeout)
+        self.read_all_bytes()
+        del self.rx_buffer[:]
+
     def read_all_bytes(self):
-        msg = self.sp.read(self.bytes_available())
-        self.bytes_received += len(msg)
+        self.poll()
+        msg, self.rx_text = self.rx_text, ''
         return msg
 
     def read_line(self):
-        msg = self.sp.readline()
-        self.bytes_received += len(msg)
-        return msg
+        self.poll()
+        if '\n' not in self.rx_text:
+            if self.framed:
+                return ''
+            self.rx_text += self.sp.readline()
+        msg, _, self.rx_text = self.rx_text.partition('\n')
+        return msg + '\n'
 
     def bytes_available(self):
-        return self.sp.inWaiting()
+        self.poll()
+        return len(self.rx_text)
+
+    def wait_for_lines(self, n_lines, timeout):
+        """ Wait until n_lines of text arrived. False if timed out. """
+        deadline = time.time() + timeout
+        self.poll()
+        while self.rx_text.count('\n') < n_lines:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            self.wait_readable(remaining)
+            self.poll()
+        return True
+
+    def wait_readable(self, timeout):
+        """ Block until the port has data or timeout passed. """
+        try:
+            select.select([self.sp.fileno()], [], [], timeout)
+        except (AttributeError, ValueError, TypeError, select.error, IOError):
+            # no selectable port handle, e.g. on Windows
+            time.sleep(min(timeout, 0.01))
+
+    def poll(self):
+        """
+        Read waiting bytes. With the framed protocol, hand acknowledgements
+        to the pending frames, keep everything else as text, and resend
+        frames without timely answer.
+        """
+        n = self.sp.inWaiting()
+        if n:
+            self.rx_buffer.extend(self.sp.read(n))
+            self.bytes_received += n
+
+        if not self.framed:
+            self.rx_text += str(self.rx_buffer)
+            del self.rx_buffer[:]
+            return
+
+        while self.rx_buffer:
+            i = self.rx_buffer.find(chr(SYNC))
+            if i < 0:
+                self.rx_text += str(self.rx_buffer)
+                del self.rx_buffer[:]
+            else:
+                self.rx_text += str(self.rx_buffer[:i])
+                del self.rx_buffer[:i]
+                if len(self.rx_buffer) < 3:
+                    break
+                self.acknowledge(self.rx_buffer[1], self.rx_buffer[2])
+                del self.rx_buffer[:3]
+
+        now = time.time()
+        for seq in [sq for sq, p in self.pending.iteritems() if now > p[1]]:
+            self.n_timeouts += 1
+            self.resend(seq)
+
+    def acknowledge(self, seq, status):
+        if status == ACK:
+            self.last_ack = seq
+        if seq not in self.pending:
+            return
+        if status == ACK:
+            self.bytes_in_flight -= self.pending.pop(seq)[3]
+        else:
+            self.n_nak += 1
+            self.fail_pins(seq)
+            self.resend(seq)
+
+    def resend(self, seq):
+        """
+        Send instructions of an unacknowledged frame again, unless a later
+        frame already carried newer data for the same pin.
+        """
+        instructions, deadline, tries, size = self.pending.pop(seq)
+        self.bytes_in_flight -= size
+        if tries > self.max_retries:
+            self.n_lost += 1
+            self.fail_pins(seq, instructions)
+            self.log.warning('Frame %d lost after %d tries', seq, tries)
+            return
+        instructions = [i for i in instructions if self.pin_seq.get((i[0], i[1])) == seq]
+        if instructions:
+            self.n_retries += 1
+            self.send_frame(instructions, tries + 1)
+
+    def fail_pins(self, seq, instructions=None):
+        """ Note pins of the frame for which no later frame was sent. """
+        if instructions is None:
+            instructions = self.pending[seq][0]
+        self.failed_pins.update((i[0], i[1]) for i in instructions if self.pin_seq.get((i[0], i[1])) == seq)
+
+    def take_failed_pins(self):
+        """ Pins that may not hold the value last sent, since the last call. """
+        failed, self.failed_pins = self.failed_pins, set()
+        return failed
+
+    def encode_frame(self, seq, instructions):
+        """ Encode frame into the transmit buffer, return its length. """
+        buf = self.tx_buffer
+        buf[0] = SYNC
+        buf[1] = seq
+        buf[2] = len(instructions)
+        pos = 3
+        for type_id, address, data in instructions:
+            data = min(max(int(data), 0), 0xFFFF) if data is not None else 0
+            struct.pack_into('<BH', buf, pos, (type_id << 3) | address, data)
+            pos += 3
+        buf[pos] = crc8(buf, 1, pos)
+        return pos + 1
+
+    def encode_packed_frame(self, seq, values):
+        """ Encode DAC values of channels 0..n-1 as packed frame. """
+        buf = self.tx_buffer
+        buf[0] = SYNC_DAC
+        buf[1] = seq
+        buf[2] = len(values)
+        pos = 3
+        for n in xrange(0, len(values), 2):
+            a = min(max(int(values[n] or 0), 0), 0xFFF)
+            buf[pos] = a & 0xFF
+            if n + 1 < len(values):
+                b = min(max(int(values[n+1] or 0), 0), 0xFFF)
+                buf[pos+1] = (a >> 8) | ((b & 0x0F) << 4)
+                buf[pos+2] = b >> 4
+                pos += 3
+            else:
+                buf[pos+1] = a >> 8
+                pos += 2
+        buf[pos] = crc8(buf, 1, pos)
+        return pos + 1
+
+    def send_frame(self, instructions, tries=1, packed=False):
+        self.seq = (self.seq + 1) % 256
+        # window of unacknowledged frames is full, wait for the answer to
+        # the frame with the same sequence number, or its time-out
+        while self.seq in self.pending:
+            self.wait_readable(max(0.0, self.pending[self.seq][1] - time.time()))
+            self.poll()
+        if packed:
+            n = self.encode_packed_frame(self.seq, [i[2] for i in instructions])
+        else:
+            n = self.encode_frame(self.seq, instructions)
+        self.sp.write(memoryview(self.tx_buffer)[:n])
+        self.bytes_sent += n
+        self.n_frames += 1
+        # the answer can't come before everything sent so far went through,
+        # 10 bits per byte
+        self.bytes_in_flight += n
+        deadline = time.time() + self.ack_timeout + self.bytes_in_flight * 10.0 / self.baud_rate
+        self.pending[self.seq] = [instructions, deadline, tries, n]
+        for i in instructions:
+            self.pin_seq[(i[0], i[1])] = self.seq
+            self.failed_pins.discard((i[0], i[1]))
+            if i[0] == 1:
+                self.dac_values[i[1]] = i[2]
+
+    def send_packed(self, instruction_list):
+        """
+        Send DAC instructions as one packed frame if that takes fewer bytes
+        than sending them as regular instructions. Channels without new
+        value are filled with the last one sent. Returns instructions left.
+        """
+        dac = dict((i[1], i[2]) for i in instruction_list if i[0] == 1)
+        if not dac:
+            return instruction_list
+        channels = [[1, a, dac.get(a, self.dac_values.get(a, 0))] for a in xrange(max(dac) + 1)]
+        others = [i for i in instruction_list if i[0] != 1]
+        size_packed = 4 + (3*len(channels) + 1) // 2 + (4 + 3*len(others) if others else 0)
+        if size_packed >= 4 + 3*len(instruction_list) or len(channels) > MAX_INSTRUCTIONS:
+            return instruction_list
+        self.send_frame(channels, packed=True)
+        return others
 
     def send_as_two_bytes(self, val):
         self.sp.write(chr(val % 128) + chr(val >> 7))
 
     def send_instructions(self, instruction_list):
         """
-        Send command byte followed by two data bytes. struct packs short
-        unsigned value ('H') as two bytes, big endian.
+        Send instructions as frames of the framed protocol, or as command
+        byte followed by two data bytes for the legacy protocol. struct packs
+        short unsigned value ('H') as two bytes, big endian.
         Type 0 = report
         Type 1 = dac
         Type 2 = digital
@@ -118,19 +459,26 @@ class Arduino(object):
         N DAC.6     V DO.6
         O DAC.7     W DO.7
         """
-        msg = ''
-        cmd_values = [0, ord('H'), ord('P')]
-        for i in instruction_list:
-            # instruction and address
-            msg += chr(cmd_values[i[0]] + i[1])
-            data = i[2] if i[2] is not None else 0
-            msg = msg + struct.pack('H', data) + '\n'
-
-        # all instructions as one string to reduce the amount of
+        # all instructions as one write to reduce the amount of
         # time spent in 4ms delay arduino spends on serial communication
         if self.sp is None:
             return False
         try:
+            if self.framed:
+                self.poll()
+                if self.packed:
+                    instruction_list = self.send_packed(instruction_list)
+                for n in xrange(0, len(instruction_list), MAX_INSTRUCTIONS):
+                    self.send_frame(instruction_list[n:n+MAX_INSTRUCTIONS])
+                return True
+
+            cmd_values = [0, ord('H'), ord('P')]
+            msg = []
+            for i in instruction_list:
+                # instruction and address
+                data = i[2] if i[2] is not None else 0
+                msg.append(chr(cmd_values[i[0]] + i[1]) + struct.pack('H', data) + '\n')
+            msg = ''.join(msg)
             self.sp.write(msg)
         except serial.serialutil.SerialTimeoutException, error:  # or writeTimeoutError
             self.log.error(error)
@@ -144,8 +492,11 @@ class Arduino(object):
     def close(self):
         """ Call this to exit a bit cleaner. """
         self.log.info("Closing Serial")
-        if hasattr(self, 'sp') and self.sp is not None:
+        if hasattr(self, 'sp') and self.is_open():
             self.null_pins()
+            # leave the board ready for the next handshake
+            if self.framed:
+                self.negotiate((PROTOCOL_LEGACY,))
             self.sp.close()
         self.bytes_received = 0
         self.bytes_sent = 0
@@ -161,10 +512,8 @@ class Arduino(object):
 
     @staticmethod
     def pass_time(duration):
-        """ Non-blocking time-out for t seconds. """
-        cont = time.time() + duration
-        while time.time() < cont:
-            time.sleep(0)
+        """ Time-out for t seconds, without keeping the CPU busy. """
+        time.sleep(duration)
 
 
 #############################################################
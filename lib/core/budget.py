@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 10:12:40 2026
+
+Per-frame time budget of the main loop. Degrades tracking quality step by
+step when updates keep overrunning the frame period, and restores it when
+there is time to spare again.
+"""
+
+import time
+import logging
+
+
+class TickBudget:
+    """
+    Keeps track of the deadline of the current frame, given by the source
+    fps. Degradation steps, in order: defer color updates of regions, lower
+    the tracking scale, skip features that don't drive any pins. Recovery
+    undoes them in reverse order.
+    """
+    # fraction of the frame period the update may use
+    headroom = 0.8
+
+    # consecutive frames over budget before degrading further
+    overrun_frames = 5
+    # consecutive frames below recover_fraction of budget before recovering
+    recover_frames = 30
+    recover_fraction = 0.5
+
+    # tracking scale factor steps
+    scale_step = 0.75
+    min_scale = 0.25
+
+    def __init__(self):
+        self.log = logging.getLogger(__name__)
+
+        self.budget = None
+        self.ts_start = None
+        self.deadline = None
+        self.elapsed = 0
+
+        self.n_over = 0
+        self.n_under = 0
+
+        # degradation state
+        self.defer_highlight = False
+        self.scale = 1.0
+        self.skip_noncritical = False
+
+    def begin(self, fps):
+        """ Start of a frame update. No budget if the source fps is unknown. """
+        self.ts_start = time.time()
+        try:
+            self.budget = self.headroom / float(fps) if fps > 0 else None
+        except (TypeError, ValueError):
+            self.budget = None
+        self.deadline = self.ts_start + self.budget if self.budget else None
+
+    def expired(self):
+        """ True if the deadline of the current frame has passed. """
+        return self.deadline is not None and time.time() > self.deadline
+
+    def end(self):
+        """ End of a frame update. Degrade or recover as needed. """
+        if self.ts_start is None:
+            return
+        self.elapsed = time.time() - self.ts_start
+        if not self.budget:
+            return
+
+        if self.elapsed > self.budget:
+            self.n_over += 1
+            self.n_under = 0
+        elif self.elapsed < self.budget * self.recover_fraction:
+            self.n_under += 1
+            self.n_over = 0
+        else:
+            self.n_over = self.n_under = 0
+
+        if self.n_over >= self.overrun_frames:
+            self.n_over = 0
+            self.degrade()
+        elif self.n_under >= self.recover_frames:
+            self.n_under = 0
+            self.recover()
+
+    @property
+    def degraded(self):
+        return self.defer_highlight or self.scale < 1.0 or self.skip_noncritical
+
+    def degrade(self):
+        """ Take the next degradation step, if any left. """
+        reason = '%.1f ms over %.1f ms budget' % (self.elapsed*1000, self.budget*1000)
+        if not self.defer_highlight:
+            self.defer_highlight = True
+            self.log.warning('Deferring region color updates, %s', reason)
+        elif self.scale * self.scale_step >= self.min_scale:
+            self.scale *= self.scale_step
+            self.log.warning('Lowering tracking scale to %.2f, %s', self.scale, reason)
+        elif not self.skip_noncritical:
+            self.skip_noncritical = True
+            self.log.warning('Skipping features not driving pins, %s', reason)
+
+    def recover(self):
+        """ Undo the last degradation step, if any. """
+        reason = '%.1f ms of %.1f ms budget' % (self.elapsed*1000, self.budget*1000)
+        if self.skip_noncritical:
+            self.skip_noncritical = False
+            self.log.info('Tracking all features again, %s', reason)
+        elif self.scale < 1.0:
+            self.scale = min(1.0, self.scale / self.scale_step)
+            self.log.info('Raising tracking scale to %.2f, %s', self.scale, reason)
+        elif self.defer_highlight:
+            self.defer_highlight = False
+            self.log.info('Updating region colors again, %s', reason)
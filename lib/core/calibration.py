@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 11:27:14 2026
+
+Codec calibration. Encodes a few seconds of synthetic frames at the frame
+size and rate of the recording with each candidate codec, measuring the
+achieved frame rate, CPU time and bytes per frame. Results are cached in
+the config directory, per machine and frame size, so each size is only
+measured once. The codec picked is the one giving the smallest files
+among those keeping up with the frame rate, or the fastest if none does.
+
+Running the module calibrates, measuring again if asked to, and lists the
+results.
+
+Usage:
+    calibration.py [options] [CODECS...]
+    calibration.py -h | --help
+
+Options:
+    -h --help           Show this screen
+    -d --dims DIMS      Frame size [default: 640x360]
+    -f --fps FPS        Frame rate to sustain [default: 30]
+    -t --time SECONDS   Seconds of video encoded per codec [default: 2]
+    -F --Force          Measure again even if cached
+    -D --DEBUG          Verbose debug output
+"""
+
+import os
+import json
+import time
+import shutil
+import socket
+import logging
+import tempfile
+
+import cv2
+import numpy as np
+
+from lib.docopt import docopt
+
+AUTO = 'AUTO'
+# achieved fps has to exceed the recording fps by this factor, leaving room
+# for everything else the machine does while recording
+MARGIN = 1.25
+
+DIR_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'config')
+cache_path = os.path.normpath(os.path.join(DIR_CONFIG, 'codec_calibration.json'))
+
+
+def synthetic_frames(size, n=32):
+    """ Frames with some motion and noise, so that the codec has work to do. """
+    x = np.linspace(0, 255, size[0]).astype(np.uint8)
+    base = np.dstack([np.tile(x, (size[1], 1))] * 3)
+    noise = np.random.randint(0, 32, (8, size[1], size[0], 3)).astype(np.uint8)
+    return [np.roll(base, 8 * i, axis=1) + noise[i % len(noise)] for i in xrange(n)]
+
+
+def measure(codec, size, fps, duration=2.0, frames=None):
+    """
+    Encode duration seconds worth of frames as fast as possible. Returns
+    achieved fps, CPU seconds per frame and bytes per frame, or None if the
+    codec can't be opened.
+    """
+    log = logging.getLogger(__name__)
+    frames = frames or synthetic_frames(size)
+    n_frames = max(int(duration * fps), len(frames))
+    directory = tempfile.mkdtemp()
+    try:
+        destination = os.path.join(directory, 'calibration.avi')
+        cc = list(codec)
+        writer = cv2.VideoWriter(filename=destination, fourcc=cv2.cv.CV_FOURCC(cc[0], cc[1], cc[2], cc[3]),
+                                 fps=fps, frameSize=size, isColor=True)
+        if not writer.isOpened():
+            log.warning('Codec %s not available', codec)
+            return None
+        t, cpu = time.time(), os.times()
+        for i in xrange(n_frames):
+            writer.write(frames[i % len(frames)])
+        del writer
+        dt = time.time() - t
+        cpu = sum(os.times()[:2]) - sum(cpu[:2])
+        n_bytes = os.path.getsize(destination) if os.path.exists(destination) else 0
+    finally:
+        shutil.rmtree(directory)
+    if not n_bytes:
+        log.warning('Codec %s wrote nothing', codec)
+        return None
+    return {'fps': n_frames / max(dt, 1e-6), 'cpu': cpu / n_frames, 'bytes': n_bytes / float(n_frames)}
+
+
+def cache_key(size, fps):
+    return '%dx%d@%g' % (size[0], size[1], fps)
+
+
+def load_cache(path=None):
+    """ Cached results of all machines, by host name, then frame size and rate, then codec. """
+    try:
+        with open(path or cache_path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def store_cache(cache, path=None):
+    """
+    Write to a temporary file next to the cache and rename it over the old
+    one, so an interrupted write never leaves a truncated cache behind.
+    """
+    path = path or cache_path
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    except (IOError, OSError), e:
+        logging.getLogger(__name__).warning('Could not store codec calibration: %s', e)
+        return
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(cache, f, indent=1, sort_keys=True)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # Windows won't rename over an existing file
+            os.remove(path)
+            os.rename(tmp_path, path)
+    except (IOError, OSError), e:
+        logging.getLogger(__name__).warning('Could not store codec calibration: %s', e)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def cached(codecs, size, fps, path=None):
+    """ Results of this machine for the codecs at the frame size and rate, None unless all are cached. """
+    results = load_cache(path).get(socket.gethostname(), {}).get(cache_key(size, fps), {})
+    if any(c not in results for c in codecs):
+        return None
+    return dict((c, results[c]) for c in codecs)
+
+
+def calibrate(codecs, size, fps, duration=2.0, force=False, path=None):
+    """
+    Results of each codec at the frame size and rate, from the cache of
+    this machine where present. Unavailable codecs have None.
+    """
+    log = logging.getLogger(__name__)
+    cache = load_cache(path)
+    results = cache.setdefault(socket.gethostname(), {}).setdefault(cache_key(size, fps), {})
+    missing = [c for c in codecs if force or c not in results]
+    if missing:
+        frames = synthetic_frames(size)
+        for codec in missing:
+            log.info('Calibrating codec %s at %dx%d, %g fps', codec, size[0], size[1], fps)
+            results[codec] = measure(codec, size, fps, duration, frames)
+        # other machines sharing the config directory may have stored their
+        # results meanwhile, only replace those of this one
+        cache = load_cache(path)
+        cache.setdefault(socket.gethostname(), {})[cache_key(size, fps)] = results
+        store_cache(cache, path)
+    return dict((c, results[c]) for c in codecs)
+
+
+def select(results, fps):
+    """ Codec with the smallest frames among those sustaining fps, else the fastest. """
+    available = [(c, r) for c, r in results.items() if r is not None]
+    if not available:
+        return None
+    sustained = [(r['bytes'], r['cpu'], c) for c, r in available if r['fps'] >= fps * MARGIN]
+    if sustained:
+        return min(sustained)[2]
+    return max((r['fps'], c) for c, r in available)[1]
+
+
+def describe(codec, result):
+    if result is None:
+        return '%s: not available' % codec
+    return '%s: %.1f fps, %.2f ms CPU/frame, %.1f kB/frame' % (codec, result['fps'], result['cpu'] * 1000,
+                                                                result['bytes'] / 1024.)
+
+
+#############################################################
+if __name__ == "__main__":
+#############################################################
+    arg_dict = docopt.docopt(__doc__, version=None)
+    logging.basicConfig(level=logging.DEBUG if arg_dict['--DEBUG'] else logging.WARNING)
+    from lib.core import writer
+    codecs = [c.upper() for c in arg_dict['CODECS']] or list(writer.Writer.codecs)
+    size = tuple(int(d) for d in arg_dict['--dims'].split('x'))
+    fps = float(arg_dict['--fps'])
+    results = calibrate(codecs, size, fps, float(arg_dict['--time']), arg_dict['--Force'])
+    print "%s, %dx%d at %g fps" % (socket.gethostname(), size[0], size[1], fps)
+    for c in codecs:
+        print "    " + describe(c, results[c])
+    print "Selected:", select(results, fps)
@@ -30,6 +30,8 @@ To do:
 import sys
 import time
 import logging
+import functools
+import threading
 from random import randint
 
 import lib.utilities as utils
@@ -48,13 +50,161 @@ from lib.core import arduino
 N_TRIES = 2
 
 
+class SerialWorker(threading.Thread):
+    """
+    Owns the serial device once connected. Holds only the latest desired
+    value of each pin, no FIFO, so a slow link never sends old data. Changed
+    pins are sent no faster than the link can carry them, and replies of the
+    board are read in the background.
+    """
+    def __init__(self, device, chatter):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.log = logging.getLogger(__name__)
+        self.device = device
+        # change suppression settings are taken from the chatter
+        self.chatter = chatter
+
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.alive = True
+        self.failed = False
+
+        # latest desired and last sent value per (pin type, pin id), and when
+        # the oldest unsent change of each pin came in
+        self.desired = {}
+        self.sent = {}
+        self.changed_at = {}
+        self.received = ''
+
+        # seconds from a change coming in to it being written
+        self.latency = 0.0
+        self.max_latency = 0.0
+        self.n_coalesced = 0
+
+        # instructions not sent because the pin didn't change (enough), and
+        # when all pins were last refreshed
+        self.n_suppressed = 0
+        self.bytes_suppressed = 0
+        self.refreshed_at = time.time()
+
+    def unchanged(self, key, data):
+        """ True if data is within the deadband of the last sent value. """
+        if key not in self.sent:
+            return False
+        sent = self.sent[key]
+        if key[0] == 1 and data is not None and sent is not None:
+            return abs(data - sent) <= self.chatter.dac_deadband
+        return data == sent
+
+    def set_pins(self, instructions):
+        """ Replace desired values of the pins in [type, id, data] list. """
+        now = time.time()
+        with self.lock:
+            for type_id, pin_id, data in instructions:
+                key = (type_id, pin_id)
+                if key in self.changed_at:
+                    self.n_coalesced += 1
+                elif self.unchanged(key, data):
+                    # keep-alive refresh still sends the exact value
+                    self.desired[key] = data
+                    self.n_suppressed += 1
+                    self.bytes_suppressed += self.device.instruction_size
+                    continue
+                else:
+                    self.changed_at[key] = now
+                self.desired[key] = data
+        self.wake.set()
+
+    def unsend(self, keys):
+        """ Forget the values sent to the pins, and send them again. """
+        now = time.time()
+        with self.lock:
+            for key in keys:
+                self.sent.pop(key, None)
+                if key in self.desired:
+                    self.changed_at.setdefault(key, now)
+        self.wake.set()
+
+    def read_all(self):
+        with self.lock:
+            msg, self.received = self.received, ''
+        return msg
+
+    def stop(self):
+        self.alive = False
+        self.wake.set()
+        self.join(1.0)
+
+    def run(self):
+        baud = getattr(self.device.sp, 'baudrate', 57600) or 57600
+        while self.alive:
+            self.wake.wait(0.05)
+            self.wake.clear()
+
+            with self.lock:
+                keys = self.changed_at.keys()
+                changed_at = [self.changed_at.pop(k) for k in keys]
+                # periodically send all pins, in case the board missed some
+                now = time.time()
+                if self.chatter.keep_alive and now - self.refreshed_at > self.chatter.keep_alive:
+                    self.refreshed_at = now
+                    changed_at.extend(now for k in self.desired if k not in keys)
+                    keys = self.desired.keys()
+                instr = [[k[0], k[1], self.desired[k]] for k in keys]
+
+            try:
+                if instr:
+                    bytes_before = self.device.bytes_sent
+                    if not self.device.send_instructions(instr):
+                        self.failed = True
+                        return
+                    now = time.time()
+                    with self.lock:
+                        for i in instr:
+                            self.sent[(i[0], i[1])] = i[2]
+                    latency = now - min(changed_at)
+                    self.latency = 0.9*self.latency + 0.1*latency
+                    self.max_latency = max(self.max_latency, latency)
+                    # don't outpace the link, 10 bits per byte
+                    time.sleep((self.device.bytes_sent - bytes_before) * 10.0 / baud)
+
+                if self.device.bytes_available():
+                    msg = self.device.read_all_bytes()
+                    with self.lock:
+                        self.received += msg
+
+                # pins of lost frames may not hold the value sent, which
+                # would suppress them until the next keep-alive
+                failed = self.device.take_failed_pins()
+                if failed:
+                    self.unsend(failed)
+            except BaseException, error:
+                self.log.error('Serial worker stopped: %s', error)
+                self.failed = True
+                return
+
+
 class Chatter:
     serial_device = None
     serial_port = None
     label = 'Arduino'
     connected = False
+    worker = None
+
+    # has to match BAUD_RATE of the sketch on the board
+    baud_rate = 57600
 
-    def __init__(self, port, frame_size=(639, 359), max_dac=4095, auto=False):
+    # DAC values changing by no more than this are not sent, and all pins
+    # are refreshed every keep_alive seconds
+    dac_deadband = 4
+    keep_alive = 1.0
+
+    # port of the last successful connection, tried first by auto_connect.
+    # Kept in the SERIAL section of templates
+    last_port = None
+
+    def __init__(self, port, frame_size=(639, 359), max_dac=4095, auto=False, settings=None):
 
         self.log = logging.getLogger(__name__)
 
@@ -68,18 +218,22 @@ class Chatter:
         self.range_dac = (dr, dr)
 
         self.auto = auto
+        # SERIAL section of a template, before the first connection
+        if settings is not None:
+            self.configure(settings)
 
-        if port or auto:
+        if port or self.auto:
             #CHECK ALL AVAILABLE PORTS FOR CONNECTION?
             # --> ON WINDOWS ALL, ON LINUX ONLY IF CANDIDATE!
             self.auto_connect(port)
 
     def auto_connect(self, port=None):
         """
-        Try to connect to specific port. If no port specified, try to connect
-        to all ports on the port_list. If any of them replies correctly, stop
-        and be happy about the connection!
+        Try to connect to specific port. If no port specified, try the port
+        of the last successful connection, then all other ports on the
+        port_list at once. The first of them replying correctly wins.
         """
+        self.close()
         if port:
             if isinstance(port, basestring):
                 port_list = [(port, port)]
@@ -87,23 +241,74 @@ class Chatter:
                 port_list = [port]
         else:
             port_list = utils.get_port_list()
-
-        for p in port_list:
-            try:
-                if self.open_serial(p[1]) and self.test_connection():
-                    self.serial_port = p[1]
-                    self.connected = True
-                    return self.connected
-            except Exception, e:
-                self.log.error(str(e))
-                self.log.error('Port is broken or handshake invalid')
+            if self.last_port:
+                device = self.probe(self.last_port)
+                if device is not None:
+                    return self.use_device(device)
+                port_list = [p for p in port_list if p[1] != self.last_port]
+
+        results = [None] * len(port_list)
+
+        def probe_into(n, p):
+            results[n] = self.probe(p)
+        threads = [threading.Thread(target=probe_into, args=(n, p[1])) for n, p in enumerate(port_list)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+
+        found = [d for d in results if d is not None]
+        for device in found[1:]:
+            device.close()
+        if found:
+            return self.use_device(found[0])
         self.connected = False
         return self.connected
 
+    def configure(self, settings):
+        """
+        Take the settings of the SERIAL section of a template. Returns True
+        if they only take effect with a new connection, as a different baud
+        rate or, while not connected, a different port to try first does.
+        """
+        reconnect = settings['baud_rate'] != self.baud_rate or \
+            (not self.connected and settings['last_port'] != self.last_port)
+        self.auto = settings['auto']
+        self.baud_rate = settings['baud_rate']
+        self.dac_deadband = settings['dac_deadband']
+        self.keep_alive = settings['keep_alive']
+        # a working connection stays the one to remember
+        if not self.connected:
+            self.last_port = settings['last_port']
+        return reconnect
+
+    def probe(self, port):
+        """ Open port and handshake, return the device if it answered. """
+        self.log.info("Probing port %s", port)
+        try:
+            device = arduino.Arduino(port, self.baud_rate)
+            if device.is_open() and self.handshake(device):
+                return device
+            device.close()
+        except Exception, e:
+            self.log.error(str(e))
+            self.log.error('Port %s is broken or handshake invalid', port)
+        return None
+
+    def use_device(self, device):
+        self.serial_device = device
+        self.serial_port = device.port_string
+        self.connected = True
+        self.worker = SerialWorker(self.serial_device, self)
+        self.worker.start()
+        self.last_port = self.serial_port
+        return self.connected
+
     def open_serial(self, port):
         self.close()
         self.log.info("Opening port %s", port)
-        self.serial_device = arduino.Arduino(port)
+        self.serial_device = arduino.Arduino(port, self.baud_rate)
         if self.serial_device.is_open():
             self.serial_port = port
         return self.serial_device.is_open()
@@ -111,7 +316,25 @@ class Chatter:
     def test_connection(self, test_values=None):
         """
         Sends values from list test_values to Arduino and compares response.
-        If no response or response not matching, the test fails.
+        If no response or response not matching, the test fails. The serial
+        worker is paused meanwhile, it would take the replies otherwise.
+        """
+        if self.serial_device is None:
+            return False
+        worker, self.worker = self.worker, None
+        if worker is not None:
+            worker.stop()
+        try:
+            return self.echo(self.serial_device, test_values)
+        finally:
+            if worker is not None and not worker.failed:
+                self.worker = SerialWorker(self.serial_device, self)
+                self.worker.start()
+
+    def echo(self, device, test_values=None, deadline=None):
+        """
+        Send test values until the device echoes them, N_TRIES times or
+        until deadline, whichever takes longer.
         """
         if not test_values:
             test_values = [0, self.range_dac[0], randint(0, 4095)]
@@ -119,40 +342,80 @@ class Chatter:
         for v in test_values:
             instructions.append([0, 0, v])
 
-        for n in xrange(N_TRIES):
-            self.serial_device.send_instructions(instructions)
-            time.sleep(0.1)
-            if self.bytes_available():
-                if test_values == map(int, self.read_all().splitlines()):
-                    if self.serial_device.get_pins():
-                        return True
+        n = 0
+        while n < N_TRIES or (deadline is not None and time.time() < deadline):
+            n += 1
+            device.read_all_bytes()
+            device.send_instructions(instructions)
+            if device.wait_for_lines(len(test_values), 0.25):
+                try:
+                    echo = map(int, device.read_all_bytes().splitlines())
+                except ValueError:
+                    continue
+                if test_values == echo:
+                    return True
         return False
 
-    def update_pins(self, slots):
-        """ instr: [type, instr, data, index]"""
-        if not self.connected:
-            return
+    def handshake(self, device, test_values=None):
+        """
+        Send test values until the device echoes them, for as long as it
+        may take to boot after the port was opened. Then fetch its pins and
+        agree on the protocol.
+        """
+        if self.echo(device, test_values, time.time() + device.boot_timeout) and device.get_pins():
+            # framed protocol if the firmware knows it
+            device.negotiate()
+            return True
+        return False
 
-        instr = []
+    def compile_plan(self, slots):
+        """
+        Flatten slots linked to pins into a list of (slot, pin type, pin id,
+        getter, argument, scaling) evaluated by update_pins each frame.
+        """
+        plan = []
         for slot in slots:
-            if slot.state_idx is None:
-                instr.append([slot.pin.type_id, slot.pin.id, slot.state()])
-            else:
-                data = slot.state(slot.state_idx)
+            scaling = None
+            if slot.state_idx is not None:
                 if slot.type == 'digital':
-                    if data:
-                        data = 100  # pin HIGH if data > 0
-                    else:
-                        data = 0
+                    scaling = self.scale_digital
                 elif slot.type == 'dac':
-                    if data is None:
-                        data = 0
-                    else:
-                        data = self.scale_point(data)[slot.state_idx]
-                instr.append([slot.pin.type_id, slot.pin.id, data])
+                    scaling = functools.partial(self.scale_dac, index=slot.state_idx)
+            plan.append((slot, slot.pin.type_id, slot.pin.id, slot.state, slot.state_idx, scaling))
+        return plan
 
-        if not self.serial_device.send_instructions(instr):
+    def update_pins(self, plan):
+        """
+        instr: [type, instr, data] for each entry of the output plan, handed
+        to the serial worker which sends only changed pins in the background.
+        """
+        if not self.connected:
+            return
+        if self.worker is not None and self.worker.failed:
             self.close()
+            return
+
+        instr = []
+        for slot, type_id, pin_id, getter, arg, scaling in plan:
+            data = getter() if arg is None else getter(arg)
+            if scaling is not None:
+                data = scaling(data)
+            instr.append([type_id, pin_id, data])
+
+        if not instr:
+            return
+        if self.worker is not None:
+            self.worker.set_pins(instr)
+        elif not self.serial_device.send_instructions(instr):
+            self.close()
+
+    @staticmethod
+    def scale_digital(data):
+        # pin HIGH if data > 0
+        return 100 if data else 0
+
+    def scale_dac(self, data, index):
+        return 0 if data is None else self.scale_point(data)[index]
 
     def pins_for_slot(self, slot):
         return self.pins(slot.type)
@@ -171,10 +434,12 @@ class Chatter:
     def read_all(self):
         if not self.serial_device:
             return
+        if self.worker is not None:
+            return self.worker.read_all()
         return self.serial_device.read_all_bytes()
 
     def read_line(self):
-        if not self.serial_device:
+        if not self.serial_device or self.worker is not None:
             return
         return self.serial_device.read_line()
 
@@ -190,6 +455,12 @@ class Chatter:
         else:
             return None
 
+    def bytes_suppressed(self):
+        if self.worker is not None:
+            return self.worker.bytes_suppressed
+        else:
+            return None
+
     def bytes_rx(self):
         if self.serial_device:
             return self.serial_device.bytes_received
@@ -197,11 +468,19 @@ class Chatter:
             return None
 
     def bytes_available(self):
+        if self.worker is not None:
+            return len(self.worker.received)
         if self.serial_device:
             return self.serial_device.bytes_available()
         else:
             return None
 
+    def latency(self):
+        """ Average and maximum seconds from pin change to serial write. """
+        if self.worker is not None:
+            return self.worker.latency, self.worker.max_latency
+        return None
+
     def pins(self, pin_type):
         if self.serial_device:
             try:
@@ -246,6 +525,9 @@ class Chatter:
         """
         self.log.info('Closing chatter')
         self.connected = False
+        if self.worker is not None:
+            self.worker.stop()
+            self.worker = None
         if self.serial_device:
             self.serial_device.close()
 
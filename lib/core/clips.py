@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 10:31:52 2026
+
+Event triggered recording. The last seconds of frames are kept JPEG
+compressed in a ring of bounded size, and a trigger writes them plus the
+frames up to some seconds after it to a numbered clip file. Triggers while
+a clip is open extend it.
+
+Frames from before the trigger come out of the ring, so they went through
+JPEG once and are lossy even in raw clips. Only those after the trigger
+are written as grabbed.
+"""
+
+import os
+import logging
+from collections import deque
+
+import cv2
+
+from lib import utilities as utils
+from lib.core import rawvideo
+
+
+def clip_path(destination, n):
+    base, ext = os.path.splitext(destination)
+    return '%s_clip%04d%s' % (base, n, ext)
+
+
+class ClipRecorder:
+    """
+    Takes frames with their index and timestamp through add().
+    open_writer(path) has to return a RawWriter, which keeps index and
+    timestamp of each frame, or a VideoWriter or anything else with a
+    write(img) method. paired(path) lists the files a clip to path creates,
+    the first of them is claimed for it, as by utils.dst_file_name.
+    """
+    # JPEG quality of frames in the ring
+    quality = 90
+    # upper bound of memory taken by the ring
+    max_bytes = 256 * 2**20
+
+    def __init__(self, destination, pre, post, fps, open_writer, paired=None):
+        self.log = logging.getLogger(__name__)
+        self.destination = destination
+        self.pre = pre
+        self.post = post
+        self.open_writer = open_writer
+        self.paired = paired
+
+        self.ring = deque(maxlen=max(1, int(round(pre * fps)) + 1))
+        self.ring_bytes = 0
+
+        self.writer = None
+        # path of the current or last clip
+        self.path = None
+        self.n_clips = 0
+        self.clip_start = None
+        self.clip_end = None
+        self.clip_frames = 0
+
+    def add(self, img, index, timestamp):
+        if self.writer is not None and timestamp > self.clip_end:
+            self.close_clip()
+        if self.writer is not None and timestamp >= self.clip_start:
+            self.write(img, index, timestamp)
+        self.push(img, index, timestamp)
+
+    def write(self, img, index, timestamp):
+        if isinstance(self.writer, rawvideo.RawWriter):
+            self.writer.write(img, index, timestamp)
+        else:
+            self.writer.write(img)
+        self.clip_frames += 1
+
+    def push(self, img, index, timestamp):
+        """ Compress frame into the ring, dropping the oldest as needed. """
+        rv, jpeg = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        if not rv:
+            return
+        if len(self.ring) == self.ring.maxlen:
+            self.ring_bytes -= len(self.ring[0][2])
+        self.ring.append((index, timestamp, jpeg))
+        self.ring_bytes += len(jpeg)
+        while self.ring_bytes > self.max_bytes and len(self.ring) > 1:
+            self.ring_bytes -= len(self.ring.popleft()[2])
+
+    def trigger(self, timestamp, description=''):
+        """
+        Record from pre seconds before to post seconds after timestamp.
+        Returns the number of the clip, None if it could not be created.
+        """
+        if self.writer is not None:
+            self.clip_end = max(self.clip_end, timestamp + self.post)
+            self.log.info('Clip %d extended by %s', self.n_clips, description)
+            return self.n_clips
+
+        # existing files are never overwritten, taken names get a number
+        try:
+            path = utils.dst_file_name(clip_path(self.destination, self.n_clips + 1), self.paired)
+        except (IOError, OSError), error:
+            self.log.error('Could not create clip file: %s', error)
+            return None
+        self.n_clips += 1
+        self.clip_start = timestamp - self.pre
+        self.clip_end = timestamp + self.post
+        self.clip_frames = 0
+        self.path = path
+        self.writer = self.open_writer(path)
+        for index, ts, jpeg in self.ring:
+            if ts >= self.clip_start:
+                self.write(cv2.imdecode(jpeg, 1), index, ts)
+        self.log.info('Clip %d to %s triggered by %s, %d frames before', self.n_clips, path,
+                      description, self.clip_frames)
+        return self.n_clips
+
+    def close_clip(self):
+        if self.writer is None:
+            return
+        release = getattr(self.writer, 'release', None)
+        if release is not None:
+            release()
+        self.writer = None
+        self.log.info('Clip %d closed with %d frames', self.n_clips, self.clip_frames)
+
+    def close(self):
+        self.close_clip()
+        self.ring.clear()
+        self.ring_bytes = 0
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 17:25:03 2026
+
+Simulated Arduino board on a pseudo terminal, speaking the same protocols as
+the SpotterPhys sketches. Lets the serial output path run without hardware,
+with adjustable pin counts, link speed and corruption of received bytes.
+Needs pty support, i.e. Linux or OS X.
+
+The benchmark compares the legacy, framed and packed encodings.
+
+Usage:
+    emulator.py [options]
+    emulator.py -h | --help
+
+Options:
+    -h --help           Show this screen
+    -n --updates N      Number of pin updates to send [default: 1000]
+    -a --analog N       DAC channels per update [default: 4]
+    -b --baud BAUD      Simulated baud rate [default: 57600]
+    -c --corrupt P      Probability of corrupting a received byte [default: 0]
+    -f --fps FPS        Update rate of the latency test [default: 30]
+    -D --DEBUG          Verbose output
+"""
+
+import os
+import pty
+import tty
+import time
+import random
+import select
+import logging
+import threading
+
+from lib.docopt import docopt
+from lib.core import arduino
+
+
+class BoardEmulator(threading.Thread):
+    """
+    Board answering on the slave end of a pty, available as self.port once
+    instantiated. Output pin states are kept in self.dac and self.digital.
+    """
+    # ms after which an incomplete frame is dropped, as in the sketch
+    frame_timeout = 0.05
+
+    def __init__(self, n_dac=2, n_digital=4, n_din=2, baud_rate=57600, corruption=0.0,
+                 boot_delay=0.0, protocol=arduino.PROTOCOL_PACKED):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.log = logging.getLogger(__name__)
+
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+
+        self.n_din = n_din
+        self.dac = [0] * n_dac
+        self.digital = [0] * n_digital
+
+        self.baud_rate = baud_rate
+        self.corruption = corruption
+        self.boot_delay = boot_delay
+        # highest protocol the firmware knows
+        self.max_protocol = protocol
+
+        self.protocol = arduino.PROTOCOL_LEGACY
+        self.buffer = bytearray()
+        self.frame_start = None
+        self.alive = True
+        self.started_at = None
+
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.n_commands = 0
+        self.n_frames = 0
+        self.n_crc_errors = 0
+        self.n_corrupted = 0
+
+    def run(self):
+        self.started_at = time.time()
+        while self.alive:
+            readable = select.select([self.master], [], [], 0.05)[0]
+            if not readable:
+                continue
+            try:
+                # small reads, a board handles bytes as they come in
+                data = bytearray(os.read(self.master, 16))
+            except OSError:
+                break
+            # bootloader doesn't listen yet
+            if time.time() - self.started_at < self.boot_delay:
+                continue
+
+            self.bytes_received += len(data)
+            if self.corruption:
+                for i in xrange(len(data)):
+                    if random.random() < self.corruption:
+                        data[i] ^= 1 << random.randint(0, 7)
+                        self.n_corrupted += 1
+            # bytes can't arrive faster than the link carries them
+            time.sleep(len(data) * 10.0 / self.baud_rate)
+
+            self.buffer.extend(data)
+            if self.protocol >= arduino.PROTOCOL_FRAMED:
+                self.parse_frames()
+            else:
+                self.parse_legacy()
+
+    def stop(self):
+        self.alive = False
+        self.join(1.0)
+        for fd in (self.master, self.slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def write(self, msg):
+        self.bytes_sent += len(msg)
+        os.write(self.master, str(msg))
+
+    def parse_legacy(self):
+        """ Command byte, two data bytes, newline. """
+        while len(self.buffer) >= 4 and self.protocol == arduino.PROTOCOL_LEGACY:
+            cmd, lsb, msb, eol = self.buffer[0:4]
+            del self.buffer[:4]
+            if eol == ord('\n'):
+                self.execute(cmd, lsb, msb)
+        if self.protocol >= arduino.PROTOCOL_FRAMED:
+            self.parse_frames()
+
+    def parse_frames(self):
+        """
+        SYNC, sequence, count, 3 bytes per instruction, CRC8. Packed DAC
+        frames start with SYNC_DAC and carry 12 bit values instead.
+        """
+        if self.frame_start is not None and time.time() - self.frame_start > self.frame_timeout:
+            # drop the incomplete frame, resynchronize after its SYNC
+            del self.buffer[:1]
+            self.frame_start = None
+        syncs = [arduino.SYNC]
+        if self.protocol == arduino.PROTOCOL_PACKED:
+            syncs.append(arduino.SYNC_DAC)
+        while self.protocol >= arduino.PROTOCOL_FRAMED:
+            starts = [i for i in (self.buffer.find(chr(sync)) for sync in syncs) if i >= 0]
+            if not starts:
+                del self.buffer[:]
+                return
+            del self.buffer[:min(starts)]
+            packed = self.buffer[0] == arduino.SYNC_DAC
+            if len(self.buffer) >= 3:
+                n = self.buffer[2]
+                end = 3 + ((3*n + 1) // 2 if packed else 3*n)
+            if len(self.buffer) < 3 or len(self.buffer) < end + 1:
+                self.frame_start = self.frame_start or time.time()
+                return
+            self.frame_start = None
+
+            seq = self.buffer[1]
+            if arduino.crc8(self.buffer, 1, end) == self.buffer[end]:
+                self.n_frames += 1
+                frame = self.buffer[3:end]
+                del self.buffer[:end+1]
+                if packed:
+                    self.set_packed(frame, n)
+                else:
+                    for k in xrange(n):
+                        self.execute(*frame[3*k:3*k+3])
+                self.write(bytearray([arduino.SYNC, seq, arduino.ACK]))
+            else:
+                self.n_crc_errors += 1
+                # the sketch drops the frame, resynchronizing on the next SYNC
+                del self.buffer[:end+1]
+                self.write(bytearray([arduino.SYNC, seq, arduino.NAK]))
+
+    def set_packed(self, payload, n):
+        """ DAC channels 0..n-1, two 12 bit values in three bytes. """
+        for k in xrange(n):
+            pos = 3 * (k // 2)
+            if k % 2 == 0:
+                value = payload[pos] | ((payload[pos+1] & 0x0F) << 8)
+            else:
+                value = (payload[pos+1] >> 4) | (payload[pos+2] << 4)
+            self.n_commands += 1
+            if k < len(self.dac):
+                self.dac[k] = value
+
+    def execute(self, cmd, lsb, msb):
+        self.n_commands += 1
+        data = min((msb << 8) + lsb, 4095)
+        address = cmd & 0x07
+        cmd_type = (cmd & 0x38) >> 3
+        if cmd_type == 0:
+            self.report(address, data)
+        elif cmd_type == 1 and address < len(self.dac):
+            self.dac[address] = data
+        elif cmd_type == 2 and address < len(self.digital):
+            self.digital[address] = 1 if data > 0 else 0
+
+    def report(self, request, data):
+        if request == 0:
+            self.write('%d\r\n' % data)
+        elif request == 1:
+            self.write('%d\r\n' % len(self.dac))
+        elif request == 2:
+            self.write('%d\r\n' % len(self.digital))
+        elif request == 3:
+            self.write('%d\r\n' % self.n_din)
+        elif request == arduino.REPORT_PROTOCOL:
+            if arduino.PROTOCOL_LEGACY <= data <= self.max_protocol:
+                self.write('%d\r\n' % data)
+                self.protocol = data
+
+
+def benchmark(n_updates, n_dac, baud_rate, corruption, fps, protocol):
+    """
+    Raw throughput of direct writes, then latency of the serial worker at
+    the given update rate, with the board knowing up to the given protocol.
+    """
+    from lib.core import chatter
+
+    board = BoardEmulator(n_dac=n_dac, baud_rate=baud_rate, corruption=corruption,
+                          protocol=protocol)
+    board.start()
+    link = chatter.Chatter(None)
+    link.baud_rate = baud_rate
+    if not link.auto_connect(board.port):
+        print "Handshake with emulated board failed"
+        board.stop()
+        return
+    device = link.serial_device
+    worker, link.worker = link.worker, None
+    worker.stop()
+
+    def update(i):
+        return [[1, a, (i*(a+1)*37) % 4096] for a in xrange(n_dac)] + [[2, 0, (i // 10) % 2]]
+
+    print "Protocol:", device.protocol_name, "at", baud_rate, "baud,", n_dac, "DAC channels"
+    bytes_before = device.bytes_sent
+    received_before = board.bytes_received
+    t = time.time()
+    for i in xrange(n_updates):
+        device.send_instructions(update(i))
+        device.poll()
+    # until all frames are acknowledged, or all legacy bytes arrived
+    n_sent = device.bytes_sent - bytes_before
+    while (device.pending if device.framed else board.bytes_received - received_before < n_sent) \
+            and time.time() - t < 60:
+        device.wait_readable(0.01)
+        device.poll()
+    dt = time.time() - t
+    print "    %d updates, %d bytes in %.2f s: %.0f updates/s, %.1f bytes/update" % (
+        n_updates, device.bytes_sent - bytes_before, dt, n_updates / dt,
+        (device.bytes_sent - bytes_before) / float(n_updates))
+    if device.framed:
+        print "    Frames %d, NAK %d, timeouts %d, retries %d, lost %d, corrupted bytes %d" % (
+            device.n_frames, device.n_nak, device.n_timeouts, device.n_retries, device.n_lost,
+            board.n_corrupted)
+
+    link.worker = chatter.SerialWorker(device, link)
+    link.worker.start()
+    t = time.time()
+    for i in xrange(int(2 * fps)):
+        link.worker.set_pins(update(i))
+        time.sleep(max(0, t + (i+1) / float(fps) - time.time()))
+    latency, max_latency = link.latency()
+    print "    Worker at %d fps: latency %.2f ms, max %.2f ms" % (fps, latency*1000, max_latency*1000)
+
+    link.close()
+    board.stop()
+
+
+#############################################################
+if __name__ == "__main__":
+#############################################################
+    arg_dict = docopt.docopt(__doc__, version=None)
+    logging.basicConfig(level=logging.DEBUG if arg_dict['--DEBUG'] else logging.WARNING)
+    for p in (arduino.PROTOCOL_LEGACY, arduino.PROTOCOL_FRAMED, arduino.PROTOCOL_PACKED):
+        benchmark(int(arg_dict['--updates']), int(arg_dict['--analog']), int(arg_dict['--baud']),
+                  float(arg_dict['--corrupt']), float(arg_dict['--fps']), p)
@@ -29,6 +29,7 @@ import struct
 import numpy as np
 from collections import deque
 from lib.docopt import docopt
+from lib.core import segments, rawvideo
 import zmq
 
 DEBUG = True
@@ -41,6 +42,8 @@ class Frame:
     def __init__(self, index, img, source_type, timestamp=None):
         self.index = index
         self.img = img
+        # full resolution image, if img got scaled down for tracking
+        self.full = None
         self.source_type = source_type
         if timestamp is None:
             self.timestamp = time.time()
@@ -128,7 +131,13 @@ class Grabber:
             # Creating capture handle object
             self.log.debug('Attempting to open %s "%s" as capture... ', self.source_type, source)
             try:
-                self.capture = cv2.VideoCapture(source)
+                # segmented and raw recordings are opened by their index
+                if self.source_type == 'file' and source.endswith(segments.INDEX_EXTENSION):
+                    self.capture = segments.SegmentCapture(source)
+                elif self.source_type == 'file' and source.endswith(rawvideo.INDEX_EXTENSION):
+                    self.capture = rawvideo.RawCapture(source)
+                else:
+                    self.capture = cv2.VideoCapture(source)
             except Exception as error:
                 self.log.exception(error)
                 self.capture = None
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 11:02:45 2026
+
+Remote monitoring. A background thread publishes downscaled JPEG thumbnails
+of the tracked frames with the latest tracking state over a ZMQ PUB socket,
+at a rate well below the frame rate. Encoding and sending happen in that
+thread, the tracking loop only hands over a reference to the newest frame.
+
+Each message has three parts: topic (the rig name), tracking state as JSON
+and the JPEG image. Running the module subscribes to a publisher and shows
+what it receives.
+
+Usage:
+    monitor.py [options]
+    monitor.py -h | --help
+
+Options:
+    -h --help           Show this screen
+    -a --address ADDR   Publisher to connect to [default: tcp://localhost:5556]
+    -t --topic TOPIC    Only messages of this rig name [default: ]
+    -n --count N        Stop after N messages, 0 to run until Escape [default: 0]
+    -H --Headless       Print states only, no thumbnail window
+"""
+
+import sys
+import json
+import time
+import socket
+import logging
+import threading
+
+import cv2
+import numpy as np
+
+from lib.docopt import docopt
+
+try:
+    import zmq
+except ImportError:
+    zmq = None
+
+
+class ThumbnailPublisher(threading.Thread):
+    """
+    Publishes thumbnails of the frames given to publish(), at most rate per
+    second. Frames arriving in between replace the waiting one.
+    """
+    # width of thumbnails in pixels, height keeps the aspect ratio
+    width = 320
+    quality = 70
+    # messages queued per subscriber before new ones are dropped
+    high_water_mark = 2
+
+    def __init__(self, address='tcp://*:5556', rate=2.0, topic=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.log = logging.getLogger(__name__)
+        if zmq is None:
+            raise ImportError('Publishing thumbnails needs pyzmq')
+
+        self.address = address
+        self.interval = 1.0 / rate
+        self.topic = topic or socket.gethostname()
+
+        self.context = zmq.Context.instance()
+        self.socket = self.context.socket(zmq.PUB)
+        self.socket.setsockopt(zmq.SNDHWM, self.high_water_mark)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        try:
+            self.socket.bind(address)
+        except zmq.ZMQError, error:
+            self.socket.close()
+            raise IOError('Could not bind %s: %s' % (address, error))
+
+        self.latest = None
+        self.ts_due = 0.0
+        self.wake = threading.Event()
+        self.alive = True
+        self.n_published = 0
+        self.log.info('Publishing thumbnails as %s on %s at %.1f Hz', self.topic, address, rate)
+
+    def due(self):
+        """ True if publish() would be taken up, to skip gathering state otherwise. """
+        return time.time() >= self.ts_due
+
+    def publish(self, img, state):
+        """ Hand over the newest frame, which must not be changed afterwards. """
+        self.ts_due = time.time() + self.interval
+        self.latest = (img, state)
+        self.wake.set()
+
+    def run(self):
+        while self.alive:
+            self.wake.wait(1.0)
+            self.wake.clear()
+            latest, self.latest = self.latest, None
+            if latest is None:
+                continue
+            img, state = latest
+            try:
+                self.send(img, state)
+            except (zmq.ZMQError, ValueError, TypeError), error:
+                self.log.error('Publishing thumbnail failed: %s', error)
+        self.socket.close()
+
+    def send(self, img, state):
+        scale = min(1.0, float(self.width) / img.shape[1])
+        if scale < 1.0:
+            img = cv2.resize(img, (0, 0), fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        rv, jpeg = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        if not rv:
+            return
+        # PUB drops the message if the subscribers are behind, never blocks
+        self.socket.send_multipart([self.topic, json.dumps(state), jpeg.tostring()], zmq.NOBLOCK)
+        self.n_published += 1
+
+    def stop(self):
+        self.alive = False
+        self.wake.set()
+        self.join(1.0)
+
+
+def subscribe(address, topic='', count=0, show=True):
+    """ Test client, prints the states and shows the thumbnails received. """
+    context = zmq.Context.instance()
+    sub = context.socket(zmq.SUB)
+    sub.setsockopt(zmq.SUBSCRIBE, topic)
+    sub.connect(address)
+    print "Subscribed to", address, "topic", repr(topic)
+
+    n = 0
+    ts_last = None
+    try:
+        while not count or n < count:
+            if not sub.poll(1000):
+                continue
+            rig, state, jpeg = sub.recv_multipart()
+            state = json.loads(state)
+            img = cv2.imdecode(np.fromstring(jpeg, np.uint8), 1)
+            n += 1
+            now = time.time()
+            rate = 1.0 / (now - ts_last) if ts_last is not None and now > ts_last else 0.0
+            ts_last = now
+            print "%s frame %s, %dx%d, %d bytes, %.1f Hz: %s" % (rig, state.get('index'), img.shape[1],
+                                                                img.shape[0], len(jpeg), rate, state)
+            if show:
+                cv2.imshow(rig, img)
+                if cv2.waitKey(1) % 0x100 == 27:
+                    break
+    finally:
+        sub.close()
+        if show:
+            cv2.destroyAllWindows()
+    return n
+
+
+#############################################################
+if __name__ == "__main__":
+#############################################################
+    arg_dict = docopt.docopt(__doc__, version=None)
+    if zmq is None:
+        print "Needs pyzmq"
+        sys.exit(1)
+    subscribe(arg_dict['--address'], arg_dict['--topic'] or '', int(arg_dict['--count']),
+              not arg_dict['--Headless'])
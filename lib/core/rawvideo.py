@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 09:58:32 2026
+
+Uncompressed recording for short high frame rate sessions. Frames are stored
+as fixed size records in chunk files sized for chunk_length frames,
+each record a header with frame index, timestamp and shape followed by the
+image. A text index next to the chunks lists them in order. RawCapture reads
+the chunks as numpy memory maps, giving instant random access to any frame.
+
+Usage:
+    rawvideo.py transcode INDEX DST [--codec CODEC]
+    rawvideo.py -h | --help
+
+Options:
+    -h --help           Show this screen
+    -c --codec CODEC    FOURCC letter code of the transcoded video [default: XVID]
+"""
+
+import os
+import logging
+
+import cv2
+import numpy as np
+
+from lib.docopt import docopt
+
+CODEC = 'RAW'
+INDEX_HEADER = '# spotter raw'
+INDEX_EXTENSION = '.ridx'
+CHUNK_EXTENSION = '.raw'
+
+# record header, padded so that images start 32 byte aligned
+HEADER_DTYPE = [('index', '<u8'), ('timestamp', '<f8'), ('height', '<u2'), ('width', '<u2'),
+                ('channels', '<u2'), ('pad', 'u1', 10)]
+
+
+def record_dtype(shape):
+    """ Record of a frame of the given (height, width, channels) shape. """
+    return np.dtype(HEADER_DTYPE + [('img', 'u1', tuple(shape))])
+
+
+def index_path(destination):
+    """ Index file belonging to a raw recording. """
+    return os.path.splitext(destination)[0] + INDEX_EXTENSION
+
+
+def chunk_path(destination, n):
+    return '%s_%04d%s' % (os.path.splitext(destination)[0], n, CHUNK_EXTENSION)
+
+
+def read_index(path):
+    """
+    Returns fps, frame shape and a list of (file, first frame, number of
+    frames) of the chunks in the index, relative to its directory.
+    """
+    directory = os.path.dirname(path)
+    with open(path) as f:
+        header = f.readline().rstrip('\n').split('\t')
+        if header[0] != INDEX_HEADER:
+            raise IOError('%s is not a raw recording index' % path)
+        fps, shape = float(header[1]), tuple(int(d) for d in header[2:5])
+        chunks = []
+        for line in f:
+            if not line.strip() or line.startswith('#'):
+                continue
+            name, first, n = line.rstrip('\n').split('\t')
+            chunks.append((os.path.join(directory, name), int(first), int(n)))
+    return fps, shape, chunks
+
+
+class RawWriter:
+    """
+    Stands in for cv2.VideoWriter. Frames are collected in a record buffer
+    and written batch_size at a time, in one sequential write each.
+    """
+    chunk_length = 1000
+    batch_size = 16
+
+    def __init__(self, destination, fps, size, channels=3):
+        self.log = logging.getLogger(__name__)
+        self.destination = destination
+        self.fps = fps
+        self.shape = (size[1], size[0], channels)
+        self.dtype = record_dtype(self.shape)
+        self.buffer = np.zeros(self.batch_size, self.dtype)
+        self.buffer['height'], self.buffer['width'], self.buffer['channels'] = self.shape
+        self.n_buffered = 0
+
+        self.index = open(index_path(destination), 'w')
+        self.index.write('%s\t%s\t%d\t%d\t%d\n' % ((INDEX_HEADER, repr(float(fps))) + self.shape))
+        self.index.flush()
+
+        self.chunk = None
+        self.n_chunk = -1
+        self.n_frames = 0
+        self.chunk_first = 0
+        self.log.info('Recording raw %dx%dx%d frames, %d bytes each, to %s', self.shape[1], self.shape[0],
+                      self.shape[2], self.dtype.itemsize, destination)
+
+    def isOpened(self):
+        return not self.index.closed
+
+    def write(self, img, index=None, timestamp=None):
+        record = self.buffer[self.n_buffered]
+        record['index'] = self.n_frames if index is None else index
+        record['timestamp'] = timestamp or 0.0
+        record['img'] = img
+        self.n_buffered += 1
+        self.n_frames += 1
+        if self.n_buffered == self.batch_size or self.n_frames - self.chunk_first == self.chunk_length:
+            self.flush()
+
+    def flush(self):
+        """ Write buffered records to the current chunk, starting a new one when full. """
+        if not self.n_buffered:
+            return
+        if self.chunk is None:
+            self.next_chunk()
+        self.buffer[:self.n_buffered].tofile(self.chunk)
+        self.n_buffered = 0
+        if self.n_frames - self.chunk_first >= self.chunk_length:
+            self.close_chunk()
+
+    def next_chunk(self):
+        self.n_chunk += 1
+        self.chunk_first = self.n_frames - self.n_buffered
+        self.chunk = open(chunk_path(self.destination, self.n_chunk), 'wb')
+        size = self.chunk_length * self.dtype.itemsize
+        if hasattr(os, 'posix_fallocate'):
+            # reserve the blocks of the whole chunk up front, so the file
+            # system can keep it contiguous
+            os.posix_fallocate(self.chunk.fileno(), 0, size)
+        else:
+            # only sets the size, the file stays sparse until written
+            self.chunk.truncate(size)
+
+    def close_chunk(self):
+        """ Cut the chunk to the frames it got and list it in the index. """
+        if self.chunk is None:
+            return
+        n = self.n_frames - self.n_buffered - self.chunk_first
+        self.chunk.truncate(n * self.dtype.itemsize)
+        self.chunk.close()
+        self.chunk = None
+        self.index.write('%s\t%d\t%d\n' % (os.path.basename(chunk_path(self.destination, self.n_chunk)),
+                                           self.chunk_first, n))
+        self.index.flush()
+
+    def release(self):
+        if self.index.closed:
+            return
+        self.flush()
+        self.close_chunk()
+        self.index.close()
+        self.log.info('Recorded %d raw frames in %d chunks', self.n_frames, self.n_chunk + 1)
+
+
+class RawCapture:
+    """
+    Reads a raw recording like a cv2.VideoCapture, for the properties the
+    Grabber asks for. Any frame can be had with frame(n).
+    """
+    def __init__(self, path):
+        self.log = logging.getLogger(__name__)
+        self.fps, self.shape, chunks = read_index(path)
+        dtype = record_dtype(self.shape)
+        self.chunks = [(np.memmap(name, dtype=dtype, mode='r', shape=(n,)), first)
+                       for name, first, n in chunks if n]
+        self.n_frames = sum(len(records) for records, first in self.chunks)
+        self.position = 0
+
+    def isOpened(self):
+        return self.n_frames > 0
+
+    def record(self, n):
+        """ Header and image of the n-th frame, without copying. """
+        for records, first in self.chunks:
+            if first <= n < first + len(records):
+                return records[n - first]
+        raise IndexError('Frame %d not in recording of %d frames' % (n, self.n_frames))
+
+    def frame(self, n):
+        return self.record(n)['img']
+
+    def timestamps(self):
+        return np.concatenate([records['timestamp'] for records, first in self.chunks])
+
+    def read(self):
+        if self.position >= self.n_frames:
+            return False, None
+        # copy, frames are drawn on
+        img = np.array(self.frame(self.position))
+        self.position += 1
+        return True, img
+
+    def get(self, prop):
+        """ Position, frame width, height, fps and frame count of the recording. """
+        if prop == 1:
+            return float(self.position)
+        if prop == 3:
+            return float(self.shape[1])
+        if prop == 4:
+            return float(self.shape[0])
+        if prop == 5:
+            return self.fps
+        if prop == 7:
+            return float(self.n_frames)
+        return 0.0
+
+    def set(self, prop, value):
+        if prop == 1:
+            self.position = min(max(int(value), 0), self.n_frames)
+            return True
+        return False
+
+    def release(self):
+        self.chunks = []
+        self.n_frames = 0
+
+
+def transcode(src, dst, codec='XVID'):
+    """ Write raw recording given by its index to a compressed video file. """
+    log = logging.getLogger(__name__)
+    capture = RawCapture(src)
+    cc = list(codec)
+    writer = cv2.VideoWriter(filename=dst, fourcc=cv2.cv.CV_FOURCC(cc[0], cc[1], cc[2], cc[3]),
+                             fps=capture.fps, frameSize=(capture.shape[1], capture.shape[0]), isColor=True)
+    for n in xrange(capture.n_frames):
+        writer.write(capture.frame(n))
+    del writer
+    log.info('Transcoded %d frames of %s to %s', capture.n_frames, src, dst)
+    return capture.n_frames
+
+
+#############################################################
+if __name__ == "__main__":
+#############################################################
+    arg_dict = docopt.docopt(__doc__, version=None)
+    logging.basicConfig(level=logging.INFO)
+    if arg_dict['transcode']:
+        transcode(arg_dict['INDEX'], arg_dict['DST'], arg_dict['--codec'].upper())
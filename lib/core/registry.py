@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 14:02:11 2026
+
+Links slots of objects and regions to pins of the serial device. Links only
+change when the user edits them, so the flat list of outputs handed to the
+chatter each frame is only recompiled when slots, pins or preferences change.
+"""
+
+import logging
+
+from lib.core import trackables as trkbl
+
+
+class SlotRegistry:
+    """
+    Caches the output plan of all slots linked to pins. The plan is
+    recompiled when the slot generation counter or the serial device
+    changed since the last compilation.
+    """
+    def __init__(self, tracker, chatter):
+        self.log = logging.getLogger(__name__)
+        self.tracker = tracker
+        self.chatter = chatter
+
+        self.key = None
+        self.output_plan = []
+
+    @property
+    def current_key(self):
+        return trkbl.Slot.generation, id(self.chatter.serial_device), self.chatter.connected
+
+    def plan(self):
+        """ Output plan for this frame, recompiled only if links changed. """
+        if self.key != self.current_key:
+            self.compile()
+            # compilation attaches preferred pins, changing the generation
+            self.key = self.current_key
+        return self.output_plan
+
+    def compile(self):
+        """ Attach preferred pins to slots and flatten linked slots. """
+        slots = []
+        for o in self.tracker.oois:
+            o.update_slots(self.chatter)
+            slots.extend(o.linked_slots)
+        for r in self.tracker.rois:
+            r.update_state()
+            r.update_slots(self.chatter)
+            slots.extend(r.linked_slots)
+
+        self.output_plan = self.chatter.compile_plan(slots)
+        self.log.debug('Compiled output plan of %d slots', len(self.output_plan))
@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 09:41:17 2026
+
+Recording split into time segments, each encoded by one of a pool of encoder
+processes, so that encoding is spread over several cores. A text index next
+to the segment files lists them in order, and SegmentCapture plays them back
+as one video, e.g. as file source of the Grabber.
+
+Running the module measures encoding throughput for increasing numbers of
+encoder processes, against a single VideoWriter. On a single core Xeon
+(1280x720 XVID, 600 frames, 60 frame segments):
+
+    VideoWriter    64.2 fps
+    1 encoder      43.0 fps, 0.67x
+    2 encoders     42.4 fps, 0.66x
+    4 encoders     44.1 fps, 0.69x
+
+i.e. handing frames to encoder processes costs about a third of the
+throughput. Segmented recording only pays off with at least two free
+cores, how it scales with more cores is still to be measured.
+
+Usage:
+    segments.py [options]
+    segments.py -h | --help
+
+Options:
+    -h --help           Show this screen
+    -n --frames N       Number of frames to encode [default: 600]
+    -d --dims DIMS      Frame size [default: 1280x720]
+    -c --codec CODEC    FOURCC letter code [default: XVID]
+    -l --length N       Frames per segment [default: 60]
+    -p --processes N    Largest number of encoder processes, all cores if not given
+    -D --DEBUG          Verbose debug output
+"""
+
+import os
+import time
+import shutil
+import logging
+import tempfile
+import multiprocessing
+
+import cv2
+import numpy as np
+
+from lib.docopt import docopt
+
+INDEX_HEADER = '# spotter segments'
+INDEX_EXTENSION = '.idx'
+
+
+def index_path(destination):
+    """ Index file belonging to a segmented recording. """
+    return os.path.splitext(destination)[0] + INDEX_EXTENSION
+
+
+def segment_path(destination, n):
+    base, ext = os.path.splitext(destination)
+    return '%s_%04d%s' % (base, n, ext)
+
+
+def read_index(path):
+    """
+    Returns fps, size, codec and a list of (file, first frame, number of
+    frames) of the segments in the index. File paths are relative to the
+    directory of the index.
+    """
+    directory = os.path.dirname(path)
+    with open(path) as f:
+        header = f.readline().rstrip('\n').split('\t')
+        if header[0] != INDEX_HEADER:
+            raise IOError('%s is not a segment index' % path)
+        fps, width, height, codec = float(header[1]), int(header[2]), int(header[3]), header[4]
+        segments = []
+        for line in f:
+            if not line.strip() or line.startswith('#'):
+                continue
+            name, first, n = line.rstrip('\n').split('\t')
+            segments.append((os.path.join(directory, name), int(first), int(n)))
+    return fps, (width, height), codec, segments
+
+
+def encode(jobs, done, fps, size, codec):
+    """
+    Encoder process. Takes a segment path, then the images of that segment,
+    then False to close it. None ends the process.
+    """
+    log = logging.getLogger(__name__)
+    cc = list(codec)
+    writer = None
+    path = None
+    n = 0
+    t_encoding = 0.0
+    while True:
+        item = jobs.get()
+        if isinstance(item, basestring):
+            path = item
+            writer = cv2.VideoWriter(filename=path, fourcc=cv2.cv.CV_FOURCC(cc[0], cc[1], cc[2], cc[3]),
+                                     fps=fps, frameSize=size, isColor=True)
+            n = 0
+            t_encoding = 0.0
+        elif item is None or item is False:
+            if writer is not None:
+                del writer
+                writer = None
+                done.put((path, n, t_encoding))
+            if item is None:
+                return
+        elif writer is not None:
+            t = time.time()
+            writer.write(item)
+            t_encoding += time.time() - t
+            n += 1
+        else:
+            log.error('Image without open segment')
+
+
+class SegmentedWriter:
+    """
+    Stands in for cv2.VideoWriter. Segment k of segment_length frames goes
+    to encoder k modulo the number of encoders, which encodes it while the
+    following segments go to the others. Each encoder buffers up to two
+    segments, after that write blocks until it catches up.
+    """
+    def __init__(self, destination, fps, size, codec, n_encoders=None, segment_length=300):
+        self.log = logging.getLogger(__name__)
+        self.destination = destination
+        self.fps = fps
+        self.size = size
+        self.codec = codec
+        self.segment_length = segment_length
+        n_encoders = n_encoders or multiprocessing.cpu_count()
+
+        self.done = multiprocessing.Queue()
+        self.jobs = []
+        self.encoders = []
+        for n in xrange(n_encoders):
+            jobs = multiprocessing.Queue(2 * segment_length)
+            encoder = multiprocessing.Process(target=encode, args=(jobs, self.done, fps, size, codec))
+            encoder.daemon = True
+            encoder.start()
+            self.jobs.append(jobs)
+            self.encoders.append(encoder)
+
+        self.index_path = index_path(destination)
+        self.index = open(self.index_path, 'w')
+        self.index.write('%s\t%s\t%d\t%d\t%s\n' % (INDEX_HEADER, repr(float(fps)), size[0], size[1], codec))
+        self.index.flush()
+
+        self.n_segment = -1
+        self.n_frames = 0
+        self.segment_first = 0
+        self.segment_name = None
+        self.log.info('Encoding %s in segments of %d frames with %d processes', destination,
+                      segment_length, n_encoders)
+
+    @property
+    def current_jobs(self):
+        return self.jobs[self.n_segment % len(self.jobs)]
+
+    def isOpened(self):
+        return not self.index.closed
+
+    def write(self, img):
+        if self.n_segment < 0 or self.n_frames - self.segment_first >= self.segment_length:
+            self.next_segment()
+        self.current_jobs.put(img)
+        self.n_frames += 1
+
+    def next_segment(self):
+        self.close_segment()
+        self.n_segment += 1
+        self.segment_first = self.n_frames
+        path = segment_path(self.destination, self.n_segment)
+        self.segment_name = os.path.basename(path)
+        self.current_jobs.put(path)
+
+    def close_segment(self):
+        """ Hand the segment to its encoder for closing and list it in the index. """
+        if self.n_segment < 0:
+            return
+        self.current_jobs.put(False)
+        self.index.write('%s\t%d\t%d\n' % (self.segment_name, self.segment_first,
+                                           self.n_frames - self.segment_first))
+        self.index.flush()
+
+    def release(self):
+        """ Wait for all encoders to finish and log the encoding time. """
+        if self.index.closed:
+            return
+        self.close_segment()
+        self.index.close()
+        for jobs in self.jobs:
+            jobs.put(None)
+        for encoder in self.encoders:
+            encoder.join()
+
+        t_encoding = 0.0
+        while not self.done.empty():
+            path, n, t = self.done.get()
+            t_encoding += t
+        self.log.info('Encoded %d frames in %d segments, %.2f ms per frame', self.n_frames,
+                      self.n_segment + 1, t_encoding / max(self.n_frames, 1) * 1000)
+
+
+class SegmentCapture:
+    """
+    Plays back the segments listed in an index like one cv2.VideoCapture,
+    for the properties the Grabber asks for.
+    """
+    def __init__(self, path):
+        self.log = logging.getLogger(__name__)
+        self.fps, self.size, self.codec, self.segments = read_index(path)
+        self.n_frames = sum(s[2] for s in self.segments)
+        self.n_segment = -1
+        self.capture = None
+
+    def isOpened(self):
+        return len(self.segments) > 0
+
+    def read(self):
+        while True:
+            if self.capture is not None:
+                rv, img = self.capture.read()
+                if rv:
+                    return rv, img
+                self.capture.release()
+                self.capture = None
+            self.n_segment += 1
+            if self.n_segment >= len(self.segments):
+                return False, None
+            self.log.debug('Opening segment %s', self.segments[self.n_segment][0])
+            self.capture = cv2.VideoCapture(self.segments[self.n_segment][0])
+
+    def get(self, prop):
+        """ Frame width, height, fps, fourcc and frame count of the recording. """
+        if prop == 3:
+            return float(self.size[0])
+        if prop == 4:
+            return float(self.size[1])
+        if prop == 5:
+            return self.fps
+        if prop == 7:
+            return float(self.n_frames)
+        return self.capture.get(prop) if self.capture is not None else 0.0
+
+    def release(self):
+        if self.capture is not None:
+            self.capture.release()
+            self.capture = None
+
+
+def benchmark(n_frames, size, codec, segment_length, max_processes):
+    """ Encoding throughput of a single VideoWriter and of 1..max_processes encoders. """
+    # frames with some motion and noise, so that the codec has work to do
+    x = np.linspace(0, 255, size[0]).astype(np.uint8)
+    base = np.dstack([np.tile(x, (size[1], 1))] * 3)
+    noise = np.random.randint(0, 32, (16, size[1], size[0], 3)).astype(np.uint8)
+    frames = [np.roll(base, 8 * i, axis=1) + noise[i % len(noise)] for i in xrange(32)]
+
+    directory = tempfile.mkdtemp()
+    try:
+        destination = os.path.join(directory, 'single.avi')
+        cc = list(codec)
+        writer = cv2.VideoWriter(filename=destination, fourcc=cv2.cv.CV_FOURCC(cc[0], cc[1], cc[2], cc[3]),
+                                 fps=30.0, frameSize=size, isColor=True)
+        t = time.time()
+        for i in xrange(n_frames):
+            writer.write(frames[i % len(frames)])
+        del writer
+        single = n_frames / (time.time() - t)
+        print "%dx%d %s, %d frames" % (size[0], size[1], codec, n_frames)
+        print "    VideoWriter: %.1f fps" % single
+
+        for n in [k for k in (1, 2, 4, 8, 16, 32) if k < max_processes] + [max_processes]:
+            destination = os.path.join(directory, 'segmented_%d.avi' % n)
+            writer = SegmentedWriter(destination, 30.0, size, codec, n, segment_length)
+            t = time.time()
+            for i in xrange(n_frames):
+                writer.write(frames[i % len(frames)])
+            writer.release()
+            fps = n_frames / (time.time() - t)
+            print "    %d encoders: %.1f fps, %.2fx" % (n, fps, fps / single)
+    finally:
+        shutil.rmtree(directory)
+
+
+#############################################################
+if __name__ == "__main__":
+#############################################################
+    arg_dict = docopt.docopt(__doc__, version=None)
+    logging.basicConfig(level=logging.DEBUG if arg_dict['--DEBUG'] else logging.WARNING)
+    benchmark(int(arg_dict['--frames']), tuple(int(d) for d in arg_dict['--dims'].split('x')),
+              arg_dict['--codec'].upper(), int(arg_dict['--length']),
+              int(arg_dict['--processes'] or multiprocessing.cpu_count()))
@@ -20,11 +20,10 @@ Options:
     -H --Headless       Run without interface
     -D --DEBUG          Verbose output
 
-To do:
-    - destination file name may consist of tokens to automatically create,
-      i.e., %date%now%iterator3$fixedstring
-    - track low res, but store full resolution
-    - can never overwrite a file
+Destination file names may consist of tokens, e.g.
+    $rat12_%date-YYYYMMDD_%iterator3.avi
+for a date, the next free number and fixed strings. Existing files are
+never overwritten.
 
 #Example:
     --source 0 --dims 320x200 --outfile test.avi
@@ -33,11 +32,11 @@ To do:
 
 import cv2
 import time
+import Queue
 import multiprocessing
 import logging
-import copy
 from lib.docopt import docopt
-from lib.core import grabber, tracker, writer, chatter
+from lib.core import grabber, tracker, writer, chatter, budget, registry, monitor
 import pickle
 
 timings_filename = 'tracking_3LEDs.p'
@@ -50,6 +49,7 @@ class Spotter:
     writer = None
     tracker = None
     chatter = None
+    monitor = None
 
     # state variables
     record_to_file = True
@@ -66,7 +66,44 @@ class Spotter:
     scale_resize = 1.0
     scale_tracking = 1.0
 
-    def __init__(self, serial=None, *args, **kwargs):
+    # frames the writer may fall behind, and what to do with new frames once
+    # it has: 'block' waits for the writer, stalling tracking and serial
+    # output, 'drop_oldest' replaces the oldest queued frame, 'drop_newest'
+    # discards the new one
+    writer_queue_size = 16
+    writer_policy = 'drop_oldest'
+    writer_policies = ('block', 'drop_oldest', 'drop_newest')
+
+    # record the downscaled tracking view with markers next to the full
+    # resolution video
+    record_tracking = False
+
+    # record only clips around region events instead of everything: seconds
+    # before and after each event, and the event types that trigger a clip.
+    # Set by the RECORDING section of templates
+    clip_mode = False
+    clip_pre = 5.0
+    clip_post = 5.0
+    clip_events = ('enter', 'cross')
+
+    # publish thumbnails and tracking state for remote monitoring on this
+    # ZMQ address, e.g. 'tcp://*:5556', at monitor_rate per second. Set by
+    # the MONITOR section of templates
+    monitor_address = None
+    monitor_rate = 2.0
+
+    # FOURCC code of recordings, 'RAW' stores uncompressed frames instead,
+    # 'AUTO' the codec of Writer.codecs calibrated to keep up on this machine.
+    # Set by the RECORDING section of templates, for the next recording
+    writer_codec = 'XVID'
+    # encoder processes of segmented recordings, 0 for a single video file
+    writer_encoders = 0
+    segment_length = 300
+
+    n_frames_queued = 0
+    n_frames_dropped = 0
+
+    def __init__(self, serial=None, settings=None, *args, **kwargs):
         """
 
         :param source:
@@ -74,9 +111,12 @@ class Spotter:
         :param fps:
         :param size:
         :param serial:
+        :param settings: Template whose settings apply from the start
         """
         self.log = logging.getLogger(__name__)
         self.log.info(str(multiprocessing.cpu_count()) + ' CPUs found')
+        if settings is not None:
+            self.configure(settings)
 
         #try:
         #    import zmq  # ZeroMQ python bindings
@@ -89,11 +129,17 @@ class Spotter:
 
         # Writer writes frames from buffer to video file in a separate process.
         self.log.debug('Instantiating writer...')
-        self.writer_queue = multiprocessing.Queue(16)
+        self.writer_queue = multiprocessing.Queue(self.writer_queue_size)
         self.writer_pipe, child_pipe = multiprocessing.Pipe()
+        # heartbeat and state of the writer, the pipe only carries commands
+        self.writer_status = writer.WriterStatus()
         self.writer = multiprocessing.Process(target=writer.Writer,
                                               args=(self.grabber.fps, self.grabber.size,
-                                                    self.writer_queue, child_pipe,))
+                                                    self.writer_queue, child_pipe,),
+                                              kwargs={'status': self.writer_status,
+                                                      'codec': self.writer_codec,
+                                                      'encoders': self.writer_encoders,
+                                                      'segment_length': self.segment_length})
         self.log.debug('Starting writer...')
         self.writer.start()
 
@@ -103,30 +149,82 @@ class Spotter:
 
         # chatter handles serial communication
         self.log.debug('Instantiating chatter...')
-        self.chatter = chatter.Chatter(serial, auto=True)
+        self.chatter = chatter.Chatter(serial, auto=True,
+                                       settings=settings['SERIAL'] if settings is not None else None)
+
+        # pin links of slots, recompiled only when changed
+        self.slot_registry = registry.SlotRegistry(self.tracker, self.chatter)
+
+        # time budget of each frame update, degrades tracking when running late
+        self.budget = budget.TickBudget()
+
+        self.start_monitor()
+
+    def configure(self, template):
+        """
+        Apply the settings of a template. Recording settings take effect with
+        the next recording, the serial link is reconnected if they need it.
+        """
+        recording = template['RECORDING']
+        self.writer_codec = recording['codec'].upper()
+        self.writer_encoders = recording['encoders']
+        self.segment_length = recording['segment_length']
+        self.clip_mode = recording['clip_mode']
+        self.clip_pre = recording['clip_pre']
+        self.clip_post = recording['clip_post']
+        self.clip_events = tuple(recording['clip_events'])
+
+        address = template['MONITOR']['address'] or None
+        self.monitor_rate = template['MONITOR']['rate']
+        if self.monitor is not None and address == self.monitor_address:
+            self.monitor.interval = 1.0 / self.monitor_rate
+        elif address != self.monitor_address:
+            self.monitor_address = address
+            # publisher of a running spotter follows, otherwise it starts
+            # with the rest
+            if self.chatter is not None:
+                self.start_monitor()
+
+        if self.chatter is not None and self.chatter.configure(template['SERIAL']) and self.chatter.auto:
+            self.chatter.auto_connect()
+
+    def start_monitor(self):
+        """ Publish on monitor_address, if given, replacing a running publisher. """
+        if self.monitor is not None:
+            self.monitor.stop()
+            self.monitor = None
+        if self.monitor_address is None:
+            return
+        try:
+            self.monitor = monitor.ThumbnailPublisher(self.monitor_address, self.monitor_rate)
+            self.monitor.start()
+        except (ImportError, IOError), error:
+            self.log.error('Remote monitoring unavailable: %s', error)
+            self.monitor = None
 
     def update(self):
         # Get new frame
         self.newest_frame = self.grabber.grab()
         if self.newest_frame is not None:
-            # resize frame if necessary
+            self.budget.begin(self.grabber.fps)
+
+            # resize frame if necessary, keeping the full resolution image for the writer
             if self.scale_resize < 1.0:
+                self.newest_frame.full = self.newest_frame.img
                 self.newest_frame.img = cv2.resize(self.newest_frame.img, (0, 0), fx=self.scale_resize,
                                                    fy=self.scale_resize, interpolation=cv2.INTER_LINEAR)
 
             #with timerclass.Timer(False, self.timings) as t:
 
             # Find and update position of tracked object
-            self.tracker.track_feature(self.newest_frame, method='hsv_thresh',
-                                       scale=self.scale_tracking*self.scale_resize)
+            self.tracker.track_feature(self.newest_frame,
+                                       scale=self.scale_tracking*self.scale_resize*self.budget.scale,
+                                       budget=self.budget)
 
-            slots = []
             messages = []
             # Update positions of all objects
             for o in self.tracker.oois:
-                o.update_slots(self.chatter)
                 o.update_state()
-                slots.extend(o.linked_slots)
                 messages.append('\t'.join([self.newest_frame.time_text,
                                            #str(self.newest_frame.tickstamp),
                                            str(o.label),
@@ -139,23 +237,28 @@ class Spotter:
                                            str(l.position)]))
 
             # Check Object-Region collisions
+            self.tracker.update_collisions(self.newest_frame.img.shape[1::-1], self.newest_frame.timestamp)
             for r in self.tracker.rois:
-                r.update_slots(self.chatter)
-                r.update_state()
-                slots.extend(r.linked_slots)
-            self.chatter.update_pins(slots)
+                r.highlight_deferred = self.budget.defer_highlight
+                if self.recording and self.clip_mode:
+                    for event, obj, ts, details in r.events:
+                        if event in self.clip_events:
+                            self.trigger_clip(' '.join([event, str(r.label), str(obj.label)]), ts)
+            self.chatter.update_pins(self.slot_registry.plan())
+
+            if self.monitor is not None and self.monitor.due():
+                self.monitor.publish(self.newest_frame.img, self.tracking_state())
 
             # Check on writer process to prevent data loss and preserve reference
             if self.check_writer():
+                self.check_writer_status()
                 if self.recording:
-                    self.writer_pipe.send(['record'])
-                    item = (copy.deepcopy(self.newest_frame),
-                            copy.deepcopy(messages))
-                    self.writer_queue.put(item)
+                    self.queue_frame(self.newest_frame, messages)
 #               time.sleep(0.001)  # required, or may crash?
 
-        # FIXME: Blocks if buffer runs full when writer crashes/closes
-        self.writer_pipe.send(['alive'])
+            self.budget.end()
+
+        self.writer_status.beat()
         return self.newest_frame
 
     @property
@@ -166,14 +269,109 @@ class Spotter:
         """ True if alive """
         return self.writer.is_alive()
 
+    def queue_frame(self, frame, messages):
+        """
+        Hand frame to the writer, dropping frames as the writer_policy says.
+        The queue pickles the images without copying them first, as
+        neither image is changed after the update.
+        """
+        self.n_frames_queued += 1
+        if self.writer_policy == 'drop_newest' and self.writer_queue.full():
+            self.n_frames_dropped += 1
+            return
+        if frame.full is None:
+            img, tracking_img = frame.img, None
+        else:
+            img, tracking_img = frame.full, frame.img if self.record_tracking else None
+        item = (frame.index, frame.timestamp, img, tracking_img,
+                self.overlay() if tracking_img is not None else None, messages)
+        if self.writer_policy == 'block':
+            self.writer_queue.put(item)
+            return
+        try:
+            self.writer_queue.put_nowait(item)
+        except Queue.Full:
+            self.n_frames_dropped += 1
+            if self.writer_policy != 'drop_oldest':
+                return
+            # the writer may have taken the oldest already, or it may not
+            # have been flushed into the pipe yet; the new one is lost then
+            try:
+                self.writer_queue.get_nowait()
+                self.writer_queue.put_nowait(item)
+            except (Queue.Empty, Queue.Full):
+                pass
+
+    def tracking_state(self):
+        """ Latest positions and region occupancy, as plain types for JSON. """
+        def xy(p):
+            return None if p is None else [float(p[0]), float(p[1])]
+
+        frame = self.newest_frame
+        return {'index': frame.index,
+                'timestamp': frame.timestamp,
+                'features': dict((str(l.label), xy(l.position)) for l in self.tracker.leds),
+                'objects': dict((str(o.label), xy(o.position)) for o in self.tracker.oois),
+                'regions': dict((str(r.label), [str(o.label) for o, inside in r.inside.items() if inside])
+                                for r in self.tracker.rois),
+                'recording': self.recording,
+                'serial': self.chatter.connected}
+
+    def overlay(self):
+        """ Markers of features and objects for the recorded tracking view. """
+        markers = [(p, 7, l.lblcolor) for l in self.tracker.leds for p in l.positions if p is not None]
+        markers.extend((o.position, 4, (1.0, 1.0, 1.0)) for o in self.tracker.oois if o.position is not None)
+        return markers
+
+    def check_writer_status(self):
+        """ Stop recording if the writer failed, e.g. could not open the file. """
+        if self.recording and self.writer_status.state == 'error':
+            self.log.error('Writer failed: %s', self.writer_status.error)
+            self.recording = False
+
+    @property
+    def writer_stats(self):
+        """ Throughput of the writer, None while not recording. """
+        if self.writer_status.state != 'recording':
+            return None
+        return self.writer_status.stats
+
+    @property
+    def writer_calibrating(self):
+        """ True while the writer measures codecs for AUTO codec selection. """
+        return self.writer_status.calibrating
+
     def start_writer(self, filename=None):
-        size = (self.newest_frame.img.shape[1], self.newest_frame.img.shape[0])
-        self.writer_pipe.send(['start', size, filename])
+        img = self.newest_frame.img if self.newest_frame.full is None else self.newest_frame.full
+        size = (img.shape[1], img.shape[0])
+        # the tracking view only differs while frames are scaled down
+        if self.record_tracking and self.newest_frame.full is not None:
+            tracking_size = (self.newest_frame.img.shape[1], self.newest_frame.img.shape[0])
+        else:
+            tracking_size = None
+        clip = (self.clip_pre, self.clip_post) if self.clip_mode else None
+        # clears a previous error, the writer answers with recording or error
+        self.writer_status.state = 'starting'
+        options = {'codec': self.writer_codec,
+                   'encoders': self.writer_encoders,
+                   'segment_length': self.segment_length}
+        self.writer_pipe.send(['start', size, filename, tracking_size, clip, options])
         self.recording = True
+        self.n_frames_queued = 0
+        self.n_frames_dropped = 0
+
+    def trigger_clip(self, description, timestamp=None):
+        """ Record a clip around timestamp, now if not given, in clip mode. """
+        if timestamp is None:
+            timestamp = self.newest_frame.timestamp if self.newest_frame is not None else time.time()
+        self.writer_pipe.send(['trigger', timestamp, description])
 
     def stop_writer(self):
         self.writer_pipe.send(['stop'])
         self.recording = False
+        if self.n_frames_dropped:
+            self.log.warning('Dropped %d of %d frames while recording', self.n_frames_dropped,
+                             self.n_frames_queued)
 
     def exit(self):
         """ Graceful exit. Ha. Ha. Ha. Bottle of root beer anyone? """
@@ -185,13 +383,20 @@ class Spotter:
         if self.tracker is not None:
             self.tracker.close()
 
+        if self.monitor is not None:
+            self.monitor.stop()
+
         # chatter HAS to close serial connection or all hell breaks loose!
         if self.chatter is not None:
             self.chatter.close()
 
         # writer is a bit trickier, may have frames left to stow away
         if self.writer is not None and self.writer.is_alive():
-            self.writer_pipe.send(['terminate'])
+            # frames queued before the sentinel are still written
+            try:
+                self.writer_queue.put(None, timeout=0.5)
+            except Queue.Full:
+                self.writer_pipe.send(['terminate'])
             # gives the child process one second to finish up
             self.writer.join(1)
             # will be terminated otherwise
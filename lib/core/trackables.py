@@ -8,6 +8,8 @@ Classes related to tracking.
 
 import math
 import random
+import cv2
+import numpy as np
 import lib.utilities as utils
 import lib.geometry as geom
 
@@ -17,9 +19,12 @@ class Shape:
     independent shapes like two rectangles on either end of the track etc.
     Not sure about the color parameter, I think it better if all shapes in a
     ROI have the same color, to keep them together as one ROI.
-    points: list of points defining the shape. Two for rectangle and circle,
+    points: list of points defining the shape. Two for rectangle, circle and
+    line, three or more for polygons.
     """
-    # TODO: n-polygon and collision detection
+    # width of lines in pixels, objects closer than half of it collide
+    line_width = 5
+
     def __init__(self, shape, points=None, label=None):
         self.active = True
         self.selected = False
@@ -37,6 +42,10 @@ class Shape:
             self.collision_check = self.collision_check_circle
         elif shape == 'rectangle':
             self.collision_check = self.collision_check_rectangle
+        elif shape == 'polygon':
+            self.collision_check = self.collision_check_polygon
+        elif shape == 'line':
+            self.collision_check = self.collision_check_line
 
     def move(self, dx, dy):
         """ Move the shape relative to current position. """
@@ -52,6 +61,11 @@ class Shape:
         """ Calculate the radius of the circle. """
         return geom.distance(self.points[0], self.points[1])
 
+    @property
+    def signature(self):
+        """ Hashable state of the shape, changes whenever it needs redrawing. """
+        return self.shape, self.active, tuple(tuple(p) for p in self.points)
+
     def collision_check_circle(self, point):
         """ Circle points: center point, one point on the circle. Test for
         collision by comparing distance between center and point of object with
@@ -75,33 +89,86 @@ class Shape:
                         (point[1] < max(self.points[0][1], self.points[1][1]))
         return self.active and x_in_interval and y_in_interval
 
+    def collision_check_polygon(self, point):
+        """ Polygon points: vertices in order. Edges and vertices collide. """
+        return self.active and geom.point_in_poly(point, [tuple(p) for p in self.points])
+
+    def collision_check_line(self, point):
+        """ Line points: start and end point. Collides within half the line
+        width of the line segment.
+        """
+        a = np.array(self.points[0], float)
+        b = np.array(self.points[1], float)
+        p = np.array(point, float)
+        ab = b - a
+        t = np.dot(p - a, ab) / np.dot(ab, ab) if np.dot(ab, ab) else 0.0
+        closest = a + min(max(t, 0.0), 1.0) * ab
+        return self.active and geom.distance(closest, p) <= self.line_width/2.0
+
+    def outline(self):
+        """ Line segments forming the outline of the shape as list of point
+        pairs. Circles have none, their collisions are tested by distance.
+        """
+        points = [tuple(p) for p in self.points]
+        if self.shape == 'rectangle':
+            (ax, ay), (bx, by) = points
+            corners = [(ax, ay), (bx, ay), (bx, by), (ax, by)]
+            return [(corners[i-1], corners[i]) for i in xrange(4)]
+        elif self.shape == 'polygon':
+            return [(points[i-1], points[i]) for i in xrange(len(points))]
+        elif self.shape == 'line':
+            return [(points[0], points[1])]
+        return []
+
+    def collision_check_segment(self, point1, point2):
+        """ Test if the path from point1 to point2 crosses or touches the shape.
+        End points inside the shape are tested with collision_check.
+        """
+        if not self.active:
+            return False
+        if self.shape == 'circle':
+            return bool(geom.segments_near_points(point1, point2, self.points[0], self.radius))
+        outline = self.outline()
+        if not outline:
+            return False
+        hit, side = geom.segments_intersect(point1, point2, [o[0] for o in outline], [o[1] for o in outline])
+        return bool(hit.any())
+
+    def rasterize(self, mask, value=255):
+        """ Draw the filled shape into a single channel mask. """
+        points = [(int(round(p[0])), int(round(p[1]))) for p in self.points]
+        if self.shape == 'rectangle':
+            cv2.rectangle(mask, points[0], points[1], value, -1)
+        elif self.shape == 'circle':
+            cv2.circle(mask, points[0], int(round(self.radius)), value, -1)
+        elif self.shape == 'polygon':
+            cv2.fillPoly(mask, [np.array(points, np.int32)], value)
+        elif self.shape == 'line':
+            cv2.line(mask, points[0], points[1], value, self.line_width)
+
 
 class Feature:
     """ General class holding a feature to be tracked with whatever tracking
     algorithm is appropriate.
     """
+    feature_type = None
 
-    def __init__(self):
-        pass
-
-
-class LED(Feature):
-    """ Each instance is a spot defined by ranges in a color space. """
-
-    def __init__(self, label, range_hue, range_sat, range_val, range_area, fixed_pos, linked_to, roi=None):
-        Feature.__init__(self)
+    def __init__(self, label, range_area, fixed_pos, linked_to, roi=None, identities=1):
         self.label = label
         self.detection_active = True
         self.marker_visible = True
 
-        # feature description ranges
-        self.range_hue = range_hue
-        self.range_sat = range_sat
-        self.range_val = range_val
+        # admissible area of the contour found for the feature
         self.range_area = range_area
 
         self.pos_hist = []
 
+        # Number of blobs matching the feature, each tracked under its own
+        # identity with a separate history. The first identity doubles as
+        # the feature position history.
+        self.identities = identities
+        self.identity_hist = [self.pos_hist] + [[] for _ in xrange(identities-1)]
+
         # Restrict tracking to a search window?
         self.adaptive_tracking = (roi is not None)
         # if so, where and which window?
@@ -123,8 +190,55 @@ class LED(Feature):
     def position(self):
         return self.pos_hist[-1] if len(self.pos_hist) else None
 
+    @property
+    def positions(self):
+        """ Last positions of all identities. """
+        return [hist[-1] for hist in self.identity_hist if len(hist)]
+
+
+class LED(Feature):
+    """ Each instance is a spot defined by ranges in a color space. """
+    feature_type = 'LED'
+
+    def __init__(self, label, range_hue, range_sat, range_val, range_area, fixed_pos, linked_to, roi=None,
+                 identities=1):
+        Feature.__init__(self, label, range_area, fixed_pos, linked_to, roi, identities)
+
+        # feature description ranges
+        self.range_hue = range_hue
+        self.range_sat = range_sat
+        self.range_val = range_val
+
+
+class Saturated(LED):
+    """ Spot saturating the sensor. Found by thresholding the brightest color
+    channel at the lower bound of the value range, and identified by the hue
+    of the pixels around the saturated core.
+    """
+    feature_type = 'SAT'
+
+
+class Motion(Feature):
+    """ Moving blob found by subtracting a running average background from a
+    downscaled greyscale frame. The value range is the admissible absolute
+    difference to the background, hue and saturation ranges are only kept for
+    the feature tab and the marker color.
+    """
+    feature_type = 'MOTION'
+
+    def __init__(self, label, range_val, range_area, fixed_pos, linked_to, roi=None, identities=1):
+        Feature.__init__(self, label, range_area, fixed_pos, linked_to, roi, identities)
+
+        self.range_hue = (0, 179)
+        self.range_sat = (0, 255)
+        self.range_val = range_val
+
 
 class Slot:
+    # bumped on any change of slot lists, pin links or pin preferences, so
+    # pin assignments are only recomputed when something changed
+    generation = 0
+
     def __init__(self, label, slot_type, state=None, state_idx=None, ref=None):
 
         # While nice, should be used for style, not for identity testing
@@ -151,10 +265,22 @@ class Slot:
             self.detach_pin()
         self.pin = pin
         self.pin.slot = self
+        Slot.touch()
 
     def detach_pin(self):
         self.pin.slot = None
         self.pin = None
+        Slot.touch()
+
+    def set_pin_pref(self, pin_pref):
+        if pin_pref != self.pin_pref:
+            self.pin_pref = pin_pref
+            Slot.touch()
+
+    @staticmethod
+    def touch():
+        """ Mark slot links as changed. """
+        Slot.generation += 1
 
     def __del__(self):
         print "Removing slot", self
@@ -224,8 +350,7 @@ class ObjectOfInterest:
             for ms in self.magnetic_signals:
                 # Check that pin preferences are set correctly
                 if slot.label == ms[0]:
-                    if not slot.pin_pref == ms[1]:
-                        slot.pin_pref = ms[1]
+                    slot.set_pin_pref(ms[1])
 
             if (slot.pin_pref is not None) and (slot.pin is None):
                 # If pin pref and not connected to pin
@@ -238,7 +363,7 @@ class ObjectOfInterest:
         """Calculate position from detected features linked to object."""
         if not self.tracked:
             return
-        feature_positions = [f.pos_hist[-1] for f in self.linked_leds if len(f.pos_hist)]
+        feature_positions = [p for f in self.linked_leds for p in f.positions]
         self.pos_hist.append(geom.middle_point(feature_positions))
 
     @property
@@ -278,13 +403,13 @@ class ObjectOfInterest:
         """
         # TODO: Direction based on movement if only one feature
         # TODO: Calculate angle when having multiple features
-        if not self.tracked or self.linked_leds is None or len(self.linked_leds) < 2:
+        if not self.tracked or self.linked_leds is None or \
+           sum(f.identities for f in self.linked_leds) < 2:
             return None
 
         feature_coords = []
         for feature in self.linked_leds:
-            if len(feature.pos_hist) > 0 and feature.pos_hist[-1] is not None:
-                feature_coords.append(feature.pos_hist[-1])
+            feature_coords.extend([p for p in feature.positions if p is not None])
 
         if len(feature_coords) == 2:
             x1 = feature_coords[0][0]*1.0
@@ -315,6 +440,16 @@ class RegionOfInterest:
     color = None
     alpha = .4
     highlighted = False
+    # color changes are postponed while the main loop is running late
+    highlight_deferred = False
+
+    # consecutive frames an object has to be in/out before it counts as
+    # having entered/left, different counts give hysteresis against flicker.
+    # One frame each reacts on the first frame of a collision, as always
+    enter_frames = 1
+    exit_frames = 1
+    # seconds of a single visit after which a dwell event is emitted
+    dwell_limit = None
 
     strict_prefs_dealt = False
 
@@ -341,6 +476,35 @@ class RegionOfInterest:
         else:
             self.magnetic_objects = magnetic_objects
 
+        # occupancy raster and outlines of all active shapes, compiled when
+        # shapes change
+        self.raster = None
+        self.raster_signature = None
+        self.raster_version = 0
+        self.segments = None
+        self.segment_shapes = []
+        self.circles = None
+        self.circle_shapes = []
+
+        # collisions of objects found in the current frame, and crossings of
+        # line shapes as (object, shape, direction)
+        self.collisions = {}
+        self.crossings = []
+
+        # debounced occupancy state per object, and behavioral stats
+        self.inside = {}
+        self.pending = {}
+        self.entered_at = {}
+        self.dwell = {}
+        self.visits = {}
+        self.dwell_reported = set()
+
+        # events of the last update as (event, object, timestamp, details),
+        # and callbacks called with (region, object, timestamp, *details) per
+        # event. Details of cross events are the line shape and direction
+        self.events = []
+        self.callbacks = {'enter': [], 'exit': [], 'dwell': [], 'cross': []}
+
         # if initialized with starting set of shapes
         self.shapes = []
         if shape_list:
@@ -348,14 +512,13 @@ class RegionOfInterest:
                 self.add_shape(*shape)
 
     def update_state(self):
-        self.highlighted = False
         self.deal_pin_prefs()
 
     def deal_pin_prefs(self):
         for mo in self.magnetic_objects:
             for s in self.slots:
                 if s.ref == mo[0]:
-                    s.pin_pref = mo[1]
+                    s.set_pin_pref(mo[1])
 
     def update_slots(self, chatter):
         for slot in self.slots:
@@ -420,32 +583,140 @@ class RegionOfInterest:
         for slot in self.slots:
             if not slot.ref in self.oois:
                 self.unlink_object(slot.ref)
+        self.forget_removed()
+
+    def forget_removed(self):
+        """ Drop collision and event state of objects no longer tracked. """
+        for state in (self.collisions, self.inside, self.pending, self.entered_at, self.dwell, self.visits):
+            for obj in [o for o in state if o not in self.oois]:
+                del state[obj]
+        self.dwell_reported.intersection_update(self.oois)
 
     def link_object(self, obj):
         print "Linked Object", obj.label, "to", self
         if obj in self.oois:
-            self.slots.append(Slot(label=obj.label, slot_type='digital', state=self.test_collision,
+            self.slots.append(Slot(label=obj.label, slot_type='digital', state=self.occupied,
                                    state_idx=obj, ref=obj))
+            Slot.touch()
 
     def unlink_object(self, obj):
         for slot in self.slots:
             if slot.ref is obj:
                 self.slots.remove(slot)
+                Slot.touch()
                 print "Removed object", obj.label, "from slot list of", self.label
 
+    def occupancy(self, size):
+        """
+        Boolean raster of size (width, height), True where any active shape
+        of the region is. Only redrawn if shapes or frame size changed.
+        """
+        signature = (tuple(size), tuple(s.signature for s in self.shapes))
+        if signature != self.raster_signature:
+            mask = np.zeros((size[1], size[0]), np.uint8)
+            segments = []
+            self.segment_shapes = []
+            circles = []
+            self.circle_shapes = []
+            for s in self.shapes:
+                if s.active and s.points is not None:
+                    s.rasterize(mask)
+                    for segment in s.outline():
+                        segments.append(segment)
+                        self.segment_shapes.append(s)
+                    if s.shape == 'circle':
+                        circles.append((s.points[0][0], s.points[0][1], s.radius))
+                        self.circle_shapes.append(s)
+            self.raster = mask.astype(bool)
+            self.segments = np.array(segments, float).reshape(-1, 2, 2)
+            self.circles = np.array(circles, float).reshape(-1, 3)
+            self.raster_signature = signature
+            self.raster_version += 1
+        return self.raster
+
+    def add_callback(self, event, callback):
+        """ Register callback(region, object, timestamp) for event type
+        enter, exit or dwell, or callback(region, object, timestamp, shape,
+        direction) for cross.
+        """
+        self.callbacks[event].append(callback)
+
+    def remove_callback(self, event, callback):
+        try:
+            self.callbacks[event].remove(callback)
+        except ValueError:
+            pass
+
+    def emit(self, event, obj, timestamp, *details):
+        self.events.append((event, obj, timestamp, details))
+        for callback in self.callbacks[event]:
+            callback(self, obj, timestamp, *details)
+
+    def update_events(self, timestamp):
+        """
+        Debounce the collisions of the current frame into enter and exit
+        events, accumulate dwell times per object and emit dwell events for
+        visits longer than dwell_limit. Lost objects keep their last state.
+        """
+        self.events = []
+        for obj, shape, direction in self.crossings:
+            self.emit('cross', obj, timestamp, shape, direction)
+
+        for obj, collision in self.collisions.items():
+            inside = self.inside.get(obj, False)
+            if collision is None or collision == inside:
+                self.pending[obj] = 0
+            else:
+                self.pending[obj] = self.pending.get(obj, 0) + 1
+                if self.pending[obj] >= (self.exit_frames if inside else self.enter_frames):
+                    self.pending[obj] = 0
+                    self.inside[obj] = inside = collision
+                    if inside:
+                        self.entered_at[obj] = timestamp
+                        self.visits[obj] = self.visits.get(obj, 0) + 1
+                        self.emit('enter', obj, timestamp)
+                    else:
+                        self.dwell[obj] = self.dwell.get(obj, 0) + timestamp - self.entered_at.pop(obj)
+                        self.dwell_reported.discard(obj)
+                        self.emit('exit', obj, timestamp)
+
+            if inside and self.dwell_limit is not None and obj not in self.dwell_reported:
+                if timestamp - self.entered_at[obj] > self.dwell_limit:
+                    self.dwell_reported.add(obj)
+                    self.emit('dwell', obj, timestamp)
+
+        self.highlighted = any(self.inside.values())
+        self.toggle_highlight()
+
+    def occupied(self, obj):
+        """ Debounced occupancy of the region by the object. """
+        return self.inside.get(obj, False)
+
+    def dwell_time(self, obj, timestamp=None):
+        """ Total seconds the object spent in the region, including the
+        current visit up to timestamp.
+        """
+        total = self.dwell.get(obj, 0)
+        if obj in self.entered_at and timestamp is not None:
+            total += timestamp - self.entered_at[obj]
+        return total
+
     def test_collision(self, obj):
-        return self.check_shape_collision(obj.position)
+        if obj in self.collisions:
+            return self.collisions[obj]
+        previous = obj.pos_hist[-2] if len(obj.pos_hist) >= 2 else None
+        return self.check_shape_collision(obj.position, previous)
 
     def check_shape_collision(self, point1, point2=None):
-        """ Test if a line between start and end would somewhere collide with
-        any shapes of this ROI. Simple AND values in the collision detection
-        array on the line.
+        """ Test if point1, or the line between point2 and point1, would
+        somewhere collide with any shapes of this ROI.
         """
         # TODO: Only checks of the point is within the bounding box of shapes?
         if point1 is not None:
             collision = False
             for s in self.shapes:
-                if s.active and s.collision_check(point1):
+                if s.active and (s.collision_check(point1) or
+                                 (point2 is not None and s.collision_check_segment(point2, point1))):
                     self.highlighted = True
                     collision = True
                     break
@@ -458,6 +729,8 @@ class RegionOfInterest:
 
     def toggle_highlight(self):
         """ Toggle color to active set if region is highlighted by collision. """
+        if self.highlight_deferred:
+            return
         if self.highlighted:
             if self.normal_color != self.active_color:
                 self.set_active_color()
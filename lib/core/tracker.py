@@ -39,6 +39,31 @@ class Tracker:
     frame = None
     scale = 1.0
 
+    # tracking method used for each feature type
+    methods = {'LED': 'hsv_thresh',
+               'SAT': 'sat',
+               'MOTION': 'motion'}
+
+    # identity assignment of features with several blobs; maximum distance
+    # in pixels per frame, and frames an identity is remembered after loss
+    max_jump = 100
+    identity_memory = 15
+
+    # bit raster of region occupancy, rebuilt when regions change
+    collision_raster = None
+    collision_keys = None
+    # outlines and circles of all regions, with index of the owning region
+    collision_segments = None
+    collision_segment_rois = None
+    collision_circles = None
+    collision_circle_rois = None
+
+    # background model for motion features, relative to the tracking scale
+    background = None
+    motion_frame = None
+    motion_scale = 0.5
+    motion_learning_rate = 0.05
+
     def __init__(self, adaptive_tracking=False):
 
         self.log = logging.getLogger(__name__)
@@ -48,16 +73,31 @@ class Tracker:
         self.leds = []
         self.adaptive_tracking = adaptive_tracking
 
-    def add_led(self, label, range_hue, range_sat, range_val, range_area, fixed_pos=False, linked_to=None):
+    def add_led(self, label, range_hue, range_sat, range_val, range_area, fixed_pos=False, linked_to=None,
+                identities=1):
         if self.adaptive_tracking:
             roi = trkbl.Shape('rectangle', None, None)
         else:
             roi = trkbl.Shape('rectangle', None, None)
-        led = trkbl.LED(label, range_hue, range_sat, range_val, range_area, fixed_pos, linked_to, roi)
+        led = trkbl.LED(label, range_hue, range_sat, range_val, range_area, fixed_pos, linked_to, roi, identities)
         self.leds.append(led)
         self.log.debug("Added feature %s", led)
         return led
 
+    def add_saturated(self, label, range_hue, range_sat, range_val, range_area, fixed_pos=False, linked_to=None):
+        roi = trkbl.Shape('rectangle', None, None)
+        sat = trkbl.Saturated(label, range_hue, range_sat, range_val, range_area, fixed_pos, linked_to, roi)
+        self.leds.append(sat)
+        self.log.debug("Added feature %s", sat)
+        return sat
+
+    def add_motion(self, label, range_val, range_area, fixed_pos=False, linked_to=None, identities=1):
+        roi = trkbl.Shape('rectangle', None, None)
+        motion = trkbl.Motion(label, range_val, range_area, fixed_pos, linked_to, roi, identities)
+        self.leds.append(motion)
+        self.log.debug("Added feature %s", motion)
+        return motion
+
     def remove_led(self, led):
         try:
             self.log.debug("Removing feature %s", led)
@@ -71,6 +111,7 @@ class Tracker:
     def add_ooi(self, led_list, label, traced=False, tracked=True, magnetic_signals=None):
         ooi = trkbl.ObjectOfInterest(led_list, label, traced, tracked, magnetic_signals)
         self.oois.append(ooi)
+        trkbl.Slot.touch()
         self.log.debug("Added object %s", ooi)
         return ooi
 
@@ -79,12 +120,14 @@ class Tracker:
             self.oois.remove(ooi)
             for roi in self.rois:
                 roi.refresh_slot_list()
+            trkbl.Slot.touch()
         except ValueError:
             self.log.error("Object to be removed not found")
 
     def add_roi(self, shape_list, label, color=None, magnetic_objects=None):
         roi = trkbl.RegionOfInterest(shape_list, label, color, self.oois, magnetic_objects)
         self.rois.append(roi)
+        trkbl.Slot.touch()
         self.log.debug("Added region %s", roi)
         return roi
 
@@ -92,25 +135,127 @@ class Tracker:
         try:
             del roi.shapes[:]
             self.rois.remove(roi)
+            trkbl.Slot.touch()
         except ValueError:
             self.log.error("Region to be removed not found")
 
-    def track_feature(self, frame, method='hsv_thresh', scale=1.0):
+    def update_collisions(self, size, timestamp=None):
+        """
+        Test all objects against all regions with a single lookup into a
+        raster of frame size (width, height), where bit n of each pixel is
+        set if region n occupies it. Objects moving fast enough to jump over
+        a shape between frames are caught by testing their path since the
+        last frame against the outlines of all shapes at once. Results, and
+        crossings of line shapes, are handed to the regions, which turn them
+        into events at the frame timestamp.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        for r in self.rois:
+            r.occupancy(size)
+        keys = tuple((id(r), r.raster_version) for r in self.rois)
+        if keys != self.collision_keys or self.collision_raster is None:
+            n_words = max(1, (len(self.rois) + 63) // 64)
+            self.collision_raster = np.zeros((size[1], size[0], n_words), np.uint64)
+            for n, r in enumerate(self.rois):
+                self.collision_raster[:, :, n // 64][r.raster] |= np.uint64(1 << (n % 64))
+            self.collision_segments = np.concatenate([r.segments for r in self.rois] +
+                                                     [np.zeros((0, 2, 2))])
+            self.collision_segment_rois = np.array([n for n, r in enumerate(self.rois)
+                                                    for _ in xrange(len(r.segments))], int)
+            self.collision_circles = np.concatenate([r.circles for r in self.rois] +
+                                                    [np.zeros((0, 3))])
+            self.collision_circle_rois = np.array([n for n, r in enumerate(self.rois)
+                                                   for _ in xrange(len(r.circles))], int)
+            self.collision_keys = keys
+
+        h, w = self.collision_raster.shape[0:2]
+        positions = [o.position for o in self.oois]
+        valid = [p is not None and 0 <= p[0] < w and 0 <= p[1] < h for p in positions]
+        points = np.array([p for p, v in zip(positions, valid) if v], int).reshape(-1, 2)
+
+        # one lookup for all objects, (n_objects, n_regions) collision matrix
+        idx = np.arange(len(self.rois))
+        words = self.collision_raster[points[:, 1], points[:, 0]]
+        hits = (words[:, idx // 64] >> (idx % 64).astype(np.uint64)) & np.uint64(1)
+        hits = hits.astype(bool)
+
+        # paths since last frame of valid objects that have one
+        moved = [i for i, o in enumerate(o for o, v in zip(self.oois, valid) if v)
+                 if len(o.pos_hist) >= 2 and o.pos_hist[-2] is not None]
+        crossed = {}
+        if moved:
+            valid_oois = [o for o, v in zip(self.oois, valid) if v]
+            start = np.array([valid_oois[i].pos_hist[-2] for i in moved], float)
+            end = points[moved].astype(float)
+
+            # (n_moved, n_segments) intersections with all outlines
+            seg_hits, sides = geom.segments_intersect(start[:, np.newaxis], end[:, np.newaxis],
+                                                      self.collision_segments[np.newaxis, :, 0],
+                                                      self.collision_segments[np.newaxis, :, 1])
+            # (n_moved, n_circles) passes through circles
+            circle_hits = geom.segments_near_points(start[:, np.newaxis], end[:, np.newaxis],
+                                                    self.collision_circles[np.newaxis, :, 0:2],
+                                                    self.collision_circles[np.newaxis, :, 2])
+            for row, col in zip(*np.nonzero(seg_hits)):
+                hits[moved[row], self.collision_segment_rois[col]] = True
+                crossed.setdefault(self.collision_segment_rois[col], []).append((row, col))
+            for row, col in zip(*np.nonzero(circle_hits)):
+                hits[moved[row], self.collision_circle_rois[col]] = True
+
+        for n, r in enumerate(self.rois):
+            r.collisions = {}
+            row = iter(hits[:, n])
+            for o, p, v in zip(self.oois, positions, valid):
+                r.collisions[o] = bool(next(row)) if v else (False if p is not None else None)
+
+            # direction of crossed lines: 1 if ending up left of the line
+            # (as seen from its first point), -1 if right of it
+            r.crossings = []
+            first = self.collision_segment_rois.searchsorted(n)
+            for row, col in crossed.get(n, []):
+                shape = r.segment_shapes[col - first]
+                if shape.shape == 'line':
+                    obj = valid_oois[moved[row]]
+                    r.crossings.append((obj, shape, int(sides[row, col])))
+                    self.log.debug('%s crossed %s of %s in direction %d',
+                                   obj.label, shape.label, r.label, sides[row, col])
+
+            r.update_events(timestamp)
+            for event, obj, ts, details in r.events:
+                self.log.debug('%s %s %s', obj.label, event, r.label)
+
+    def track_feature(self, frame, scale=1.0, budget=None):
         """
-        Intermediate method selecting tracking method and separating those
-        tracking methods from the frames stored in the instantiated Tracker
+        Intermediate method selecting tracking method for each feature and
+        separating those tracking methods from the frames stored in the
+        instantiated Tracker. Color space conversions and the background model
+        are only computed if any active feature requires them.
 
         :param:scale
             Resize frame before tracking, computation decreases scale^2.
+        :param:budget
+            TickBudget of the current frame. Features driving pins are
+            tracked first, others are skipped if the budget says so or once
+            the deadline has passed.
         """
         self.scale = scale*1.0  # float
         if self.scale > 1.0:
             self.scale = 1.0
 
+        active = [f for f in self.leds if f.detection_active]
+        # with nothing driving pins, every feature is as important as any
+        # other, and skipping the non-critical ones would skip them all
+        critical = self.critical_features() or set(active)
+        if budget is not None and budget.skip_noncritical:
+            active = [f for f in active if f in critical]
+        methods = dict((f, self.methods[f.feature_type]) for f in active)
+        used_methods = set(methods.values())
+
 #        # conversion to HSV before dilation causes artifacts!
         # dilate bright spots
 #        kernel = np.ones((3,3), 'uint8')
-        if method == 'hsv_thresh':
+        if 'hsv_thresh' in used_methods:
             if self.scale >= 1.0:
                 self.frame = cv2.cvtColor(frame.img, cv2.COLOR_BGR2HSV)
             else:
@@ -118,32 +263,61 @@ class Tracker:
                 self.frame = cv2.cvtColor(cv2.resize(frame.img, (0, 0), fx=self.scale, fy=self.scale,
                                                      interpolation=cv2.INTER_NEAREST), cv2.COLOR_BGR2HSV)
 
-            for led in self.leds:
-                if led.detection_active:
-                    self.track_thresholds(self.frame, led)
-                else:
-                    led.pos_hist.append(None)
+        if 'sat' in used_methods:
+            sat_features = [f for f in active if methods[f] == 'sat']
+            level = min(f.range_val[0] for f in sat_features)
+            candidates = self.find_saturated(frame.img, level)
+            sat_positions = self.track_saturated(candidates, sat_features)
 
-    def track_thresholds(self, hsv_frame, l):
+        if 'motion' in used_methods:
+            self.update_background(frame.img)
+        else:
+            # stale model would report everything that moved since as foreground
+            self.background = None
+
+        # features driving pins first, in case the deadline passes
+        for feature in sorted(self.leds, key=lambda f: f not in critical):
+            if feature not in methods or \
+               (budget is not None and feature not in critical and budget.expired()):
+                if feature in methods:
+                    self.log.debug('Deadline passed, skipping feature %s', feature.label)
+                for hist in feature.identity_hist:
+                    hist.append(None)
+            elif methods[feature] == 'hsv_thresh':
+                self.track_thresholds(self.frame, feature)
+            elif methods[feature] == 'sat':
+                feature.pos_hist.append(sat_positions[feature])
+            elif methods[feature] == 'motion':
+                self.track_motion(self.motion_frame, feature)
+
+    def critical_features(self):
         """
-        Tracks LEDs from a list in a HSV frame by thresholding
-        hue, saturation, followed by thresholding for each LEDs hue.
-        Large enough contours will have coordinates returned, or None
+        Features of objects whose own slots or region slots are linked to
+        pins. Everything else only shows up as marker or trace in the GUI.
         """
-        r_hue = l.range_hue
-        r_sat = l.range_sat
-        r_val = l.range_val
-        r_area = (l.range_area[0]*self.scale**2, l.range_area[1]*self.scale**2)
-
-        # determine array slices if adaptive tracking is used
-        if (l.adaptive_tracking and self.adaptive_tracking) \
+        driving = set()
+        for r in self.rois:
+            driving.update(slot.ref for slot in r.slots if slot.pin)
+        critical = set()
+        for o in self.oois:
+            if o in driving or any(slot.pin for slot in o.slots):
+                critical.update(o.linked_leds)
+        return critical
+
+    def search_window(self, frame, l, scale):
+        """
+        Slice of the frame to search a feature in if adaptive tracking is
+        used, and the offset of that slice in the frame.
+        """
+        # search window follows a single position, identities may be anywhere
+        if (l.adaptive_tracking and self.adaptive_tracking) and l.identities == 1 \
            and l.search_roi is not None and l.search_roi.points is not None:
             (ax, ay), (bx, by) = l.search_roi.points
-            ax *= self.scale
-            bx *= self.scale
-            ay *= self.scale
-            by *= self.scale
-            h, w = hsv_frame.shape[0:2]
+            ax = int(ax * scale)
+            bx = int(bx * scale)
+            ay = int(ay * scale)
+            by = int(by * scale)
+            h, w = frame.shape[0:2]
 
             # check if box is too far left or right:
             # Esther says to do it the stoopid way
@@ -157,12 +331,37 @@ class Tracker:
             if by >= h-1:
                 by = h-1
 
-            frame = hsv_frame[ay:by, ax:bx, :]
-            frame_offset = True
+            return frame[ay:by, ax:bx, ...], (ax, ay)
         else:
-            frame_offset = False
-            frame = hsv_frame
+            return frame, None
 
+    def track_thresholds(self, hsv_frame, l):
+        """
+        Tracks LEDs from a list in a HSV frame by thresholding
+        hue, saturation, followed by thresholding for each LEDs hue.
+        Large enough contours will have coordinates returned, or None
+        """
+        r_hue = l.range_hue
+        r_sat = l.range_sat
+        r_val = l.range_val
+        r_area = (l.range_area[0]*self.scale**2, l.range_area[1]*self.scale**2)
+
+        # determine array slices if adaptive tracking is used
+        frame, offset = self.search_window(hsv_frame, l, self.scale)
+
+        ranged_frame = self.threshold_hsv(frame, r_hue, r_sat, r_val)
+
+        # find largest contour that is >= than minimum area
+        ranged_frame = cv2.dilate(ranged_frame, np.ones((3, 3), np.uint8))
+        if l.identities > 1:
+            self.track_identities(ranged_frame, l, r_area, offset, self.scale)
+        else:
+            contour_area, contour = self.find_contour(ranged_frame, r_area)
+            l.pos_hist.append(self.contour_position(contour, offset, self.scale))
+
+    @staticmethod
+    def threshold_hsv(frame, r_hue, r_sat, r_val):
+        """ Mask of pixels of a HSV frame within the hue, saturation and value ranges. """
         # if range[0] > range[1], i.e., color is red and wraps around
         invert_range = False if not r_hue[0] > r_hue[1] else True
 
@@ -184,23 +383,165 @@ class Tracker:
             red_range = cv2.inRange(frame, lower_bound, upper_bound)
             # combine both ends for complete mask
             ranged_frame = cv2.bitwise_or(ranged_frame, red_range)
+        return ranged_frame
 
-        # find largest contour that is >= than minimum area
+    def find_saturated(self, img, level):
+        """
+        Find spots where the brightest color channel reaches level, on a
+        strided view of the frame instead of a resized copy. Returns list of
+        candidates as (position, area, HSV cutout around the spot). Only the
+        cutouts are converted to HSV.
+        """
+        step = max(1, int(round(1.0/self.scale)))
+        peak = img[::step, ::step].max(axis=2)
+        mask = cv2.inRange(peak, np.array([level], np.uint8), np.array([255], np.uint8))
+        mask = cv2.dilate(mask, np.ones((3, 3), np.uint8))
+        contours, hierarchy = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+        h, w = img.shape[0:2]
+        candidates = []
+        for cnt in contours:
+            x, y, cw, ch = cv2.boundingRect(cnt)
+            position = self.contour_position(cnt, None, 1.0/step)
+            if position is None:
+                position = ((x + cw/2.0)*step, (y + ch/2.0)*step)
+            area = cv2.contourArea(cnt.astype(int))*step**2
+
+            # colored halo around the saturated core carries the hue
+            ax, ay = max(0, (x-1)*step), max(0, (y-1)*step)
+            bx, by = min(w, (x+cw+1)*step), min(h, (y+ch+1)*step)
+            cutout = cv2.cvtColor(img[ay:by, ax:bx], cv2.COLOR_BGR2HSV)
+            candidates.append((position, area, cutout))
+        return candidates
+
+    def track_saturated(self, candidates, features):
+        """
+        Assign saturated spots to features by the number of pixels around
+        each spot matching the hue and saturation range of a feature. Each
+        spot is assigned to at most one feature, best matches first.
+        """
+        scores = []
+        for f in features:
+            window = None
+            if (f.adaptive_tracking and self.adaptive_tracking) \
+               and f.search_roi is not None and f.search_roi.points is not None:
+                window = f.search_roi.points
+
+            for idx, (position, area, cutout) in enumerate(candidates):
+                if area < f.range_area[0] or (f.range_area[1] and area >= f.range_area[1]):
+                    continue
+                if window is not None and not \
+                   (window[0][0] <= position[0] <= window[1][0] and window[0][1] <= position[1] <= window[1][1]):
+                    continue
+                score = cv2.countNonZero(self.threshold_hsv(cutout, f.range_hue, f.range_sat, (0, 255)))
+                if score:
+                    scores.append((score, f, idx))
+
+        positions = dict((f, None) for f in features)
+        assigned = set()
+        for score, f, idx in sorted(scores, key=lambda sc: sc[0], reverse=True):
+            if positions[f] is None and idx not in assigned:
+                positions[f] = candidates[idx][0]
+                assigned.add(idx)
+        return positions
+
+    def update_background(self, img):
+        """
+        Incrementally update the running average background model with a
+        downscaled, greyscale version of the frame. The absolute difference
+        of the frame to the model before the update is kept as motion_frame.
+        """
+        scale = self.scale * self.motion_scale
+        grey = cv2.cvtColor(cv2.resize(img, (0, 0), fx=scale, fy=scale, interpolation=cv2.INTER_NEAREST),
+                            cv2.COLOR_BGR2GRAY)
+        grey = cv2.blur(grey, (3, 3))
+
+        # (re-)initialize model on first frame or if the frame size changed
+        if self.background is None or self.background.shape != grey.shape:
+            self.background = grey.astype(np.float32)
+
+        self.motion_frame = cv2.absdiff(grey, cv2.convertScaleAbs(self.background))
+        cv2.accumulateWeighted(grey, self.background, self.motion_learning_rate)
+
+    def track_motion(self, motion_frame, l):
+        """
+        Tracks the largest foreground blob in the difference image of the
+        background model. Difference has to be within the value range of the
+        feature, area within its area range.
+        """
+        scale = self.scale * self.motion_scale
+        r_area = (l.range_area[0]*scale**2, l.range_area[1]*scale**2)
+
+        frame, offset = self.search_window(motion_frame, l, scale)
+        ranged_frame = cv2.inRange(frame, np.array([l.range_val[0]], np.uint8),
+                                   np.array([l.range_val[1]], np.uint8))
+
+        # close small gaps in the foreground of low contrast animals
         ranged_frame = cv2.dilate(ranged_frame, np.ones((3, 3), np.uint8))
-        contour_area, contour = self.find_contour(ranged_frame, r_area)
-
-        # find centroids of the contour returned
-        if contour is not None:
-            moments = cv2.moments(contour.astype(int))
-            cx = moments['m10']/moments['m00']
-            cy = moments['m01']/moments['m00']
-            if frame_offset:
-                cx += ax
-                cy += ay
-            l.pos_hist.append((cx/self.scale, cy/self.scale))
+        if l.identities > 1:
+            self.track_identities(ranged_frame, l, r_area, offset, scale)
         else:
-            # Couldn't find a good enough spot
-            l.pos_hist.append(None)
+            contour_area, contour = self.find_contour(ranged_frame, r_area)
+            l.pos_hist.append(self.contour_position(contour, offset, scale))
+
+    def track_identities(self, frame, l, range_area, offset, scale):
+        """
+        Assign all admissible blobs to the identities of a feature by
+        minimizing the summed distance to the predicted position of each
+        identity. Identities without prediction take whatever blobs are left,
+        assignments jumping further than max_jump are rejected.
+        """
+        contours = self.find_contours(frame, range_area)
+        positions = [self.contour_position(cnt, offset, scale) for cnt in contours]
+        positions = [p for p in positions if p is not None]
+
+        predicted = [self.predict_position(hist) for hist in l.identity_hist]
+        new_positions = [None] * l.identities
+        if positions:
+            cost = np.empty((l.identities, len(positions)))
+            cost.fill(self.max_jump)
+            for i, prediction in enumerate(predicted):
+                if prediction is not None:
+                    cost[i] = np.hypot(*(np.array(positions) - prediction).T)
+
+            for i, j in geom.linear_assignment(cost):
+                if predicted[i] is None or cost[i, j] <= self.max_jump:
+                    new_positions[i] = positions[j]
+
+        for hist, position in zip(l.identity_hist, new_positions):
+            hist.append(position)
+
+    def predict_position(self, pos_hist):
+        """
+        Expected position from the history of an identity. Linear extrapolation
+        from the last two positions, or the last known position if it is not
+        older than identity_memory frames.
+        """
+        if len(pos_hist) >= 2 and pos_hist[-1] is not None and pos_hist[-2] is not None:
+            return 2*np.array(pos_hist[-1]) - np.array(pos_hist[-2])
+        for p in xrange(min(len(pos_hist), self.identity_memory)):
+            if pos_hist[-p-1] is not None:
+                return np.array(pos_hist[-p-1])
+        return None
+
+    @staticmethod
+    def contour_position(contour, offset, scale):
+        """
+        Centroid of the contour in coordinates of the full frame. Returns None
+        if no contour given, i.e. couldn't find a good enough spot.
+        """
+        if contour is None:
+            return None
+
+        moments = cv2.moments(contour.astype(int))
+        if not moments['m00']:
+            return None
+        cx = moments['m10']/moments['m00']
+        cy = moments['m01']/moments['m00']
+        if offset is not None:
+            cx += offset[0]
+            cy += offset[1]
+        return cx/scale, cy/scale
 
     @staticmethod
     def find_contour(frame, range_area):
@@ -221,6 +562,20 @@ class Tracker:
                     best_cnt = cnt
         return largest_area, best_cnt
 
+    @staticmethod
+    def find_contours(frame, range_area):
+        """
+        Return all contours within admissible range_area, largest first.
+        """
+        contours, hierarchy = cv2.findContours(frame, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
+        admissible = []
+        for cnt in contours:
+            area = cv2.contourArea(cnt.astype(int))
+            if area >= range_area[0] and (range_area[1] == 0 or area < range_area[1]):
+                admissible.append((area, cnt))
+        admissible.sort(key=lambda ac: ac[0], reverse=True)
+        return [cnt for area, cnt in admissible]
+
     def close(self):
         """ Nothing to do here. """
         self.log.debug('Closing tracker')
@@ -29,14 +29,102 @@ import cv2
 import os
 import sys
 import time
+import Queue
+import select
 import logging
+import threading
+import multiprocessing
 
 from lib import utilities as utils
 from lib.docopt import docopt
+from lib.core import segments, rawvideo, clips, calibration
 
 OVERWRITE = False
-#seconds till writer process times out after having received last alive packet
+#seconds till writer process times out after the last heartbeat
 STILL_ALIVE_TIMEOUT = 10
+#seconds to wait for the first heartbeat, while the interface starts up
+STARTUP_TIMEOUT = 120
+#seconds between checks of the heartbeat while idle
+HEARTBEAT_INTERVAL = 1.0
+
+
+class WriterStatus(object):
+    """
+    Memory shared by Spotter and the writer process, read and written
+    without locks or messages. Spotter counts up the heartbeat every
+    update and sets the starting state when asking for a recording,
+    everything else is only written by the writer. Codec calibration runs
+    next to any of the states.
+    """
+    states = ('starting', 'idle', 'recording', 'error', 'closed')
+    stat_names = ('fps', 'mbps', 'latency', 'max_latency', 'queued')
+    error_length = 256
+
+    def __init__(self):
+        self._heartbeat = multiprocessing.RawValue('L', 0)
+        self._state = multiprocessing.RawValue('i', 0)
+        self._frames = multiprocessing.RawValue('L', 0)
+        # double, byte counts pass 4 GB
+        self._bytes = multiprocessing.RawValue('d', 0)
+        self._stats = multiprocessing.RawArray('d', len(self.stat_names))
+        self._error = multiprocessing.RawArray('c', self.error_length)
+        self._calibrating = multiprocessing.RawValue('b', 0)
+
+    def beat(self):
+        self._heartbeat.value += 1
+
+    @property
+    def heartbeat(self):
+        return self._heartbeat.value
+
+    @property
+    def state(self):
+        return self.states[self._state.value]
+
+    @state.setter
+    def state(self, state):
+        self._state.value = self.states.index(state)
+
+    @property
+    def frames(self):
+        return self._frames.value
+
+    @property
+    def bytes(self):
+        return self._bytes.value
+
+    def count(self, n_bytes):
+        self._frames.value += 1
+        self._bytes.value += n_bytes
+
+    @property
+    def error(self):
+        return self._error.value
+
+    @error.setter
+    def error(self, msg):
+        self._error.value = msg[:self.error_length-1]
+
+    @property
+    def calibrating(self):
+        return bool(self._calibrating.value)
+
+    @calibrating.setter
+    def calibrating(self, calibrating):
+        self._calibrating.value = int(calibrating)
+
+    @property
+    def stats(self):
+        return dict(zip(self.stat_names, self._stats))
+
+    @stats.setter
+    def stats(self, stats):
+        self._stats[:] = [float(stats.get(name, 0.0)) for name in self.stat_names]
+
+    def fail(self, msg):
+        """ Set error state with message, for the other side to find. """
+        self.error = msg
+        self.state = 'error'
 
 
 class Writer:
@@ -44,16 +132,56 @@ class Writer:
     destination = None
     writer = None
     size = None
+    # downscaled tracking stream with overlay, recorded alongside if given
+    tracking_writer = None
+    tracking_size = None
+    # keeps recent frames and writes clips around triggers instead of
+    # recording everything, if given
+    clip_recorder = None
     alive = True
     recording = False
-    ts_last = time.clock()
+    ts_last = None
+    heartbeat = 0
     video_logger = None
 
+    # frames written before checking the pipe for commands again
+    batch_size = 16
+    # wait on the queue alone if the handles can't be selected, checking
+    # the pipe in between
+    fallback_interval = 0.05
+    # seconds between statistics updates in the shared status, and between
+    # throughput reports in the log
+    stats_interval = 1.0
+    log_interval = 10.0
+
     def __init__(self, fps=None, size=None, queue=None, pipe=None, *args, **kwargs):
         logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
         self.log = logging.getLogger(__name__)
         self.queue = queue
         self.pipe = pipe
+        self.ts_last = time.time()
+        # shared with Spotter, a private one if running on its own
+        self.status = kwargs['status'] if 'status' in kwargs else WriterStatus()
+
+        # select takes pipes only on POSIX, the queue handle is its reader end
+        self.handles = None
+        if os.name == 'posix':
+            try:
+                self.handles = [self.pipe.fileno(), self.queue._reader.fileno()]
+            except (AttributeError, IOError, OSError), error:
+                self.log.debug('Can not wait on handles: %s', error)
+        # item taken off the queue by the fallback wait
+        self.backlog = []
+
+        # throughput since the last report
+        self.ts_stats = time.time()
+        self.ts_log = time.time()
+        self.n_written = 0
+        self.bytes_written = 0
+        self.t_writing = 0.0
+        self.max_write = 0.0
+        self.max_batch = 0
+        self.max_queued = 0
 
         # Only important if lower than what camera can provide, or for videos
         try:
@@ -68,15 +196,43 @@ class Writer:
         except TypeError:
             pass
 
-        self.codec = kwargs['codec'] if 'codec' in kwargs else self.codecs[0]
+        # results of the codecs at the size of the recording, None while
+        # not measured yet
+        self.calibration = None
+        self.calibration_thread = None
+        # size to calibrate once the recording stops
+        self.calibration_due = None
+        self.configure(kwargs.get('codec', self.codecs[0]), kwargs.get('encoders', 0),
+                       kwargs.get('segment_length', 300))
+        # calibrate for the camera frame size while nothing is recorded yet
+        if self.auto_codec and self.size is not None and \
+                calibration.cached(self.codecs, self.size, self.fps) is None:
+            self.calibrate_background(self.size)
         self.log.info('Starting loop with size %s', str(size))
         self.loop()
 
-    def start(self, parameters):  # dst=None, size=None
+    def configure(self, codec, encoders, segment_length):
+        """ Codec, encoder processes and frames per segment of the next recording. """
+        self.options = (codec.upper(), encoders, segment_length)
+        self.codec = codec.upper()
+        # pick the codec by measuring the candidates, done once per machine
+        # and frame size
+        self.auto_codec = self.codec == calibration.AUTO
+        if self.auto_codec:
+            self.codec = self.codecs[0]
+        # more than zero encoders record segments, encoded in parallel
+        self.encoders = encoders
+        self.segment_length = segment_length
+        if encoders and encoders >= multiprocessing.cpu_count():
+            self.log.warning('%d encoders on %d CPUs, segmented recording is slower than a single writer '
+                             'without cores to spare', encoders, multiprocessing.cpu_count())
+
+    def start(self, parameters):  # dst=None, size=None, tracking_size=None, clip=None, options=None
         if len(parameters) >= 1:
             size = parameters[1]
             if size is None:
                 self.log.error('Video size not specified.')
+                self.status.fail('Video size not specified')
                 return
             else:
                 self.size = size
@@ -84,22 +240,47 @@ class Writer:
         if len(parameters) >= 2:
             dst = parameters[2]
 
-        # check if output file exists
+        self.tracking_size = parameters[3] if len(parameters) >= 4 else None
+        # (seconds before, seconds after) triggers
+        clip = parameters[4] if len(parameters) >= 5 else None
+        # codec, encoders and segment length, if changed since the last one
+        if len(parameters) >= 6 and parameters[5]:
+            options = (parameters[5]['codec'].upper(), parameters[5]['encoders'], parameters[5]['segment_length'])
+            if options != self.options:
+                self.configure(*options)
+
         if dst is None:
-            dst = 'recordings/' + utils.time_string() + '.avi'
+            dst = 'recordings/%date.avi'
 
-        destination = utils.dst_file_name(dst)
-        if os.path.isfile(destination) and not OVERWRITE:
-            self.log.error('Destination file %s exists.', destination)
-            return
+        # next free name for all files of the recording, no existing file
+        # is overwritten
+        if OVERWRITE:
+            destination = utils.expand_tokens(dst, 1)
+        else:
+            try:
+                destination = utils.dst_file_name(dst, self.paired_files)
+            except (IOError, OSError), error:
+                self.log.error('Could not create destination file %s: %s', dst, error)
+                self.status.fail('Could not create destination file %s: %s' % (dst, error))
+                return
         self.destination = destination
+        if self.auto_codec:
+            self.calibrate(self.size)
 
         self.log.info('Start recording: %s fps, %s, %s', str(self.fps), str(self.size), self.destination)
 
         # VideoWriter object
-        cc = list(self.codec)
-        self.writer = cv2.VideoWriter(filename=self.destination, fourcc=cv2.cv.CV_FOURCC(cc[0], cc[1], cc[2], cc[3]),
-                                      fps=self.fps, frameSize=self.size, isColor=True)
+        if clip is not None:
+            self.clip_recorder = clips.ClipRecorder(self.destination, clip[0], clip[1], self.fps,
+                                                    lambda path: self.open_writer(path, self.size),
+                                                    self.clip_files)
+            # stands in for the writer, frames are only written in clips
+            self.writer = self.clip_recorder
+            self.tracking_size = None
+        else:
+            self.writer = self.open_writer(self.destination, self.size, self.encoders)
+        if self.tracking_size is not None:
+            self.tracking_writer = self.open_writer(self.tracking_path(self.destination), self.tracking_size)
 
         self.video_logger = logging.getLogger(destination)
         self.video_logger.handlers = []
@@ -109,9 +290,96 @@ class Writer:
 
         self.video_logger.info('Start recording: %s fps, %s, %s, %s',
                                str(self.fps), str(self.size), self.codec, self.destination)
+        if self.auto_codec and self.calibration is not None:
+            self.video_logger.info('Codec %s selected by calibration at %s fps', self.codec, str(self.fps))
+            for codec in self.codecs:
+                self.video_logger.info('    %s', calibration.describe(codec, self.calibration[codec]))
+        elif self.auto_codec:
+            self.video_logger.info('Codec %s used, codecs are not calibrated at this size yet', self.codec)
+        if clip is not None:
+            self.video_logger.info('Recording clips from %.1f s before to %.1f s after triggers', *clip)
 
         self.log.debug('Recording running...')
         self.recording = True
+        self.status.state = 'recording'
+
+    def trigger(self, timestamp, description):
+        """ Start or extend a clip, if recording clips. """
+        if self.clip_recorder is None or not self.recording:
+            return
+        n = self.clip_recorder.trigger(timestamp, description)
+        if n is not None:
+            self.video_logger.info('Clip %d triggered at %.3f by %s', n, timestamp, description)
+
+    @staticmethod
+    def tracking_path(destination):
+        base, ext = os.path.splitext(destination)
+        return base + '_tracking' + ext
+
+    def paired_files(self, destination):
+        """
+        Files a recording to destination may create, in any mode. The log
+        comes first, it is the one written by every mode.
+        """
+        return [destination + '.log', destination, self.tracking_path(destination),
+                rawvideo.index_path(destination), segments.index_path(destination),
+                clips.clip_path(destination, 1)]
+
+    def clip_files(self, path):
+        """ Files of a clip to path, first the one its writer creates. """
+        if self.codec == rawvideo.CODEC:
+            return [rawvideo.index_path(path), path]
+        return [path, rawvideo.index_path(path)]
+
+    def calibrate(self, size):
+        """
+        Select the codec giving the smallest files that still keeps up at
+        this size. Measuring takes seconds per codec, so a recording at a
+        size not calibrated yet keeps the codec selected before, and the
+        codecs are measured once it stopped, not to delay or disturb it.
+        """
+        self.calibration = calibration.cached(self.codecs, size, self.fps)
+        if self.calibration is None:
+            self.log.info('Codecs not calibrated at %dx%d yet, using %s', size[0], size[1], self.codec)
+            self.calibration_due = size
+            return
+        codec = calibration.select(self.calibration, self.fps)
+        if codec is None:
+            self.log.error('No codec available, trying %s', self.codecs[0])
+            codec = self.codecs[0]
+        if codec != self.codec:
+            self.log.info('Selected codec %s for %dx%d at %s fps', codec, size[0], size[1], str(self.fps))
+        self.codec = codec
+
+    def calibrate_background(self, size):
+        """
+        Measure the codecs at this size in a thread, shown in the status
+        meanwhile. False if another calibration is still running.
+        """
+        if self.calibration_thread is not None and self.calibration_thread.is_alive():
+            return False
+
+        def measure():
+            try:
+                calibration.calibrate(self.codecs, size, self.fps)
+            finally:
+                self.status.calibrating = False
+        self.status.calibrating = True
+        self.calibration_thread = threading.Thread(target=measure)
+        self.calibration_thread.daemon = True
+        self.calibration_thread.start()
+        return True
+
+    def open_writer(self, destination, size, encoders=0):
+        """ VideoWriter, or its stand-in for raw and segmented recordings. """
+        if self.codec == rawvideo.CODEC:
+            return rawvideo.RawWriter(destination, self.fps, size)
+        if encoders:
+            return segments.SegmentedWriter(destination, self.fps, size, self.codec,
+                                            encoders, self.segment_length)
+        cc = list(self.codec)
+        return cv2.VideoWriter(filename=destination, fourcc=cv2.cv.CV_FOURCC(cc[0], cc[1], cc[2], cc[3]),
+                               fps=self.fps, frameSize=size, isColor=True)
 
     def stop(self):
         self.destination = None
@@ -127,82 +395,210 @@ class Writer:
         if self.recording:
             self.close()
         self.recording = False
+        if self.status.state == 'recording':
+            self.status.state = 'idle'
+        self.status.stats = {}
+
+        if self.calibration_due is not None and self.calibrate_background(self.calibration_due):
+            self.calibration_due = None
 
     def write(self, item):
+        """
+        Item of frame index, timestamp, full resolution image, tracking
+        image or None, overlay markers and log messages. Markers are
+        (position, size, RGB color) drawn into the tracking image only.
+        """
         # TODO: Error handling of frame existence/content
-        frame = item[0]
-        messages = item[1]
+        index, timestamp, img, tracking_img, overlay, messages = item
 
         try:
-            assert self.size == (frame.img.shape[1], frame.img.shape[0])
+            assert self.size == (img.shape[1], img.shape[0])
         except AssertionError:
             self.log.error('Frame size not correct!')
-            self.log.debug('Frame shape: %s, expected: %s', str(frame.img.shape), str(self.size))
+            self.log.debug('Frame shape: %s, expected: %s', str(img.shape), str(self.size))
             self.stop()
+            self.status.fail('Frame size %s, expected %s' % (str(img.shape[1::-1]), str(self.size)))
+            return
 
+        t = time.time()
         for m in messages:
             self.video_logger.info(m)
-        self.writer.write(frame.img)
+        self.write_image(self.writer, img, index, timestamp)
+        if self.tracking_writer is not None and tracking_img is not None:
+            # unpickled copy of the writer process, free to draw on
+            for position, size, color in overlay or []:
+                utils.drawCross(tracking_img, tuple(int(c) for c in position), size,
+                                tuple(int(255*c) for c in reversed(color[:3])), gap=3)
+            self.write_image(self.tracking_writer, tracking_img, index, timestamp)
+        dt = time.time() - t
+        self.t_writing += dt
+        self.max_write = max(self.max_write, dt)
+        self.n_written += 1
+        self.bytes_written += img.nbytes
+        self.status.count(img.nbytes)
+
+    @staticmethod
+    def write_image(writer, img, index, timestamp):
+        if isinstance(writer, clips.ClipRecorder):
+            writer.add(img, index, timestamp)
+        elif isinstance(writer, rawvideo.RawWriter):
+            writer.write(img, index, timestamp)
+        else:
+            writer.write(img)
 
     def loop(self):
-        """Writes frames from the queue. If alive flag set to
-        false, deletes capture object to allow proper exit
+        """Writes frames from the queue as they arrive, blocking while there
+        is nothing to do. A None item in the queue or the terminate command
+        ends the loop, closing the capture object to allow proper exit.
         """
-        # FIXME: The interface initialization can take longer than the timeout on the writer!
-        while 42 and self.alive:
-            # Process should terminate if not being talked to for a while
-            #self.log.debug("Alive signal timeout: %s", str(time.clock() - self.ts_last))
-            if time.clock() - self.ts_last > STILL_ALIVE_TIMEOUT:
+        self.status.state = 'idle'
+        while self.alive:
+            # Process should terminate if not being talked to for a while,
+            # allowing for a slow start of the interface
+            heartbeat = self.status.heartbeat
+            if heartbeat != self.heartbeat:
+                self.heartbeat = heartbeat
+                self.ts_last = time.time()
+            timeout = STILL_ALIVE_TIMEOUT if self.heartbeat else STARTUP_TIMEOUT
+            remaining = timeout - (time.time() - self.ts_last)
+            if remaining <= 0:
                 self.log.error("Alive signal timed out")
+                self.status.fail('Heartbeat timed out')
                 self.close()
                 sys.exit(0)
 
+            self.wait(min(remaining, HEARTBEAT_INTERVAL))
+            self.receive()
+            self.drain()
+            self.report()
+
+        # Close writer upon termination signal
+        self.close()
+
+    def wait(self, timeout):
+        """ Block until the pipe or the queue has something, or timeout. """
+        if self.handles is not None:
             try:
-                new_pipe_msg = self.pipe.poll()
-            except Exception, error:
-                self.log.error(error)
-                new_pipe_msg = False
+                select.select(self.handles, [], [], timeout)
+                return
+            except (select.error, ValueError), error:
+                self.log.debug('Waiting on handles failed: %s', error)
+                self.handles = None
+        if not self.backlog:
+            try:
+                self.backlog.append(self.queue.get(timeout=min(timeout, self.fallback_interval)))
+            except Queue.Empty:
+                pass
 
-            if new_pipe_msg:
+    def receive(self):
+        """ Handle all commands waiting in the pipe. """
+        while self.alive:
+            try:
+                if not self.pipe.poll():
+                    return
                 # any command in the pipe will keep the process alive
                 full_message = self.pipe.recv()
-                cmd = full_message[0]
-                if len(full_message) > 1:
-                    msg = full_message[:]
-                else:
-                    msg = None
-                self.ts_last = time.clock()
-                if cmd == 'terminate':
-                    self.log.debug('Writer received termination signal')
-                    # don't close yet, first empty buffer!
+            except (EOFError, IOError), error:
+                self.log.error('Pipe closed: %s', error)
+                self.alive = False
+                return
+            cmd = full_message[0]
+            if len(full_message) > 1:
+                msg = full_message[:]
+            else:
+                msg = None
+            self.ts_last = time.time()
+            if cmd == 'terminate':
+                self.log.debug('Writer received termination signal')
+                # don't close yet, first empty buffer!
+                self.drain(None)
+                self.alive = False
+            elif cmd == 'stop':
+                self.log.debug('Writer received stop signal')
+                self.stop()
+            elif cmd == 'start':
+                self.log.debug('Writer received start signal with parameters: %s', str(msg))
+                self.start(msg)
+            elif cmd == 'trigger':
+                self.trigger(msg[1], msg[2])
+
+    def drain(self, batch_size=-1):
+        """ Write up to batch_size frames waiting in the queue, all if None. """
+        batch_size = self.batch_size if batch_size == -1 else batch_size
+        try:
+            self.max_queued = max(self.max_queued, self.queue.qsize())
+        except NotImplementedError:
+            # no sem_getvalue on OS X
+            pass
+        n = 0
+        while batch_size is None or n < batch_size:
+            if self.backlog:
+                item = self.backlog.pop(0)
+            else:
+                try:
+                    item = self.queue.get_nowait()
+                except Queue.Empty:
+                    break
+                except (EOFError, IOError), error:
+                    self.log.error('Queue closed: %s', error)
                     self.alive = False
-                elif cmd == 'stop':
-                    self.log.debug('Writer received stop signal')
-                    self.stop()
-                elif cmd == 'start':
-                    self.log.debug('Writer received start signal with parameters: %s', str(msg))
-                    self.start(msg)
-                elif cmd == 'alive':
-                    pass
-
-            while not self.queue.empty():
-                item = self.queue.get()
-
-                if self.writer and self.recording:
-                    self.write(item)
-
-            # refresh time to keep CPU utilization down
-            time.sleep(0.01)
-
-        # Close writer upon termination signal
-        if not self.alive:
-            self.close()
+                    break
+
+            # sentinel, everything before it has been written
+            if item is None:
+                self.log.debug('Writer received end of queue')
+                self.alive = False
+                break
+            n += 1
+            if self.writer and self.recording:
+                self.write(item)
+        self.max_batch = max(self.max_batch, n)
+
+    def report(self):
+        """
+        Put throughput, write latency and queue occupancy of the last
+        stats_interval seconds into the shared status while recording.
+        """
+        dt = time.time() - self.ts_stats
+        if dt < self.stats_interval:
+            return
+        if self.recording:
+            stats = {'fps': self.n_written / dt,
+                     'mbps': self.bytes_written / dt / 1e6,
+                     'latency': self.t_writing / self.n_written if self.n_written else 0.0,
+                     'max_latency': self.max_write,
+                     'queued': self.max_queued}
+            self.status.stats = stats
+            if self.n_written and time.time() - self.ts_log >= self.log_interval:
+                self.ts_log = time.time()
+                self.log.info('Writing %.1f fps, %.1f MB/s, %.2f ms/frame (max %.2f), '
+                              'up to %d frames queued, batches up to %d', stats['fps'], stats['mbps'],
+                              stats['latency']*1000, stats['max_latency']*1000, stats['queued'],
+                              self.max_batch)
+        self.ts_stats = time.time()
+        self.n_written = 0
+        self.bytes_written = 0
+        self.t_writing = 0.0
+        self.max_write = 0.0
+        self.max_batch = 0
+        self.max_queued = 0
 
     def close(self):
         self.log.debug('Closing writer')
+        if not self.alive and self.status.state != 'error':
+            self.status.state = 'closed'
+        for writer in (self.writer, self.tracking_writer):
+            if isinstance(writer, (segments.SegmentedWriter, rawvideo.RawWriter)):
+                # waits for the encoders to finish their segments, or writes
+                # out the last buffered raw frames
+                writer.release()
+        if self.clip_recorder is not None:
+            self.clip_recorder.close()
+            self.clip_recorder = None
         if self.writer is not None:
             del self.writer
             self.writer = None
+        self.tracking_writer = None
 
 
 #############################################################
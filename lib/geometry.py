@@ -142,6 +142,97 @@ def seg_intersect(a1, a2, b1, b2):
         return (num / denom)*db + b1
 
 
+def segments_intersect(a1, a2, b1, b2):
+    """Vectorized version of seg_intersect for arrays of segments a1-a2 and
+    b1-b2 (points along the last axis), broadcast against each other. Bounded
+    to the segments, parallel segments never intersect. Returns boolean array
+    of intersections, and the side of segment b the point a2 ends up on:
+    1 if the cross product of b and a2 - b1 is positive, -1 if negative.
+    """
+    a1, a2, b1, b2 = [np.asarray(p, dtype=float) for p in (a1, a2, b1, b2)]
+    da = a2 - a1
+    db = b2 - b1
+    dp = a1 - b1
+    denom = da[..., 0]*db[..., 1] - da[..., 1]*db[..., 0]
+    num_a = db[..., 0]*dp[..., 1] - db[..., 1]*dp[..., 0]
+    num_b = da[..., 0]*dp[..., 1] - da[..., 1]*dp[..., 0]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ua = num_a / denom
+        ub = num_b / denom
+        hit = (denom != 0) & (ua >= 0) & (ua <= 1) & (ub >= 0) & (ub <= 1)
+
+    de = a2 - b1
+    side = np.sign(db[..., 0]*de[..., 1] - db[..., 1]*de[..., 0]).astype(int)
+    return hit, side
+
+
+def segments_near_points(a1, a2, points, radii):
+    """Vectorized test if segments a1-a2 pass within radii of points,
+    broadcast against each other.
+    """
+    a1, a2, points = [np.asarray(p, dtype=float) for p in (a1, a2, points)]
+    da = a2 - a1
+    length = (da**2).sum(axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = ((points - a1)*da).sum(axis=-1) / length
+    t = np.where(length > 0, np.clip(t, 0.0, 1.0), 0.0)
+    closest = a1 + t[..., np.newaxis]*da
+    return ((points - closest)**2).sum(axis=-1) <= np.asarray(radii)**2
+
+
+def linear_assignment(cost):
+    """Optimal assignment of rows to columns of a cost matrix, minimizing the
+    summed cost. Hungarian method with row and column potentials, O(n^2*m) for
+    n <= m. Rectangular matrices leave surplus rows or columns unassigned.
+    Returns list of (row, column) tuples.
+    """
+    cost = np.asarray(cost, dtype=float)
+    if not cost.size:
+        return []
+    transposed = cost.shape[0] > cost.shape[1]
+    if transposed:
+        cost = cost.T
+    n, m = cost.shape
+
+    # potentials and matching are 1-indexed, column 0 is the virtual start
+    u = np.zeros(n+1)
+    v = np.zeros(m+1)
+    match = np.zeros(m+1, int)
+    way = np.zeros(m+1, int)
+    for i in xrange(1, n+1):
+        match[0] = i
+        j0 = 0
+        min_v = np.empty(m+1)
+        min_v.fill(np.inf)
+        used = np.zeros(m+1, bool)
+        while True:
+            used[j0] = True
+            reduced = cost[match[j0]-1] - u[match[j0]] - v[1:]
+            free = ~used[1:]
+            better = free & (reduced < min_v[1:])
+            min_v[1:][better] = reduced[better]
+            way[1:][better] = j0
+            candidates = np.where(free, min_v[1:], np.inf)
+            j1 = int(np.argmin(candidates)) + 1
+            delta = candidates[j1-1]
+            u[match[used]] += delta
+            v[used] -= delta
+            min_v[~used] -= delta
+            j0 = j1
+            if match[j0] == 0:
+                break
+        # augmenting path
+        while j0:
+            j1 = way[j0]
+            match[j0] = match[j1]
+            j0 = j1
+
+    pairs = [(match[j]-1, j-1) for j in xrange(1, m+1) if match[j]]
+    if transposed:
+        pairs = [(c, r) for r, c in pairs]
+    return sorted(pairs)
+
+
 def point_in_poly(point, poly):
     """Improved point in polygon test which includes edge and vertex points
     From: http://geospatialpython.com/2011/08/point-in-polygon-2-on-line.html
@@ -59,8 +59,11 @@ class GLFrame(QtOpenGL.QGLWidget):
 
         # draw crosses
         for l in self.spotter.tracker.leds:
-            if l.pos_hist[-1] is not None and l.marker_visible:
-                self.jobs.append([self.drawCross, l.pos_hist[-1], 14, l.lblcolor])
+            if not l.marker_visible:
+                continue
+            for position in l.positions:
+                if position is not None:
+                    self.jobs.append([self.drawCross, position, 14, l.lblcolor])
 
         # draw search windows if adaptive tracking is used:
         if self.spotter.tracker.adaptive_tracking:
@@ -93,6 +96,8 @@ class GLFrame(QtOpenGL.QGLWidget):
                         self.jobs.append([self.drawCircle, s.points, color])
                     elif s.shape == "line":
                         self.jobs.append([self.drawLine, s.points, color])
+                    elif s.shape == "polygon":
+                        self.jobs.append([self.drawPolygon, s.points, color])
 
         self.updateGL()
 
@@ -283,6 +288,14 @@ class GLFrame(QtOpenGL.QGLWidget):
         GL.glRectf(points[0][0]*1.0/self.width, points[0][1]*1.0/self.height,
                    points[1][0]*1.0/self.width, points[1][1]*1.0/self.height)
 
+    def drawPolygon(self, points, color):
+        """ Draws a filled polygon. GL only fills convex polygons properly. """
+        GL.glColor(*color)
+        GL.glBegin(GL.GL_POLYGON)
+        for p in points:
+            GL.glVertex(p[0]*1.0/self.width, p[1]*1.0/self.height, 0.0)
+        GL.glEnd()
+
     def drawBox(self, points, color):
         if points is None:
             return
@@ -152,16 +152,27 @@ class SideBar(QtGui.QWidget, Ui_side_bar):
             template = self.parent.template_default['FEATURES'][key]
             label = 'LED_' + str(len(self.spotter.tracker.leds))
 
-        if not template['type'].lower() == 'led':
-            return
-        else:
+        feature_type = template['type'].lower()
+        if feature_type in ['led', 'sat']:
             range_hue = map(int, template['range_hue'])
             range_sat = map(int, template['range_sat'])
             range_val = map(int, template['range_val'])
             range_area = map(int, template['range_area'])
             fixed_pos = template.as_bool('fixed_pos')
-            feature = self.spotter.tracker.add_led(label, range_hue, range_sat, range_val,
-                                                  range_area, fixed_pos)
+            if feature_type == 'led':
+                feature = self.spotter.tracker.add_led(label, range_hue, range_sat, range_val,
+                                                      range_area, fixed_pos, identities=int(template['identities']))
+            else:
+                feature = self.spotter.tracker.add_saturated(label, range_hue, range_sat, range_val,
+                                                            range_area, fixed_pos)
+        elif feature_type == 'motion':
+            range_val = map(int, template['range_val'])
+            range_area = map(int, template['range_area'])
+            fixed_pos = template.as_bool('fixed_pos')
+            feature = self.spotter.tracker.add_motion(label, range_val, range_area, fixed_pos,
+                                                     identities=int(template['identities']))
+        else:
+            return
         self.features_page.add_item(feature, focus_new)
 
     ###############################################################################
@@ -311,6 +322,8 @@ class SideBar(QtGui.QWidget, Ui_side_bar):
         color = template['color']
 
         region = self.spotter.tracker.add_roi(shape_list, label, color, magnetic_objects)
+        region.enter_frames = template['enter_frames']
+        region.exit_frames = template['exit_frames']
         self.regions_page.add_item(region, focus_new)
 
     ###############################################################################
@@ -34,4 +34,19 @@ class StatusBar(QtGui.QWidget, Ui_statusBar):
                 self.lbl_fps.setStyleSheet(' QLabel {color: red}')
             else:
                 self.fps_low = False
-                self.lbl_fps.setStyleSheet(' QLabel {color: black}')
\ No newline at end of file
+                self.lbl_fps.setStyleSheet(' QLabel {color: black}')
+
+    def update_writer(self, stats, queue_size, dropped, calibrating=False):
+        """
+        Writer statistics while recording, red when frames were dropped, and
+        whether codecs are being calibrated.
+        """
+        if stats is None:
+            text = 'Calibrating codecs' if calibrating else ''
+            if self.lbl_writer.text() != text:
+                self.lbl_writer.setText(text)
+            return
+        self.lbl_writer.setText('REC {:.1f} fps, {:.1f} MB/s, {:.1f} ms, queue {:d}/{:d}, dropped {:d}{}'.format(
+            stats['fps'], stats['mbps'], stats['latency']*1000, int(stats['queued']), queue_size, dropped,
+            ', calibrating codecs' if calibrating else ''))
+        self.lbl_writer.setStyleSheet(' QLabel {color: red}' if dropped else ' QLabel {color: black}')
@@ -58,6 +58,8 @@ class Tab(QtGui.QWidget, Ui_tab_serial):
                 self.btn_serial_connect.setChecked(True)
             # Human readable values of bytes sent/received
             tx = utils.binary_prefix(self.serial.bytes_tx())
+            if self.serial.bytes_suppressed():
+                tx += ' (%s saved)' % utils.binary_prefix(self.serial.bytes_suppressed())
             rx = utils.binary_prefix(self.serial.bytes_rx())
             self.lbl_bytes_sent.setText(tx)
             self.lbl_bytes_received.setText(rx)
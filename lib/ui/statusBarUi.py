@@ -47,6 +47,10 @@ class Ui_statusBar(object):
         self.horizontalLayout_2.addWidget(self.sb_offset)
         spacerItem = QtGui.QSpacerItem(40, 20, QtGui.QSizePolicy.Expanding, QtGui.QSizePolicy.Minimum)
         self.horizontalLayout_2.addItem(spacerItem)
+        self.lbl_writer = QtGui.QLabel(statusBar)
+        self.lbl_writer.setText(_fromUtf8(""))
+        self.lbl_writer.setObjectName(_fromUtf8("lbl_writer"))
+        self.horizontalLayout_2.addWidget(self.lbl_writer)
 
         self.retranslateUi(statusBar)
         QtCore.QMetaObject.connectSlotsByName(statusBar)
@@ -57,4 +61,5 @@ class Ui_statusBar(object):
         self.lbl_fps.setText(_translate("statusBar", "FPS: 100.0", None))
         self.sb_offset.setToolTip(_translate("statusBar", "Bias GUI refresh interval", None))
         self.sb_offset.setSuffix(_translate("statusBar", " ms", None))
+        self.lbl_writer.setToolTip(_translate("statusBar", "Video writer: frames and megabytes written per second, write time per frame, queued and dropped frames.", None))
 
@@ -12,6 +12,8 @@ import cv2
 import math
 import time
 import re
+import os
+import errno
 import platform
 
 os_str = platform.system().lower()
@@ -231,17 +233,103 @@ def drawCross(frame, coords, size, color, gap=7):
     cv2.line(frame, (x, y + size + gap), (x, y + gap), color, 1)
 
 
-def dst_file_name(destination):
+# next iterator value to try per file name template, saves probing the
+# numbers already taken again
+_next_iterator = {}
+
+DATE_FIELDS = (('YYYY', '%Y'), ('YY', '%y'), ('MM', '%m'), ('DD', '%d'),
+               ('hh', '%H'), ('mm', '%M'), ('ss', '%S'))
+
+
+def expand_date(match):
+    """ strftime of the FORMAT of a %date-FORMAT token, time_string without. """
+    if not match.group(1):
+        return time_string()
+    fmt = match.group(1)
+    for field, directive in DATE_FIELDS:
+        fmt = fmt.replace(field, directive)
+    return time.strftime(fmt, time.localtime())
+
+
+def expand_tokens(destination, iterator=None):
+    """
+    File name template with date and fixed string tokens replaced, and
+    iterator tokens as well if a number is given.
+    """
+    template = re.sub(r'%date(?:-([YMDhms]+))?', expand_date, destination).replace('$', '')
+    if iterator is not None:
+        template = re.sub(r'%iterator(\d*)', lambda m: str(iterator).zfill(int(m.group(1) or 1)), template)
+    return template
+
+
+def claim_file_name(paths):
+    """
+    Atomically create the first of the paths, if none of them exist. The
+    file stays as placeholder for whoever writes it.
+    """
+    if any(os.path.exists(p) for p in paths[1:]):
+        return False
+    directory = os.path.dirname(paths[0])
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    try:
+        os.close(os.open(paths[0], os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except OSError, error:
+        if error.errno == errno.EEXIST:
+            return False
+        raise
+    return True
+
+
+def first_free_iterator(name, paired):
+    """ Lowest free number after a run of taken ones, without listing the directory. """
+    def taken(n):
+        return any(os.path.exists(p) for p in paired(name(n)))
+    if not taken(1):
+        return 1
+    high = 2
+    while taken(high):
+        high *= 2
+    low = high // 2
+    while high - low > 1:
+        middle = (low + high) // 2
+        if taken(middle):
+            low = middle
+        else:
+            high = middle
+    return high
+
+
+def dst_file_name(destination, paired=None):
     """ Allows to automatically generate the output file name from tokens:
-        %date-FORMAT        FORMAT as YYYYMMDDhhmmss
-        %iterator           If file with base till this point exists, iterate
+        %date-FORMAT        FORMAT as YYYYMMDDhhmmss, %date alone as time_string
+        %iteratorN          Lowest free number, zero padded to N digits
         $fixedString        $Animal52
+    The name is claimed by creating the first file paired(name) returns,
+    the others must not exist. Without %iterator token, one is appended to
+    names already taken. Never returns the name of an existing file.
     """
-    # TODO: Destination file name generation
-    if destination is 'None':
+    if destination is None or destination == 'None':
         return None
-    else:
-        return destination
+    if paired is None:
+        paired = lambda n: [n]
+
+    template = expand_tokens(destination)
+    match = re.search(r'%iterator(\d*)', template)
+    if match is None:
+        if claim_file_name(paired(template)):
+            return template
+        base, ext = os.path.splitext(template)
+        template = base + '_%iterator3' + ext
+        match = re.search(r'%iterator(\d*)', template)
+
+    width = int(match.group(1) or 1)
+    name = lambda n: template[:match.start()] + str(n).zfill(width) + template[match.end():]
+    n = _next_iterator.get(template) or first_free_iterator(name, paired)
+    while not claim_file_name(paired(name(n))):
+        n += 1
+    _next_iterator[template] = n + 1
+    return name(n)
 
 
 def binary_prefix(n_bytes):
@@ -17,13 +17,14 @@ Options:
     -S --Serial         Serial port to uC [default: None]
     -o --outfile DST    Path to video out file [default: None]
     -d --dims DIMS      Frame size [default: 640x360]
+    -t --template TEMPLATE  Template loaded at startup, its settings
+                        apply before the serial link is opened
     -D --DEBUG          Verbose output
 
-To do:
-    - destination file name may consist of tokens to automatically create,
-      i.e., %date%now%iterator3$fixedstring
-    - track low res, but store full resolution
-    - can never overwrite a file
+Destination file names may consist of tokens, e.g.
+    $rat12_%date-YYYYMMDD_%iterator3.avi
+for a date, the next free number and fixed strings. Existing files are
+never overwritten.
 
 #Example:
     --source 0 --outfile test.avi --size=320x200 --fps=30
@@ -70,8 +71,15 @@ class Main(QtGui.QMainWindow):
         self.ui = Ui_MainWindow()
         self.ui.setupUi(self)
 
+        # Settings of the default template, or of the one given, are needed
+        # before the serial link is opened
+        template_path = kwargs.pop('template', None)
+        default_path = os.path.join(os.path.abspath(DIR_CONFIG), DEFAULT_TEMPLATE)
+        self.template_default = self.parse_config(default_path, True)
+        template = self.parse_config(template_path) if template_path else None
+
         # Spotter main class, handles Grabber, Writer, Tracker, Chatter
-        self.__spotter_ref = Spotter(*args, **kwargs)
+        self.__spotter_ref = Spotter(settings=template or self.template_default, *args, **kwargs)
 
         # Status Bar
         self.status_bar = StatusBar(self)
@@ -116,8 +124,8 @@ class Main(QtGui.QMainWindow):
         self.gl_frame.sig_event.connect(self.mouse_event_to_tab)
 
         # Loading template list in folder
-        default_path = os.path.join(os.path.abspath(DIR_CONFIG), DEFAULT_TEMPLATE)
-        self.template_default = self.parse_config(default_path, True)
+        if template is not None:
+            self.load_config(template_path)
         #list_of_files = [f for f in os.listdir(DIR_TEMPLATES) if f.lower().endswith('ini')]
 
         # Main Window states
@@ -166,6 +174,8 @@ class Main(QtGui.QMainWindow):
         # based on stopwatch, show GUI refresh rate
         #self.log.debug("Updating GUI refresh rate display")
         self.status_bar.update_fps(elapsed)
+        self.status_bar.update_writer(self.spotter.writer_stats, self.spotter.writer_queue_size,
+                                      self.spotter.n_frames_dropped, self.spotter.writer_calibrating)
 
     def adjust_refresh_rate(self, forced=None):
         """
@@ -341,6 +351,10 @@ class Main(QtGui.QMainWindow):
                                          abs_pos=abs_pos,
                                          focus_new=False)
 
+            # reconnects if the baud rate changed, or to the last port of
+            # the template if not connected
+            self.spotter.configure(template)
+
     def save_config(self, filename=None, directory=DIR_TEMPLATES):
         """ Store a full set of configuration to file. """
         config = configobj.ConfigObj(indent_type='    ')
@@ -362,12 +376,13 @@ class Main(QtGui.QMainWindow):
         # Features
         config['FEATURES'] = {}
         for f in self.spotter.tracker.leds:
-            section = {'type': 'LED',
+            section = {'type': f.feature_type,
                        'range_hue': f.range_hue,
                        'range_sat': f.range_sat,
                        'range_val': f.range_val,
                        'range_area': f.range_area,
-                       'fixed_pos': f.fixed_pos}
+                       'fixed_pos': f.fixed_pos,
+                       'identities': f.identities}
             config['FEATURES'][str(f.label)] = section
 
         # Objects
@@ -410,12 +425,30 @@ class Main(QtGui.QMainWindow):
                        'digital_out': True,
                        'digital_collision': [o[0].label for o in mo],
                        'pin_pref': [o[1] for o in mo],
-                       'color': r.active_color[0:3]}
+                       'color': r.active_color[0:3],
+                       'enter_frames': r.enter_frames,
+                       'exit_frames': r.exit_frames}
             config['REGIONS'][str(r.label)] = section
 
+        config['RECORDING'] = {}
+        config['RECORDING']['codec'] = self.spotter.writer_codec
+        config['RECORDING']['encoders'] = self.spotter.writer_encoders
+        config['RECORDING']['segment_length'] = self.spotter.segment_length
+        config['RECORDING']['clip_mode'] = self.spotter.clip_mode
+        config['RECORDING']['clip_pre'] = self.spotter.clip_pre
+        config['RECORDING']['clip_post'] = self.spotter.clip_post
+        config['RECORDING']['clip_events'] = list(self.spotter.clip_events)
+
+        config['MONITOR'] = {}
+        config['MONITOR']['address'] = self.spotter.monitor_address or ''
+        config['MONITOR']['rate'] = self.spotter.monitor_rate
+
         config['SERIAL'] = {}
         config['SERIAL']['auto'] = self.spotter.chatter.auto
-        config['SERIAL']['last_port'] = self.spotter.chatter.serial_port
+        config['SERIAL']['last_port'] = self.spotter.chatter.last_port or self.spotter.chatter.serial_port
+        config['SERIAL']['baud_rate'] = self.spotter.chatter.baud_rate
+        config['SERIAL']['dac_deadband'] = self.spotter.chatter.dac_deadband
+        config['SERIAL']['keep_alive'] = self.spotter.chatter.keep_alive
 
         # and finally
         config.write()
@@ -446,7 +479,7 @@ if __name__ == "__main__":                                  #
     # Frame size parameter string 'WIDTHxHEIGHT' to size tuple (WIDTH, HEIGHT)
     size = (640, 360) if not arg_dict['--dims'] else tuple(arg_dict['--dims'].split('x'))
 
-    main(source=arg_dict['--source'], size=size)
+    main(source=arg_dict['--source'], size=size, template=arg_dict['--template'])
 
     # Qt main window which instantiates spotter class with all parameters
     #main(source=arg_dict['--source'],
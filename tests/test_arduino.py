@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Framed serial protocol against an emulated board on a pseudo terminal.
+"""
+
+import time
+import unittest
+
+from lib.core import arduino, emulator
+
+
+class SilentSwitchBoard(emulator.BoardEmulator):
+    """ Switches protocol, but the first answer to the request gets lost. """
+    lost = False
+
+    def report(self, request, data):
+        if request == arduino.REPORT_PROTOCOL and not self.lost and data <= self.max_protocol:
+            self.lost = True
+            self.protocol = data
+            return
+        emulator.BoardEmulator.report(self, request, data)
+
+
+class DeafBoard(emulator.BoardEmulator):
+    """ Accepts framed protocols, but its acknowledgements never arrive. """
+    def write(self, msg):
+        if isinstance(msg, bytearray) and len(msg) == 3 and msg[0] == arduino.SYNC:
+            return
+        emulator.BoardEmulator.write(self, msg)
+
+
+class TestFramedProtocol(unittest.TestCase):
+    board_class = emulator.BoardEmulator
+    protocol = arduino.PROTOCOL_PACKED
+
+    def setUp(self):
+        self.board = self.board_class(protocol=self.protocol)
+        self.board.start()
+        self.device = arduino.Arduino(self.board.port)
+
+    def tearDown(self):
+        self.device.close()
+        self.board.stop()
+
+    def settle(self, timeout=2.0):
+        """ Until all frames are acknowledged. """
+        deadline = time.time() + timeout
+        while self.device.pending and time.time() < deadline:
+            self.device.wait_readable(0.01)
+            self.device.poll()
+
+    def set_dac(self, value):
+        self.device.send_instructions([[1, 0, value]])
+        deadline = time.time() + 1.0
+        while self.board.dac[0] != value and time.time() < deadline:
+            time.sleep(0.01)
+        return self.board.dac[0]
+
+
+class TestNegotiation(TestFramedProtocol):
+    def test_switch(self):
+        self.assertTrue(self.device.negotiate())
+        self.assertEqual(self.device.protocol_name, 'packed')
+        self.assertEqual(self.board.protocol, arduino.PROTOCOL_PACKED)
+        self.assertEqual(self.set_dac(1234), 1234)
+
+
+class TestNakResend(TestFramedProtocol):
+    def test_crc_error_resent(self):
+        self.assertTrue(self.device.negotiate((arduino.PROTOCOL_FRAMED,)))
+        write = self.device.sp.write
+
+        def corrupt_once(data):
+            self.device.sp.write = write
+            data = bytearray(data)
+            data[-1] ^= 0xFF
+            return write(data)
+
+        self.device.sp.write = corrupt_once
+        self.device.send_instructions([[1, 0, 777], [2, 1, 1]])
+        self.settle()
+        self.assertEqual(self.board.n_crc_errors, 1)
+        self.assertEqual(self.device.n_nak, 1)
+        self.assertEqual(self.device.n_retries, 1)
+        self.assertEqual(self.device.n_lost, 0)
+        self.assertEqual(self.device.pending, {})
+        self.assertEqual(self.board.dac[0], 777)
+        self.assertEqual(self.board.digital[1], 1)
+
+
+class TestLostSwitchAnswer(TestFramedProtocol):
+    board_class = SilentSwitchBoard
+
+    def test_confirmed_by_ping(self):
+        self.assertTrue(self.device.negotiate())
+        self.assertEqual(self.device.protocol_name, 'packed')
+        self.assertEqual(self.set_dac(2345), 2345)
+
+
+class TestUnacknowledged(TestFramedProtocol):
+    board_class = DeafBoard
+
+    def test_reverted(self):
+        self.assertFalse(self.device.negotiate())
+        self.assertEqual(self.device.protocol_name, 'legacy')
+        self.assertEqual(self.board.protocol, arduino.PROTOCOL_LEGACY)
+        self.assertEqual(self.set_dac(3456), 3456)
+
+
+class TestLegacyFirmware(TestFramedProtocol):
+    protocol = arduino.PROTOCOL_LEGACY
+
+    def test_stays_aligned(self):
+        self.assertFalse(self.device.negotiate())
+        self.assertEqual(self.device.protocol_name, 'legacy')
+        # pings and reverts left the command stream aligned
+        self.assertEqual(self.set_dac(1111), 1111)
+        self.assertEqual(self.set_dac(2222), 2222)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+Codec calibration cache.
+"""
+
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+from lib.core import calibration
+
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'codec_calibration.json')
+        self.result = {'fps': 100.0, 'cpu': 0.01, 'bytes': 1000.0}
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def store(self, results, host=None):
+        cache = calibration.load_cache(self.path)
+        cache.setdefault(host or socket.gethostname(), {})[calibration.cache_key((160, 120), 30)] = results
+        calibration.store_cache(cache, self.path)
+
+    def test_cached(self):
+        self.assertIsNone(calibration.cached(['XVID'], (160, 120), 30, self.path))
+        self.store({'XVID': self.result, 'IYUV': None})
+        self.assertEqual(calibration.cached(['XVID', 'IYUV'], (160, 120), 30, self.path),
+                         {'XVID': self.result, 'IYUV': None})
+        # every codec asked for has to be measured
+        self.assertIsNone(calibration.cached(['XVID', 'DIVX'], (160, 120), 30, self.path))
+        self.assertIsNone(calibration.cached(['XVID'], (320, 240), 30, self.path))
+
+    def test_other_machines(self):
+        self.store({'XVID': self.result}, 'other')
+        self.assertIsNone(calibration.cached(['XVID'], (160, 120), 30, self.path))
+
+    def test_store_replaces(self):
+        self.store({'XVID': self.result})
+        self.store({'XVID': None})
+        self.assertEqual(calibration.cached(['XVID'], (160, 120), 30, self.path), {'XVID': None})
+        # written through a temporary file, nothing of it is left
+        self.assertEqual(os.listdir(self.directory), ['codec_calibration.json'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+Clips around triggers, written raw to keep index and timestamp per frame.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from lib.core import clips, rawvideo
+
+
+class TestRawClips(unittest.TestCase):
+    fps = 10.
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.destination = os.path.join(self.directory, 'session.raw')
+        self.recorder = clips.ClipRecorder(self.destination, 0.5, 0.3, self.fps,
+                                           lambda path: rawvideo.RawWriter(path, self.fps, (16, 8)),
+                                           lambda path: [rawvideo.index_path(path), path])
+
+    def tearDown(self):
+        self.recorder.close()
+        shutil.rmtree(self.directory)
+
+    def feed(self, first, last):
+        for n in xrange(first, last):
+            self.recorder.add(np.full((8, 16, 3), n, np.uint8), n, n / self.fps)
+
+    def test_index_and_timestamp(self):
+        self.feed(0, 20)
+        n = self.recorder.trigger(1.95, 'test')
+        self.feed(20, 30)
+        self.recorder.close_clip()
+
+        self.assertEqual(self.recorder.path, clips.clip_path(self.destination, n))
+        capture = rawvideo.RawCapture(rawvideo.index_path(self.recorder.path))
+        indices = [int(capture.record(i)['index']) for i in xrange(capture.n_frames)]
+        # ring replay from 1.45 s, then live frames up to 2.25 s
+        self.assertEqual(indices, range(15, 23))
+        np.testing.assert_allclose(capture.timestamps(), np.arange(15, 23) / self.fps)
+        # frames after the trigger are written untouched
+        self.assertTrue((capture.frame(7) == 22).all())
+        capture.release()
+
+    def test_existing_clip_kept(self):
+        existing = rawvideo.index_path(clips.clip_path(self.destination, 1))
+        with open(existing, 'w') as f:
+            f.write('earlier session')
+        self.feed(0, 10)
+        self.recorder.trigger(0.95, 'test')
+        self.recorder.close_clip()
+        self.assertNotEqual(rawvideo.index_path(self.recorder.path), existing)
+        self.assertTrue(os.path.exists(rawvideo.index_path(self.recorder.path)))
+        with open(existing) as f:
+            self.assertEqual(f.read(), 'earlier session')
+
+
+if __name__ == '__main__':
+    unittest.main()
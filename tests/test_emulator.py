@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+Chatter sessions against the emulated board, for each serial protocol.
+"""
+
+import time
+import random
+import unittest
+
+from lib.core import arduino, chatter, emulator
+
+
+class ChatterSession(unittest.TestCase):
+    protocol = arduino.PROTOCOL_LEGACY
+    protocol_name = 'legacy'
+    n_dac = 2
+    n_digital = 4
+
+    def setUp(self):
+        random.seed(1)
+        self.board = emulator.BoardEmulator(n_dac=self.n_dac, n_digital=self.n_digital,
+                                            protocol=self.protocol)
+        self.board.start()
+        self.link = chatter.Chatter(None)
+        # only acknowledgements and resends may bring lost updates back
+        self.link.keep_alive = 0
+        self.link.dac_deadband = 0
+        self.assertTrue(self.link.auto_connect(self.board.port))
+
+    def tearDown(self):
+        self.link.close()
+        self.board.stop()
+
+    def plan(self, values):
+        """ Output plan of DAC 0, DAC 1 and digital 0 reading from values. """
+        getter = lambda i: values[i]
+        return [(None, 1, 0, getter, 0, None),
+                (None, 1, 1, getter, 1, None),
+                (None, 2, 0, getter, 2, None)]
+
+    def wait_for(self, condition, timeout=5.0):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+        return condition()
+
+    def test_connect(self):
+        self.assertEqual(self.link.serial_device.protocol_name, self.protocol_name)
+        self.assertEqual(len(self.link.pins('dac')), self.n_dac)
+        self.assertEqual(len(self.link.pins('digital')), self.n_digital)
+
+    def test_connection(self):
+        self.assertTrue(self.link.test_connection([1, 2, 3]))
+        # worker takes over again, pins are not fetched twice
+        self.assertIsNotNone(self.link.worker)
+        self.assertEqual(len(self.link.pins('dac')), self.n_dac)
+        self.link.update_pins(self.plan([10, 20, 1]))
+        self.assertTrue(self.wait_for(lambda: self.board.dac == [10, 20]))
+
+    def test_update_pins(self):
+        values = [0, 0, 0]
+        plan = self.plan(values)
+        for i in xrange(60):
+            values[:] = [(i * 37) % 4096, (i * 91) % 4096, (i // 10) % 2]
+            self.link.update_pins(plan)
+            time.sleep(0.005)
+        # the digital value may still be on its way in a resent frame
+        self.assertTrue(self.wait_for(lambda: self.board.dac == values[:2] and self.board.digital[0] == values[2]),
+                        (self.board.dac, self.board.digital, values))
+
+
+class StartupSettings(unittest.TestCase):
+    def setUp(self):
+        self.board = emulator.BoardEmulator()
+        self.board.start()
+        self.settings = {'auto': True, 'last_port': self.board.port, 'baud_rate': 57600,
+                         'dac_deadband': 0, 'keep_alive': 0}
+        self.link = None
+
+    def tearDown(self):
+        if self.link is not None:
+            self.link.close()
+        self.board.stop()
+
+    def test_last_port_first(self):
+        """ The port of the template answers, no other port is waited for. """
+        t = time.time()
+        self.link = chatter.Chatter(None, auto=True, settings=self.settings)
+        self.assertTrue(self.link.connected)
+        self.assertEqual(self.link.serial_port, self.board.port)
+        self.assertLess(time.time() - t, arduino.Arduino.boot_timeout)
+
+    def test_reconfigure(self):
+        self.link = chatter.Chatter(None, auto=True, settings=self.settings)
+        self.assertFalse(self.link.configure(self.settings))
+        # a working connection is kept as the one to remember
+        self.assertFalse(self.link.configure(dict(self.settings, last_port='COM3')))
+        self.assertEqual(self.link.last_port, self.board.port)
+        self.assertTrue(self.link.configure(dict(self.settings, baud_rate=115200)))
+
+
+class FramedSession(ChatterSession):
+    protocol = arduino.PROTOCOL_FRAMED
+    protocol_name = 'framed'
+
+    def settle(self, device, timeout=10.0):
+        deadline = time.time() + timeout
+        while device.pending and time.time() < deadline:
+            device.wait_readable(0.01)
+            device.poll()
+
+    def test_burst(self):
+        """ More frames than the sequence window, faster than the link. """
+        worker, self.link.worker = self.link.worker, None
+        worker.stop()
+        device = self.link.serial_device
+        for i in xrange(400):
+            device.send_instructions([[1, 0, i], [2, 1, i % 2]])
+        self.settle(device)
+        # answers queued behind the burst are not taken for time-outs, and
+        # a full window waits instead of dropping frames
+        self.assertEqual(device.n_timeouts, 0)
+        self.assertEqual(device.n_lost, 0)
+        self.assertEqual(self.board.n_frames, device.n_frames)
+        self.assertEqual(self.board.dac[0], 399)
+
+    def test_burst_corrupted(self):
+        """ Every update arrives, resent where corrupted. """
+        worker, self.link.worker = self.link.worker, None
+        worker.stop()
+        device = self.link.serial_device
+        self.board.corruption = 0.005
+        for i in xrange(300):
+            device.send_instructions([[1, 0, i], [1, 1, 4095 - i]])
+        self.settle(device)
+        self.assertGreater(self.board.n_crc_errors, 0)
+        self.assertEqual(device.n_lost, 0)
+        self.assertEqual(self.board.dac, [299, 3796])
+
+    def test_update_pins_corrupted(self):
+        self.board.corruption = 0.005
+        self.test_update_pins()
+        self.assertEqual(self.link.serial_device.n_lost, 0)
+
+    def test_lost_edge_resent(self):
+        """ A digital edge in a lost frame is sent again without keep-alive. """
+        device = self.link.serial_device
+        # every refused frame is given up on
+        device.max_retries = 0
+        self.board.corruption = 1.0
+        self.link.update_pins(self.plan([0, 0, 1]))
+        self.assertTrue(self.wait_for(lambda: device.n_lost > 0))
+        self.board.corruption = 0.0
+        self.assertTrue(self.wait_for(lambda: self.board.digital[0] == 1 and not device.pending))
+        self.assertEqual(self.link.worker.sent[(2, 0)], 1)
+
+
+class PackedSession(FramedSession):
+    protocol = arduino.PROTOCOL_PACKED
+    protocol_name = 'packed'
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Region events from debounced collisions and line crossings.
+"""
+
+import unittest
+
+from lib.core import tracker
+
+
+class TestRegionEvents(unittest.TestCase):
+    def setUp(self):
+        self.tracker = tracker.Tracker()
+        self.obj = self.tracker.add_ooi([], 'rat')
+        self.region = self.tracker.add_roi(None, 'box')
+        self.region.refresh_slot_list()
+
+    def collide(self, collision, frames, t0=0.0):
+        for n in xrange(frames):
+            self.region.collisions[self.obj] = collision
+            self.region.update_events(t0 + n)
+
+    def test_enter_exit(self):
+        self.collide(True, self.region.enter_frames)
+        self.assertEqual([e[0] for e in self.region.events], ['enter'])
+        self.assertTrue(self.region.occupied(self.obj))
+        self.collide(False, self.region.exit_frames, 10.0)
+        self.assertEqual([e[0] for e in self.region.events], ['exit'])
+        self.assertEqual(self.region.visits[self.obj], 1)
+
+    def test_hysteresis(self):
+        self.region.enter_frames = 2
+        self.region.exit_frames = 3
+        self.collide(True, 1)
+        self.assertFalse(self.region.occupied(self.obj))
+        self.collide(True, 1, 1.0)
+        self.assertTrue(self.region.occupied(self.obj))
+        self.collide(False, 2, 2.0)
+        self.assertTrue(self.region.occupied(self.obj))
+        self.collide(False, 1, 4.0)
+        self.assertFalse(self.region.occupied(self.obj))
+
+    def test_cross_details(self):
+        received = []
+        self.region.add_callback('cross', lambda *args: received.append(args))
+        shape = object()
+        self.region.crossings = [(self.obj, shape, -1)]
+        self.region.update_events(1.0)
+        self.assertEqual(received, [(self.region, self.obj, 1.0, shape, -1)])
+        self.assertEqual(self.region.events, [('cross', self.obj, 1.0, (shape, -1))])
+
+    def test_removed_object_forgotten(self):
+        self.collide(True, self.region.enter_frames)
+        self.tracker.remove_ooi(self.obj)
+        for state in (self.region.collisions, self.region.inside, self.region.pending,
+                      self.region.entered_at, self.region.visits):
+            self.assertNotIn(self.obj, state)
+        self.region.update_events(5.0)
+        self.assertEqual(self.region.events, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
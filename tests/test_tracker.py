@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+Tracking methods of feature types, and tracking under a degraded tick budget.
+"""
+
+import unittest
+
+import numpy as np
+
+from lib.core import tracker, budget
+from lib.core.grabber import Frame
+
+
+def green_spot(position, size=(320, 240)):
+    img = np.zeros((size[1], size[0], 3), np.uint8)
+    x, y = position
+    img[y-5:y+5, x-5:x+5] = (0, 255, 0)
+    return Frame(0, img, 'test')
+
+
+class TestSkipNoncritical(unittest.TestCase):
+    def setUp(self):
+        self.tracker = tracker.Tracker()
+        self.led = self.tracker.add_led('green', (50, 70), (150, 255), (75, 255), (20, 0))
+        self.budget = budget.TickBudget()
+        self.budget.skip_noncritical = True
+
+    def test_no_pins_tracks_all(self):
+        # nothing drives pins, so there is nothing more important to keep
+        self.tracker.track_feature(green_spot((100, 80)), budget=self.budget)
+        self.assertIsNotNone(self.led.pos_hist[-1])
+
+    def test_pins_skip_others(self):
+        other = self.tracker.add_led('green2', (50, 70), (150, 255), (75, 255), (20, 0))
+        self.tracker.critical_features = lambda: set([other])
+        self.tracker.track_feature(green_spot((100, 80)), budget=self.budget)
+        self.assertIsNotNone(other.pos_hist[-1])
+        self.assertIsNone(self.led.pos_hist[-1])
+
+
+class TestFeatureTypes(unittest.TestCase):
+    def setUp(self):
+        self.tracker = tracker.Tracker()
+
+    def test_bright_led_keeps_value_bounds(self):
+        # a bright LED is no SAT feature, its upper value bound still holds
+        led = self.tracker.add_led('green', (50, 70), (150, 255), (250, 254), (20, 0))
+        self.tracker.track_feature(green_spot((100, 80)))
+        self.assertIsNone(led.pos_hist[-1])
+
+    def test_saturated(self):
+        sat = self.tracker.add_saturated('green', (50, 70), (150, 255), (250, 255), (20, 0))
+        self.tracker.track_feature(green_spot((100, 80)))
+        self.assertIsNotNone(sat.pos_hist[-1])
+
+
+if __name__ == '__main__':
+    unittest.main()